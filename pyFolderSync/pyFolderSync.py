@@ -2,20 +2,38 @@
 # -*- coding: utf-8 -*-
 
 import io
+import json
+import mmap
+import asyncio
+import functools
 import sqlite3
 import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
 import re
 import urllib
 import pathlib
 import time
 import shutil
+import stat
 import hashlib
 import traceback
+import threading
 
 from pathlib import Path
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from sqlite3 import Error
-from os import popen
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
 
 
 # ================================================================
@@ -26,6 +44,11 @@ from os import popen
 
 
 EXT_PATH = '\\\\?\\' if os.name == 'nt' else ''
+DELTA_DIGEST_SIZE = 16  # bytes of blake2b per block signature
+FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+# errors meaning "this copy mechanism can't do it here", the next one is tried
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP,
+                        errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.EPERM, errno.ETXTBSY}
 
 
 # ================================================================
@@ -54,19 +77,460 @@ def _get_parent(filepath):
 def make_parent_if_not_exists(filepath):
     parentOutFilepath = _get_parent(filepath)
     if not(os.path.isdir(parentOutFilepath)):
-        os.makedirs(parentOutFilepath)
+        os.makedirs(parentOutFilepath, exist_ok=True)
+
+
+def get_file_id(filepath, statResult=None):
+    return get_default_file_id_provider().get_file_id(filepath, statResult)
+
 
+def get_default_file_id_provider():
+    return NtfsFileIdProvider() if os.name == 'nt' else StatFileIdProvider()
 
-def get_file_id(filepath):
-    return popen('fsutil file queryfileid "{}"'.format(filepath)).read()
+
+def get_default_watcher():
+    return InotifyWatcher() if InotifyWatcher.is_supported() else PollingWatcher()
 
 
 def get_descedents(dirIn):
-    for root, dirs, files in os.walk(dirIn):
-        for name in files:
-            yield os.path.join(root, name)
-        for name in dirs:
-            yield os.path.join(root, name)
+    for relpath, _ in scan_tree(dirIn):
+        yield os.path.join(dirIn, relpath)
+
+
+def _list_dir(rootDir, relDir):
+    """ (relpath, stat, isDir) per entry of one dir, re-using the stat cached on the DirEntry """
+    try:
+        with os.scandir(os.path.join(rootDir, relDir) if relDir else rootDir) as it:
+            entries = list(it)
+    except OSError:
+        return []
+    listing = []
+    for entry in entries:
+        relpath = os.path.join(relDir, entry.name) if relDir else entry.name
+        try:
+            statResult = entry.stat()
+        except OSError:
+            # broken link or removed mid-scan
+            continue
+        listing.append((relpath, statResult, entry.is_dir(follow_symlinks=False)))
+    return listing
+
+
+# dirs scan_tree keeps open at once, deeper listings are read ahead and closed
+MAX_OPEN_DIRS = 64
+
+
+def scan_tree(rootDir, relDir='', syncFilter=None, matcher=None):
+    """
+    pre-order walk yielding (relpath, stat) per entry, dirs excluded by syncFilter are not entered.
+    Entries stream from scandir as they are read, so memory follows the depth of the tree, not its size.
+    """
+    stack = []  # (relDir, entries, open scandir or None, matcher) per dir being read
+    try:
+        _open_dir(stack, rootDir, relDir, syncFilter, matcher)
+        while stack:
+            dirRelpath, entries, scandirIt, matcher = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                if scandirIt is not None:
+                    scandirIt.close()
+                stack.pop()
+                continue
+            relpath = os.path.join(dirRelpath, entry.name) if dirRelpath else entry.name
+            try:
+                statResult = entry.stat()
+            except OSError:
+                # broken link or removed mid-scan
+                continue
+            isDir = entry.is_dir(follow_symlinks=False)
+            if syncFilter and syncFilter.is_excluded(matcher, relpath, statResult, isDir):
+                continue
+            yield relpath, statResult
+            if isDir:
+                _open_dir(stack, rootDir, relpath, syncFilter, matcher)
+    finally:
+        for _, _, scandirIt, _ in stack:
+            if scandirIt is not None:
+                scandirIt.close()
+
+
+def _open_dir(stack, rootDir, relDir, syncFilter, parentMatcher):
+    try:
+        scandirIt = os.scandir(os.path.join(rootDir, relDir) if relDir else rootDir)
+    except OSError:
+        return
+    matcher = syncFilter.get_matcher(rootDir, relDir, parentMatcher) if syncFilter else None
+    if len(stack) < MAX_OPEN_DIRS:
+        stack.append((relDir, scandirIt, scandirIt, matcher))
+        return
+    # keeps open file handles bounded on very deep trees
+    with scandirIt:
+        entries = list(scandirIt)
+    stack.append((relDir, iter(entries), None, matcher))
+
+
+def scan_tree_indexed(rootDir, index, indexChildren, relDir='', dirStat=None, syncFilter=None, matcher=None,
+                      trustDirMtimes=False):
+    """
+    scan_tree, but a dir whose mtime matches the index has the same children as last sync, so it is not listed:
+    its indexed children are re-stat'd instead and its child dirs are walked the same way to look for changes
+    further down. Only the listings of unchanged dirs are saved, which pays off most on trees with many small dirs.
+    With trustDirMtimes the files of an unchanged dir are yielded with their indexed stat, only dirs are stat'd:
+    the walk costs a stat per dir instead of one per entry, but an in-place edit (it leaves the dir mtime alone)
+    is not seen.
+    """
+    rootPrefix = os.path.join(rootDir, '')
+    # one iterator of (relpath, stat, isDir, matcher) per dir being walked
+    stack = [_indexed_listing(rootDir, rootPrefix, index, indexChildren, relDir, dirStat, syncFilter, matcher,
+                              trustDirMtimes)]
+    while stack:
+        for relpath, statResult, isDir, childMatcher in stack[-1]:
+            yield relpath, statResult
+            if isDir:
+                stack.append(_indexed_listing(rootDir, rootPrefix, index, indexChildren, relpath, statResult,
+                                              syncFilter, childMatcher, trustDirMtimes))
+                break
+        else:
+            stack.pop()
+
+
+def _indexed_listing(rootDir, rootPrefix, index, indexChildren, relDir, dirStat, syncFilter, matcher,
+                     trustDirMtimes):
+    """ (relpath, stat, isDir, matcher) per child of relDir, from the index if relDir is unchanged """
+    indexedStat = index.get(relDir) if relDir else None
+    if indexedStat is not None and dirStat is not None and indexedStat.st_mtime == dirStat.st_mtime:
+        if syncFilter:
+            matcher = syncFilter.get_matcher(rootDir, relDir, matcher)
+        return _stat_indexed(rootPrefix, index, indexChildren.get(relDir, ()), syncFilter, matcher, trustDirMtimes)
+    listing = _list_dir(rootDir, relDir)
+    if syncFilter:
+        listing, matcher = syncFilter.filter_listing(rootDir, relDir, listing, matcher)
+    return ((relpath, statResult, isDir, matcher) for relpath, statResult, isDir in listing)
+
+
+def _stat_indexed(rootPrefix, index, relpaths, syncFilter, matcher, trustDirMtimes):
+    for relpath in relpaths:
+        indexedStat = index[relpath]
+        isDir = stat.S_ISDIR(indexedStat.st_mode)
+        if syncFilter and syncFilter.is_excluded(matcher, relpath, indexedStat, isDir):
+            continue
+        if trustDirMtimes and not(isDir):
+            yield relpath, indexedStat, isDir, matcher
+            continue
+        try:
+            statResult = os.stat(rootPrefix + relpath)
+        except OSError:
+            continue
+        yield relpath, statResult, isDir, matcher
+
+
+def estimate_seconds(bytesCount, operations, bytesPerSecond=None, opsPerSecond=None):
+    """ transfer time at the given rates, None when neither is known """
+    if not(bytesPerSecond) and not(opsPerSecond):
+        return None
+    return (bytesCount / bytesPerSecond if bytesPerSecond else 0) + (operations / opsPerSecond if opsPerSecond else 0)
+
+
+def write_plan(plan, ofp, sync, fullScan=None, bytesPerSecond=None, opsPerSecond=None):
+    """
+    streams a plan as JSON lines: a header naming the sync, one line per operation (in execution order)
+    and a summary with the totals per action and the estimated transfer time
+    """
+    ofp.write(json.dumps({'type': 'header', 'folderIn': sync.get_folderIn(), 'folderOut': sync.get_folderOut(),
+                          'fullScan': fullScan, 'planned': formate_date_iso8601(datetime.now())}) + '\n')
+    operations = 0
+    bytesCount = 0
+    for operation in plan:
+        record = operation.to_dict()
+        record['type'] = 'operation'
+        ofp.write(json.dumps(record) + '\n')
+        operations += 1
+        bytesCount += record['bytes']
+    ofp.write(json.dumps({'type': 'summary', 'operations': operations, 'bytes': bytesCount,
+                          'actions': plan.get_totals(), 'bytesPerSecond': bytesPerSecond,
+                          'opsPerSecond': opsPerSecond,
+                          'estimatedSeconds': estimate_seconds(bytesCount, operations, bytesPerSecond, opsPerSecond)
+                          }) + '\n')
+
+
+def read_plan(ifp):
+    """ (header, SyncPlan, summary) of a write_plan stream, summary is None if the stream was cut short """
+    header = None
+    summary = None
+    plan = SyncPlan()
+    for line in ifp:
+        if not(line.strip()):
+            continue
+        record = json.loads(line)
+        if record['type'] == 'header':
+            header = record
+        elif record['type'] == 'operation':
+            plan.add(SyncOperation.build_from_dict(record))
+        elif record['type'] == 'summary':
+            summary = record
+    return header, plan, summary
+
+
+def _index_children(index):
+    """ {parent relpath: [child relpaths]} of an index """
+    indexChildren = {}
+    for relpath in index:
+        # relpaths are normalized, so this is os.path.dirname
+        indexChildren.setdefault(relpath.rpartition(os.sep)[0], []).append(relpath)
+    return indexChildren
+
+
+def _block_digest(block):
+    return hashlib.blake2b(block, digest_size=DELTA_DIGEST_SIZE).digest()
+
+
+def hash_file(filepath, chunkSize=1024 * 1024):
+    """ blake2b hex digest of the file contents, read in chunks """
+    digest = hashlib.blake2b()
+    with open(filepath, 'rb') as ifp:
+        for chunk in iter(lambda: ifp.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compute_block_signatures(filepath, blockSize):
+    """ concatenated digests of each fixed-size block of filepath """
+    signatures = bytearray()
+    with open(filepath, 'rb') as ifp:
+        for block in iter(lambda: ifp.read(blockSize), b''):
+            signatures += _block_digest(block)
+    return bytes(signatures)
+
+
+def delta_copy(inFilepath, outFilepath, blockSize, signatures=None):
+    """
+    rewrites in place only the blocks of outFilepath that differ from inFilepath, then truncates it to size.
+    signatures are the block signatures of outFilepath, computed (full read) when not given.
+    Returns (block signatures of the updated outFilepath, bytes written)
+    """
+    if signatures is None:
+        signatures = compute_block_signatures(outFilepath, blockSize)
+    newSignatures = bytearray()
+    bytesWritten = 0
+    with open(inFilepath, 'rb') as ifp, open(outFilepath, 'r+b') as ofp:
+        for blockIndex, block in enumerate(iter(lambda: ifp.read(blockSize), b'')):
+            digest = _block_digest(block)
+            digestOffset = blockIndex * DELTA_DIGEST_SIZE
+            if signatures[digestOffset:digestOffset + DELTA_DIGEST_SIZE] != digest:
+                ofp.seek(blockIndex * blockSize)
+                ofp.write(block)
+                bytesWritten += len(block)
+            newSignatures += digest
+        ofp.truncate(ifp.tell())
+    return bytes(newSignatures), bytesWritten
+
+
+def _relative_to(rootDir, filepath):
+    """ path of filepath under rootDir ('' for rootDir itself), ValueError if it is not under it """
+    if filepath == rootDir:
+        return ''
+    prefix = rootDir if rootDir.endswith(os.sep) else rootDir + os.sep
+    if not(filepath.startswith(prefix)):
+        raise ValueError('{} is not under {}'.format(filepath, rootDir))
+    return filepath[len(prefix):]
+
+
+def _ignore_pattern_to_regex(pattern):
+    """ regex of one gitignore-style glob: * and ? stay within a name, ** spans dirs, [...] classes """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            body = pattern[i + 1:end]
+            parts.append('[' + ('^' + body[1:] if body.startswith('!') else body) + ']')
+            i = end
+        elif c == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+def parse_ignore_patterns(lines, baseDir=''):
+    """
+    (regex, negate, dirOnly) rules of gitignore-style lines, relative to baseDir: blank lines and
+    # comments are skipped, ! negates, a trailing / only matches dirs, a pattern holding a / is
+    anchored to baseDir while one without matches names at any depth.
+    """
+    prefix = re.escape(baseDir.replace(os.sep, '/') + '/') if baseDir else ''
+    rules = []
+    for line in lines:
+        line = line.rstrip('\r\n').rstrip(' ')
+        if not(line) or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dirOnly = line.endswith('/')
+        line = line.rstrip('/')
+        if not(line):
+            continue
+        anchored = '/' in line
+        regex = _ignore_pattern_to_regex(line.lstrip('/'))
+        rules.append((prefix + (regex if anchored else '(?:.*/)?' + regex), negate, dirOnly))
+    return rules
+
+
+def _get_temp_filepath(filepath):
+    """ hidden sibling of filepath that a copy is written to before being renamed over it """
+    return os.path.join(os.path.dirname(filepath), '.' + os.path.basename(filepath) + '.pyfoldersync-tmp')
+
+
+def _is_copied(inFilepath, outFilepath):
+    """ whether outFilepath is a finished copy of inFilepath (copies get their stat once complete) """
+    try:
+        outStat = os.stat(outFilepath)
+    except FileNotFoundError:
+        return False
+    inStat = os.stat(inFilepath)
+    return (stat.S_ISREG(outStat.st_mode) and outStat.st_size == inStat.st_size and
+            outStat.st_mtime == inStat.st_mtime)
+
+
+def fan_out_copy(inFilepath, outFilepaths, bufferSize=1024 * 1024):
+    """
+    copies inFilepath to every outFilepath with a single read of it, each chunk read is written to all
+    of them. A failing output (missing volume, disk full) is dropped and the others carry on.
+    Copies are written next to their target and renamed over it once complete.
+    Returns the outFilepaths copied, raises if inFilepath can't be read.
+    """
+    outputs = {}  # outFilepath -> (tmpFilepath, file)
+    copied = []
+    try:
+        for outFilepath in outFilepaths:
+            tmpFilepath = _get_temp_filepath(outFilepath)
+            try:
+                make_parent_if_not_exists(outFilepath)
+                outputs[outFilepath] = (tmpFilepath, open(tmpFilepath, 'wb'))
+            except OSError:
+                traceback.print_exc()
+        buffer = bytearray(bufferSize)
+        view = memoryview(buffer)
+        with open(inFilepath, 'rb') as ifp:
+            while outputs:
+                length = ifp.readinto(buffer)
+                if not(length):
+                    break
+                for outFilepath, (tmpFilepath, ofp) in list(outputs.items()):
+                    try:
+                        ofp.write(view[:length])
+                    except OSError:
+                        print("failed to fan out to:" + outFilepath)
+                        traceback.print_exc()
+                        _discard_output(*outputs.pop(outFilepath))
+        for outFilepath, (tmpFilepath, ofp) in list(outputs.items()):
+            try:
+                ofp.close()
+                shutil.copystat(inFilepath, tmpFilepath)
+                os.replace(tmpFilepath, outFilepath)
+                copied.append(outFilepath)
+            except OSError:
+                print("failed to fan out to:" + outFilepath)
+                traceback.print_exc()
+                _discard_output(tmpFilepath, ofp)
+            del outputs[outFilepath]
+    finally:
+        for tmpFilepath, ofp in outputs.values():
+            _discard_output(tmpFilepath, ofp)
+    return copied
+
+
+def _discard_output(tmpFilepath, ofp):
+    try:
+        ofp.close()
+    except OSError:
+        pass
+    try:
+        os.remove(tmpFilepath)
+    except OSError:
+        pass
+
+
+def _operation_paths(operation):
+    """ relpaths a SyncOperation touches """
+    if operation.get_oldRelpath() is not None:
+        return (operation.get_relpath(), operation.get_oldRelpath())
+    return (operation.get_relpath(),)
+
+
+def _overlaps_in_flight(paths, inFlight):
+    """ whether paths overlap any of the paths of the in flight operations {future: paths} """
+    return any(_paths_overlap(path, inFlightPath)
+               for inFlightPaths in inFlight.values()
+               for inFlightPath in inFlightPaths
+               for path in paths)
+
+
+def _relpath_sort_key(relpath):
+    return relpath.split(os.sep)
+
+
+def _remap_relpath(relpath, renames):
+    """ relpath with its nearest renamed ancestor (or itself) swapped for the new name, renames {old: new} """
+    ancestor = relpath
+    while ancestor:
+        renamed = renames.get(ancestor)
+        if renamed is not None:
+            return renamed + relpath[len(ancestor):]
+        ancestor = os.path.dirname(ancestor)
+    return relpath
+
+
+@functools.lru_cache(maxsize=None)
+def _sql_tables(query):
+    """ names a sql statement reads or writes (a CTE name included, it is never written) """
+    return frozenset(re.findall(r'\b(?:FROM|JOIN|INTO|UPDATE(?: OR \w+)?)\s+(\w+)', query))
+
+
+def _paths_overlap(pathA, pathB):
+    """ same path, or one is an ancestor of the other """
+    if len(pathA) > len(pathB):
+        pathA, pathB = pathB, pathA
+    return pathB.startswith(pathA) and (len(pathA) == len(pathB) or pathB[len(pathA)] == os.sep)
+
+
+def run_cycles(cycle, frequency):
+    """ cycle(), then again every frequency seconds after it finished (once if frequency is None) """
+    while True:
+        cycle()
+        # re-run or stop
+        if frequency:
+            time.sleep(frequency)
+        else:
+            break
+
+
+def _timed(function):
+    """ records each call of a FolderSync method in the timings of its current SyncMetrics """
+    @functools.wraps(function)
+    def timed(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            self.metrics.observe(function.__name__, time.perf_counter() - start)
+    return timed
 
 
 # ================================================================
@@ -81,9 +545,10 @@ def get_descedents(dirIn):
 
 class Sync:
 
-    def __init__(self, folderIn, folderOut):
+    def __init__(self, folderIn, folderOut, syncFilter=None):
         self._folderIn = folderIn
         self._folderOut = folderOut
+        self._syncFilter = syncFilter  # SyncFilter of what is mirrored, None for everything
 
     @staticmethod
     def build_from_dict(dictInput):
@@ -92,149 +557,2620 @@ class Sync:
     def get_folderIn(self):
         return self._folderIn
 
-    def get_folderOut(self):
-        return self._folderOut
+    def get_folderOut(self):
+        return self._folderOut
+
+    def get_syncFilter(self):
+        return self._syncFilter
+
+
+class FileId:
+    """
+    Identity of a file that survives renames/moves on the same volume.
+    (st_dev, st_ino) on POSIX, (volume serial, NTFS file index) on Windows.
+    """
+
+    def __init__(self, device, index):
+        self._device = device
+        self._index = index
+
+    @staticmethod
+    def build_from_str(strInput):
+        if not strInput:
+            return None
+        device, index = strInput.split(':', 1)
+        return FileId(int(device), int(index))
+
+    def get_device(self):
+        return self._device
+
+    def get_index(self):
+        return self._index
+
+    def __str__(self):
+        return '{}:{}'.format(self._device, self._index)
+
+    def __repr__(self):
+        return 'FileId({}, {})'.format(self._device, self._index)
+
+    def __eq__(self, other):
+        return isinstance(other, FileId) and (self._device, self._index) == (other._device, other._index)
+
+    def __hash__(self):
+        return hash((self._device, self._index))
+
+
+class EntryStat:
+    """ stat-like metadata of an indexed entry, usable in place of an os.stat_result in snapshots """
+
+    __slots__ = ('st_mode', 'st_size', 'st_mtime', 'st_dev', 'st_ino')
+
+    def __init__(self, st_mode, st_size, st_mtime, st_dev=0, st_ino=0):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_dev = st_dev
+        self.st_ino = st_ino
+
+    @staticmethod
+    def build_from_dict(dictInput):
+        if dictInput.get('mode') is None:
+            return None
+        fileId = FileId.build_from_str(dictInput['file_id'])
+        return EntryStat(dictInput['mode'],
+                         dictInput['size'],
+                         dictInput['mtime'],
+                         fileId.get_device() if fileId else 0,
+                         fileId.get_index() if fileId else 0)
+
+    @staticmethod
+    def build_from_stat_dict(dictInput):
+        """ inverse of stat_to_dict """
+        if not dictInput:
+            return None
+        return EntryStat(dictInput['mode'], dictInput['size'], dictInput['mtime'])
+
+    @staticmethod
+    def stat_to_dict(statResult):
+        """ the part of a stat result plans are serialized with """
+        if statResult is None:
+            return None
+        return {'mode': statResult.st_mode, 'size': statResult.st_size, 'mtime': statResult.st_mtime}
+
+
+class Location:
+
+    def __init__(self, sync, folderInLocation, folderInId=None, folderInStat=None, folderInHash=None):
+        self._sync = sync
+        self._folderInLocation = folderInLocation
+        self._folderInId = folderInId
+        self._folderInStat = folderInStat
+        self._folderInHash = folderInHash
+
+    @staticmethod
+    def build_from_dict(sync, folderInLocation, dictInput):
+        """ location row of sync, its path is rebuilt from the directory table by the DataStore """
+        return Location(sync,
+                        folderInLocation,
+                        FileId.build_from_str(dictInput['file_id']),
+                        EntryStat.build_from_dict(dictInput),
+                        dictInput.get('hash'))
+
+    def get_sync(self):
+        return self._sync
+
+    def get_folderInLocation(self):
+        return self._folderInLocation
+
+    def get_folderInId(self):
+        return self._folderInId
+
+    def get_folderInStat(self):
+        return self._folderInStat
+
+    def get_folderInHash(self):
+        return self._folderInHash
+
+
+class SyncOperation:
+    """ one planned change to folderOut, paths are relative to the sync roots """
+
+    CREATE = 'create'
+    UPDATE = 'update'
+    MOVE = 'move'
+    DELETE = 'delete'
+    TRACK = 'track'  # both sides in sync, only the index is missing/stale
+
+    def __init__(self, action, relpath, inStat=None, outStat=None,
+                 fileId=None, priorLocation=None, oldRelpath=None):
+        self._action = action
+        self._relpath = relpath
+        self._inStat = inStat
+        self._outStat = outStat
+        self._fileId = fileId
+        self._priorLocation = priorLocation
+        self._oldRelpath = oldRelpath
+        self._copyBackends = None
+        self._subtreeBytes = 0  # files under a created dir, copied along with it
+
+    @staticmethod
+    def build_from_dict(dictInput):
+        """ operation of a serialized plan (see write_plan), its stats are the ones seen when planning """
+        operation = SyncOperation(dictInput['action'], dictInput['relpath'],
+                                  EntryStat.build_from_stat_dict(dictInput.get('inStat')),
+                                  EntryStat.build_from_stat_dict(dictInput.get('outStat')),
+                                  oldRelpath=dictInput.get('oldRelpath'))
+        inStat = operation.get_inStat()
+        if inStat is not None and stat.S_ISDIR(inStat.st_mode):
+            operation.add_subtree_bytes(dictInput.get('bytes', 0))
+        return operation
+
+    def to_dict(self):
+        return {
+            'action': self._action,
+            'relpath': self._relpath,
+            'oldRelpath': self._oldRelpath,
+            'bytes': self.get_bytes(),
+            'inStat': EntryStat.stat_to_dict(self._inStat),
+            'outStat': EntryStat.stat_to_dict(self._outStat),
+        }
+
+    def get_action(self):
+        return self._action
+
+    def get_relpath(self):
+        return self._relpath
+
+    def get_inStat(self):
+        return self._inStat
+
+    def get_outStat(self):
+        return self._outStat
+
+    def get_fileId(self):
+        return self._fileId
+
+    def get_priorLocation(self):
+        return self._priorLocation
+
+    def get_oldRelpath(self):
+        return self._oldRelpath
+
+    def get_copyBackends(self):
+        """ {copy mechanism: files copied with it} once executed """
+        return self._copyBackends
+
+    def set_copyBackends(self, copyBackends):
+        self._copyBackends = copyBackends
+
+    def get_bytes(self):
+        """ bytes it copies, an upper bound for delta updates """
+        if self._action not in (SyncOperation.CREATE, SyncOperation.UPDATE) or self._inStat is None:
+            return 0
+        if stat.S_ISREG(self._inStat.st_mode):
+            return self._inStat.st_size
+        return self._subtreeBytes
+
+    def add_subtree_bytes(self, size):
+        self._subtreeBytes += size
+
+
+class SyncResult:
+    """ outcome of one sync cycle """
+
+    def __init__(self, plan, failures, fullScan):
+        self._plan = plan
+        self._failures = failures
+        self._fullScan = fullScan
+
+    def get_plan(self):
+        return self._plan
+
+    def get_failures(self):
+        return self._failures
+
+    def get_fullScan(self):
+        return self._fullScan
+
+
+class SyncPlan:
+    """ ordered operations computed from one snapshot of each side """
+
+    def __init__(self):
+        self._operations = []
+
+    def add(self, operation):
+        self._operations.append(operation)
+
+    def get_operations(self, action=None):
+        return [op for op in self._operations if action is None or op.get_action() == action]
+
+    def get_totals(self):
+        """ {action: {'operations': count, 'bytes': bytes copied}} """
+        totals = {}
+        for operation in self._operations:
+            total = totals.setdefault(operation.get_action(), {'operations': 0, 'bytes': 0})
+            total['operations'] += 1
+            total['bytes'] += operation.get_bytes()
+        return totals
+
+    def __iter__(self):
+        return iter(self._operations)
+
+    def __len__(self):
+        return len(self._operations)
+
+
+# Helper Classes
+# ================================================================
+
+class FileIdProvider:
+    """ resolves the FileId of a path, re-using a stat result when one is already in hand """
+
+    def get_file_id(self, filepath, statResult=None):
+        raise NotImplementedError
+
+
+class StatFileIdProvider(FileIdProvider):
+    """ POSIX file identity: (st_dev, st_ino) """
+
+    def get_file_id(self, filepath, statResult=None):
+        if statResult is None:
+            statResult = os.stat(filepath)
+        return FileId(statResult.st_dev, statResult.st_ino)
+
+
+class NtfsFileIdProvider(StatFileIdProvider):
+    """
+    Windows file identity: os.stat fills st_dev/st_ino with the volume serial and NTFS file index,
+    but DirEntry.stat() leaves both as 0, so those results are re-read with os.stat.
+    """
+
+    def get_file_id(self, filepath, statResult=None):
+        if statResult is None or not(statResult.st_ino):
+            statResult = os.stat(filepath)
+        return FileId(statResult.st_dev, statResult.st_ino)
+
+
+class FileCopier:
+    """ copies a file like shutil.copy2, returns the name of the mechanism that moved the data """
+
+    def copy_data(self, inFilepath, outFilepath):
+        raise NotImplementedError
+
+    def copy(self, inFilepath, outFilepath):
+        backend = self.copy_data(inFilepath, outFilepath)
+        shutil.copystat(inFilepath, outFilepath)
+        return backend
+
+
+class BufferedFileCopier(FileCopier):
+    """ readinto loop through a per-thread buffer """
+
+    BUFFERED = 'readinto'
+
+    def __init__(self, bufferSize=1024 * 1024):
+        self.bufferSize = bufferSize
+        self._local = threading.local()
+
+    def copy_data(self, inFilepath, outFilepath):
+        with open(inFilepath, 'rb') as ifp, open(outFilepath, 'wb') as ofp:
+            return self._copy_buffered(ifp, ofp)
+
+    def _copy_buffered(self, ifp, ofp):
+        view = getattr(self._local, 'view', None)
+        if view is None:
+            view = self._local.view = memoryview(bytearray(self.bufferSize))
+        while True:
+            read = ifp.readinto(view)
+            if not(read):
+                break
+            ofp.write(view[:read])
+        return BufferedFileCopier.BUFFERED
+
+
+class KernelFileCopier(BufferedFileCopier):
+    """
+    Copies without moving data through python where the platform allows it:
+    reflink (FICLONE, btrfs/XFS), then copy_file_range, then sendfile, then the buffered loop.
+    """
+
+    REFLINK = 'reflink'
+    COPY_FILE_RANGE = 'copy_file_range'
+    SENDFILE = 'sendfile'
+
+    def copy_data(self, inFilepath, outFilepath):
+        with open(inFilepath, 'rb') as ifp, open(outFilepath, 'wb') as ofp:
+            for backend, method in ((KernelFileCopier.REFLINK, self._reflink),
+                                    (KernelFileCopier.COPY_FILE_RANGE, self._copy_file_range),
+                                    (KernelFileCopier.SENDFILE, self._sendfile)):
+                try:
+                    if method(ifp.fileno(), ofp.fileno()):
+                        return backend
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+                # undo any partial copy before falling back
+                ofp.truncate(0)
+                os.lseek(ifp.fileno(), 0, os.SEEK_SET)
+                os.lseek(ofp.fileno(), 0, os.SEEK_SET)
+            return self._copy_buffered(ifp, ofp)
+
+    def _reflink(self, inFd, outFd):
+        if fcntl is None:
+            return False
+        fcntl.ioctl(outFd, FICLONE, inFd)
+        return True
+
+    def _copy_file_range(self, inFd, outFd):
+        if not(hasattr(os, 'copy_file_range')):
+            return False
+        return self._copy_with(lambda count: os.copy_file_range(inFd, outFd, count), inFd)
+
+    def _sendfile(self, inFd, outFd):
+        if not(sys.platform.startswith('linux')):
+            return False
+        return self._copy_with(lambda count: os.sendfile(outFd, inFd, None, count), inFd)
+
+    def _copy_with(self, copyChunk, inFd):
+        copied = 0
+        while True:
+            sent = copyChunk(self.bufferSize * 8)
+            if not(sent):
+                break
+            copied += sent
+        # some filesystems (procfs, ...) report 0 bytes right away, let the next mechanism copy them
+        return copied > 0 or os.fstat(inFd).st_size == 0
+
+
+class ThrottledFileCopier(KernelFileCopier):
+    """
+    KernelFileCopier writing bufferSize chunks paced by a RateLimiter, so big files are spread out
+    instead of written in one burst. Reflinks write no data and are not paced.
+    """
+
+    def __init__(self, rateLimiter, bufferSize=1024 * 1024):
+        super().__init__(bufferSize)
+        self.rateLimiter = rateLimiter
+
+    def _copy_with(self, copyChunk, inFd):
+        copied = 0
+        while True:
+            start = time.perf_counter()
+            sent = copyChunk(self.bufferSize)
+            if not(sent):
+                break
+            copied += sent
+            self.rateLimiter.pace(sent, time.perf_counter() - start)
+        return copied > 0 or os.fstat(inFd).st_size == 0
+
+    def _copy_buffered(self, ifp, ofp):
+        view = getattr(self._local, 'view', None)
+        if view is None:
+            view = self._local.view = memoryview(bytearray(self.bufferSize))
+        while True:
+            read = ifp.readinto(view)
+            if not(read):
+                break
+            start = time.perf_counter()
+            ofp.write(view[:read])
+            self.rateLimiter.pace(read, time.perf_counter() - start)
+        return BufferedFileCopier.BUFFERED
+
+
+class TokenBucket:
+    """
+    rate tokens per second, up to burst saved up. consume() may overdraw: the debt is returned as the
+    seconds the caller has to wait, so concurrent callers queue up behind each other.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._last = clock()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """ None = unlimited, burst defaults to one second worth """
+        with self._lock:
+            self._refill()
+            # a bucket that was unlimited starts full
+            self.tokens = (min(self.tokens, burst if burst is not None else rate) if self.rate else
+                           (burst if burst is not None else rate)) if rate else 0
+            self.rate = rate
+            self.burst = burst if burst is not None else rate
+
+    def consume(self, amount):
+        """ seconds to wait before using amount """
+        with self._lock:
+            if not(self.rate):
+                return 0
+            self._refill()
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+
+class ThrottleProfile:
+    """
+    rates used between start and end ('HH:MM' local time, wraps past midnight, start == end is all day),
+    None = unlimited
+    """
+
+    def __init__(self, start, end, bytesPerSecond=None, opsPerSecond=None):
+        self.start = datetime.strptime(start, '%H:%M').time()
+        self.end = datetime.strptime(end, '%H:%M').time()
+        self.bytesPerSecond = bytesPerSecond
+        self.opsPerSecond = opsPerSecond
+
+    def is_active(self, now):
+        nowTime = now.time()
+        if self.start == self.end:
+            return True
+        if self.start < self.end:
+            return self.start <= nowTime < self.end
+        return nowTime >= self.start or nowTime < self.end
+
+
+class RateLimiter:
+    """
+    Token buckets on bytes/s and ops/s (file copies, moves and deletes), shareable by several syncs.
+    The first active ThrottleProfile overrides the default rates.
+    adaptive: write latency (seconds per byte, smoothed) is compared to the best seen so far; above
+    latencyFactor times that the byte rate is cut, below it recovers. Without a byte rate the cut
+    applies to the observed throughput.
+    """
+
+    BACKOFF = 0.7
+    RECOVER = 1.05
+    ADJUST_EVERY = 0.5  # seconds between two adaptive steps
+
+    def __init__(self, bytesPerSecond=None, opsPerSecond=None, profiles=None, adaptive=False,
+                 latencyFactor=2.0, minScale=0.05, clock=time.monotonic, sleep=time.sleep):
+        self.bytesPerSecond = bytesPerSecond
+        self.opsPerSecond = opsPerSecond
+        self.profiles = list(profiles) if profiles else []
+        self.adaptive = adaptive
+        self.latencyFactor = latencyFactor
+        self.minScale = minScale
+        self.clock = clock
+        self.sleep = sleep
+        self._bytes = TokenBucket(clock=clock)
+        self._ops = TokenBucket(clock=clock)
+        self._lock = threading.Lock()
+        self._rates = None  # (bytes/s, ops/s) applied to the buckets
+        self._nextRefresh = 0
+        self._scale = 1.0
+        self._latency = None  # smoothed seconds per byte
+        self._bestLatency = None
+        self._throughput = None  # smoothed bytes/s of the writes
+        self._nextAdjust = 0
+
+    def acquire_op(self):
+        self._refresh()
+        self._wait(self._ops.consume(1))
+
+    def pace(self, size, seconds):
+        """ called after writing size bytes in seconds, waits as long as the byte rate asks """
+        if self.adaptive and size:
+            self._adapt(size, seconds)
+        self._refresh()
+        self._wait(self._bytes.consume(size))
+
+    def get_rates(self):
+        """ (bytes/s, ops/s) currently applied, None = unlimited """
+        self._refresh()
+        return self._rates
+
+    def get_scale(self):
+        return self._scale
+
+    def _wait(self, seconds):
+        if seconds > 0:
+            self.sleep(seconds)
+
+    def _refresh(self, force=False):
+        now = self.clock()
+        if not(force) and now < self._nextRefresh:
+            return
+        with self._lock:
+            self._nextRefresh = now + 1
+            bytesPerSecond, opsPerSecond = self.bytesPerSecond, self.opsPerSecond
+            if self.profiles:
+                localNow = datetime.now()
+                for profile in self.profiles:
+                    if profile.is_active(localNow):
+                        bytesPerSecond, opsPerSecond = profile.bytesPerSecond, profile.opsPerSecond
+                        break
+            if bytesPerSecond is None and self._scale < 1 and self._throughput:
+                bytesPerSecond = self._throughput
+            if bytesPerSecond is not None:
+                bytesPerSecond = max(bytesPerSecond * self._scale, 1)
+            rates = (bytesPerSecond, opsPerSecond)
+            if rates != self._rates:
+                self._bytes.set_rate(bytesPerSecond)
+                self._ops.set_rate(opsPerSecond)
+                self._rates = rates
+
+    def _adapt(self, size, seconds):
+        with self._lock:
+            latency = seconds / size
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            if seconds > 0:
+                throughput = size / seconds
+                self._throughput = throughput if self._throughput is None else \
+                    0.8 * self._throughput + 0.2 * throughput
+            self._bestLatency = self._latency if self._bestLatency is None else min(self._bestLatency, self._latency)
+            now = self.clock()
+            if now < self._nextAdjust:
+                return
+            self._nextAdjust = now + RateLimiter.ADJUST_EVERY
+            if self._latency > self._bestLatency * self.latencyFactor:
+                scale = max(self._scale * RateLimiter.BACKOFF, self.minScale)
+            else:
+                scale = min(self._scale * RateLimiter.RECOVER, 1.0)
+            changed = scale != self._scale
+            self._scale = scale
+        if changed:
+            self._refresh(force=True)
+
+
+class PathMatcher:
+    """
+    gitignore-style rules (see parse_ignore_patterns) compiled to one regex per entry type,
+    the last rule matching a path (or one of its parent dirs) decides whether it is excluded
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        self._dirRegex, self._dirNegates = self._compile(True)
+        self._fileRegex, self._fileNegates = self._compile(False)
+
+    def extended(self, rules):
+        """ matcher with rules after these ones (so they win) """
+        return PathMatcher(self.rules + list(rules)) if rules else self
+
+    def is_excluded(self, relpath, isDir):
+        regex, negates = (self._dirRegex, self._dirNegates) if isDir else (self._fileRegex, self._fileNegates)
+        if regex is None:
+            return False
+        match = regex.fullmatch(relpath if os.sep == '/' else relpath.replace(os.sep, '/'))
+        return match is not None and not(negates[match.lastindex - 1])
+
+    def _compile(self, isDir):
+        # one group per rule, last rule first: the first alternative that matches is the rule that decides
+        alternatives = []
+        negates = []
+        for regex, negate, dirOnly in reversed(self.rules):
+            # a matching parent dir excludes what is under it, dir-only rules only match files that way
+            alternatives.append('(' + regex + ('/.*' if dirOnly and not(isDir) else '(?:/.*)?') + ')')
+            negates.append(negate)
+        return (re.compile('|'.join(alternatives), re.DOTALL) if alternatives else None), negates
+
+
+class SyncFilter:
+    """
+    What a sync mirrors. patterns are gitignore-style lines for the whole tree, ignoreFilename names
+    per-dir ignore files whose patterns apply under their dir (deeper files win). Files can further be
+    limited by size (bytes) and age (seconds since modified). Excluded dirs are pruned from the walks,
+    so their contents are never listed, and excluded entries are left alone on both sides.
+    """
+
+    def __init__(self, patterns=(), ignoreFilename=None, minSize=None, maxSize=None, minAge=None, maxAge=None):
+        self.matcher = PathMatcher(parse_ignore_patterns(patterns))
+        self.ignoreFilename = ignoreFilename
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.minAge = minAge  # skips files still being written
+        self.maxAge = maxAge
+        self._matchers = {}  # (rootDir, relDir) -> (ignore file mtime, parent matcher, matcher)
+
+    def get_matcher(self, rootDir, relDir, parentMatcher=None, listing=None):
+        """
+        matcher for the entries of relDir. Walks pass the matcher of the parent dir and the listing of
+        relDir, other callers get the one the last walk used.
+        """
+        if not(self.ignoreFilename):
+            return self.matcher
+        key = (rootDir, relDir)
+        cached = self._matchers.get(key)
+        if parentMatcher is None:
+            if cached is not None and listing is None:
+                return cached[2]
+            parentMatcher = self.get_matcher(rootDir, os.path.dirname(relDir)) if relDir else self.matcher
+        ignoreRelpath = os.path.join(relDir, self.ignoreFilename) if relDir else self.ignoreFilename
+        ignoreFilepath = os.path.join(rootDir, ignoreRelpath)
+        if listing is not None:
+            ignoreStat = next((statResult for relpath, statResult, _ in listing if relpath == ignoreRelpath), None)
+        else:
+            try:
+                ignoreStat = os.stat(ignoreFilepath)
+            except OSError:
+                ignoreStat = None
+        ignoreMtime = ignoreStat.st_mtime if ignoreStat is not None else None
+        if cached is not None and cached[0] == ignoreMtime and cached[1] is parentMatcher:
+            return cached[2]
+        matcher = parentMatcher
+        if ignoreMtime is not None:
+            with open(ignoreFilepath, encoding='utf-8', errors='replace') as ifp:
+                matcher = parentMatcher.extended(parse_ignore_patterns(ifp, relDir))
+        self._matchers[key] = (ignoreMtime, parentMatcher, matcher)
+        return matcher
+
+    def filter_listing(self, rootDir, relDir, listing, parentMatcher=None):
+        """ (entries of a _list_dir listing that are not excluded, matcher of relDir) """
+        matcher = self.get_matcher(rootDir, relDir, parentMatcher, listing)
+        return [entry for entry in listing if not(self.is_excluded(matcher, *entry))], matcher
+
+    def is_excluded(self, matcher, relpath, statResult, isDir):
+        if matcher.is_excluded(relpath, isDir):
+            return True
+        if isDir or not(stat.S_ISREG(statResult.st_mode)):
+            return False
+        if self.minSize is not None and statResult.st_size < self.minSize:
+            return True
+        if self.maxSize is not None and statResult.st_size > self.maxSize:
+            return True
+        if self.minAge is not None or self.maxAge is not None:
+            age = time.time() - statResult.st_mtime
+            if self.minAge is not None and age < self.minAge:
+                return True
+            if self.maxAge is not None and age > self.maxAge:
+                return True
+        return False
+
+    def is_path_excluded(self, rootDir, relpath, statResult):
+        """ is_excluded for a single path, e.g. from a watcher or the index """
+        return self.is_excluded(self.get_matcher(rootDir, os.path.dirname(relpath)), relpath, statResult,
+                                stat.S_ISDIR(statResult.st_mode))
+
+
+class DeleteWaitlist:
+    """
+    Paths under rootDir waiting one more run to be deleted, kept as a tree of interned names
+    ({name: None for a waiting leaf, or {name: ..., WAITING: None} for a dir}) instead of a set
+    of full paths, so a deleted dir drops everything waiting under it in one step.
+    Shared by the handlers running on PlanExecutor workers, so every access holds the lock.
+    """
+
+    WAITING = ''  # key of a dir waiting itself, never a file name
+
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self._root = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def add(self, filepath):
+        parts = self._split(filepath)
+        with self._lock:
+            if parts and self._find(parts) is None:
+                self._add(parts)
+
+    def discard(self, filepath):
+        """ drops filepath, but not what waits under it """
+        parts = self._split(filepath)
+        with self._lock:
+            self._discard(parts)
+
+    def discard_subtree(self, filepath):
+        """ drops filepath and everything waiting under it """
+        parts = self._split(filepath)
+        with self._lock:
+            self._discard_subtree(parts)
+
+    def clear(self):
+        self.discard_subtree(self.rootDir)
+
+    def __contains__(self, filepath):
+        parts = self._split(filepath)
+        with self._lock:
+            return self._find(parts) is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def _add(self, parts):
+        node = self._root
+        for name in parts[:-1]:
+            child = node.get(name)
+            if child is None:
+                # a waiting leaf with waiting children becomes a dir node
+                child = node[sys.intern(name)] = {DeleteWaitlist.WAITING: None} if name in node else {}
+            node = child
+        name = parts[-1]
+        child = node.get(name)
+        if child is None:
+            node[sys.intern(name)] = None
+        else:
+            child[DeleteWaitlist.WAITING] = None
+        self._count += 1
+
+    def _discard(self, parts):
+        path = self._find(parts)
+        if path is None:
+            return
+        parent, name = path[-1]
+        child = parent[name]
+        if child is None:
+            del parent[name]
+        else:
+            del child[DeleteWaitlist.WAITING]
+        self._count -= 1
+        self._prune(path)
+
+    def _discard_subtree(self, parts):
+        if not(parts):
+            self._root = {}
+            self._count = 0
+            return
+        node = self._root
+        path = []
+        for name in parts:
+            if node is None or name not in node:
+                return
+            path.append((node, name))
+            node = node[name]
+        parent, name = path[-1]
+        self._count -= self._count_waiting(parent.pop(name))
+        self._prune(path)
+
+    def _split(self, filepath):
+        relpath = _relative_to(self.rootDir, filepath)
+        return relpath.split(os.sep) if relpath else []
+
+    def _find(self, parts):
+        """ [(parent node, name)] down to a waiting filepath, None if it is not waiting """
+        if not(parts):
+            return None
+        node = self._root
+        path = []
+        for name in parts:
+            if node is None or name not in node:
+                return None
+            path.append((node, name))
+            node = node[name]
+        if node is not None and DeleteWaitlist.WAITING not in node:
+            return None
+        return path
+
+    def _count_waiting(self, node):
+        if node is None:
+            return 1
+        return sum(self._count_waiting(child) if name != DeleteWaitlist.WAITING else 1
+                   for name, child in node.items())
+
+    def _prune(self, path):
+        """ removes dir nodes left empty, bottom up """
+        for parent, name in reversed(path):
+            if name not in parent:
+                continue
+            if parent[name] is not None and not(parent[name]):
+                del parent[name]
+            else:
+                return
+
+
+class WriteBatch:
+    """ write statements collected to run in one transaction, in order """
+
+    def __init__(self):
+        self._statements = []
+        self._tables = set()
+
+    def add(self, query, args):
+        self._statements.append((query, args))
+        self._tables.update(_sql_tables(query))
+
+    def touches(self, query):
+        """ whether query reads a table the collected statements write """
+        return not(self._tables.isdisjoint(_sql_tables(query)))
+
+    def get_statement_groups(self):
+        """ (query, [args]) per run of the same query, each run is one executemany """
+        groups = []
+        for query, args in self._statements:
+            if groups and groups[-1][0] is query:
+                groups[-1][1].append(args)
+            else:
+                groups.append((query, [args]))
+        return groups
+
+    def __len__(self):
+        return len(self._statements)
+
+
+class DatabaseConnector:
+
+    PRAGMAS = ("PRAGMA journal_mode=WAL;",
+               "PRAGMA synchronous=NORMAL;",
+               "PRAGMA cache_size=-65536;",  # KiB
+               "PRAGMA temp_store=MEMORY;")
+
+    def __init__(self, dataFolder=get_current_folder(), dbSetupFolder=get_current_folder()):
+        self.setupFileLoc = dbSetupFolder + "/tableSetup.sql"
+        self.rollbacks = 0  # transactions rolled back, rows they inserted are gone
+        self.conn = self._create_connection(dataFolder)
+        self.conn.row_factory = sqlite3.Row
+        self._run_setup()
+
+    def _create_connection(self, db_path):
+        """ create db conn """
+        if not os.path.exists(db_path):
+            os.makedirs(db_path)
+        conn = sqlite3.connect(db_path + "/sqllite.db", check_same_thread=False)
+        for pragma in DatabaseConnector.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _run_setup(self):
+        """ sets up database tables """
+        legacy = self._drop_legacy_schema()
+        cursor = self.conn.cursor()
+        sql_file = open(self.setupFileLoc)
+        sql_as_string = sql_file.read()
+        cursor.executescript(sql_as_string)
+        if legacy:
+            cursor.execute("INSERT OR IGNORE INTO sync (folderIn, folderOut) SELECT folderIn, folderOut FROM sync_legacy;")
+            cursor.execute("DROP TABLE sync_legacy;")
+            self.conn.commit()
+
+    def _drop_legacy_schema(self):
+        """
+        drops the tables keyed by absolute path strings (before sync ids and the directory table).
+        Syncs are kept, their locations are rebuilt by the next full scan. Returns whether it did.
+        """
+        cursor = self.conn.cursor()
+        syncColumns = {row['name'] for row in cursor.execute("PRAGMA table_info(sync);")}
+        if not(syncColumns) or 'id' in syncColumns:
+            return False
+        cursor.executescript("""ALTER TABLE sync RENAME TO sync_legacy;
+                                DROP TABLE IF EXISTS location;
+                                DROP TABLE IF EXISTS signature;
+                                DROP TABLE IF EXISTS journal;""")
+        return True
+
+    def execute(self, query, args):
+        """Executes sql statements, and maps response to objects"""
+        cursor = self.conn.cursor()
+        cursor.execute(query, args)
+        self.conn.commit()
+        dictList = [dict(row) for row in cursor.fetchall()]
+        return dictList
+
+    def query(self, query, args):
+        """Executes a read, a transaction left open stays open"""
+        return [dict(row) for row in self.conn.execute(query, args).fetchall()]
+
+    def insert(self, query, args, commit=True):
+        """
+        Executes an insert, returns the id of the row it made (None if it was ignored).
+        Without commit it joins the open transaction, the next executeTransaction commits it.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute(query, args)
+        if commit:
+            self.conn.commit()
+        return cursor.lastrowid if cursor.rowcount > 0 else None
+
+    def executeBatch(self, query, argsList):
+        """Executes sql statements, and maps response to objects"""
+        cursor = self.conn.cursor()
+        cursor.executemany(query, argsList)
+        self.conn.commit()
+        dictList = [dict(row) for row in cursor.fetchall()]
+        return dictList
+
+    def executeTransaction(self, statementGroups):
+        """Executes (query, argsList) groups in one transaction"""
+        cursor = self.conn.cursor()
+        try:
+            for query, argsList in statementGroups:
+                cursor.executemany(query, argsList)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            self.rollbacks += 1
+            raise
+
+
+class DataStore:
+    """
+    Locations are keyed by (sync id, parent dir id, name): dirs are interned in the directory table,
+    so moving or deleting a dir is one row no matter how much is under it. Callers keep using absolute
+    folderIn paths, the dir ids they resolve to are cached.
+    """
+
+    SYNC_TB = "sync"
+    CREATE_SYNC = """INSERT OR IGNORE INTO {}
+                     (folderIn, folderOut) VALUES (?,?);""".format(SYNC_TB)
+    READ_SYNC_ID = """SELECT id FROM {}
+                      WHERE folderIn = ? AND folderOut = ?;""".format(SYNC_TB)
+    READ_SYNCS = """SELECT * FROM {};""".format(SYNC_TB)
+
+    DIR_TB = "directory"
+    CREATE_DIR = """INSERT OR IGNORE INTO {}
+                    (sync_id, parent_id, name) VALUES (?,?,?);""".format(DIR_TB)
+    READ_DIR = """SELECT id FROM {}
+                  WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(DIR_TB)
+    READ_DIR_BY_ID = """SELECT * FROM {}
+                        WHERE id = ?;""".format(DIR_TB)
+    READ_DIRS_BY_SYNC = """SELECT * FROM {}
+                           WHERE sync_id = ?;""".format(DIR_TB)
+    MOVE_DIR = """UPDATE OR REPLACE {} SET
+                  parent_id = ?, name = ? WHERE id = ?;""".format(DIR_TB)
+    REMOVE_DIRS_BY_SYNC = """DELETE FROM {}
+                             WHERE sync_id = ?;""".format(DIR_TB)
+    # ids of a dir and every dir under it, bound to (dir id, sync id)
+    DIR_SUBTREE = """WITH RECURSIVE subtree(id) AS (
+                         SELECT ?
+                         UNION ALL
+                         SELECT d.id FROM {} d JOIN subtree s ON d.sync_id = ? AND d.parent_id = s.id)
+                  """.format(DIR_TB)
+    READ_DIR_SUBTREE = DIR_SUBTREE + """SELECT id FROM subtree;"""
+    REMOVE_DIR_SUBTREE = DIR_SUBTREE + """DELETE FROM {}
+                                          WHERE id IN (SELECT id FROM subtree);""".format(DIR_TB)
+
+    LOC_TB = "location"
+    CREATE_LOC = """INSERT INTO {}
+                    (sync_id, parent_id, name, file_id, size, mtime, mode, hash)
+                    VALUES (?,?,?,?,?,?,?,?)
+                    ON CONFLICT (sync_id, parent_id, name) DO UPDATE SET
+                    file_id = excluded.file_id, size = excluded.size, mtime = excluded.mtime,
+                    mode = excluded.mode, hash = excluded.hash;""".format(LOC_TB)
+    READ_LOC_BY_PATH = """SELECT * FROM {}
+                          WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(LOC_TB)
+    READ_LOCS_BY_HASH = """SELECT * FROM {}
+                           WHERE sync_id = ? AND hash = ? AND size = ?;""".format(LOC_TB)
+    READ_HASHED_SIZE = """SELECT 1 FROM {}
+                          WHERE sync_id = ? AND size = ? AND hash IS NOT NULL LIMIT 1;""".format(LOC_TB)
+    READ_LOC = """SELECT * FROM {}
+                  WHERE sync_id = ? AND file_id = ?;""".format(LOC_TB)
+    # formatted with one placeholder per file id looked up
+    READ_LOCS_BY_FILE_IDS = """SELECT * FROM {}
+                               WHERE sync_id = ? AND file_id IN ({{}});""".format(LOC_TB)
+    UPDATE_LOC = """UPDATE OR REPLACE {} SET
+                    parent_id = ?, name = ? WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(LOC_TB)
+    REMOVE_LOC = """DELETE FROM {}
+                    WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(LOC_TB)
+    READ_LOCS_BY_SYNC = """SELECT * FROM {}
+                           WHERE sync_id = ?;""".format(LOC_TB)
+    REMOVE_LOC_SUBTREE = DIR_SUBTREE + """DELETE FROM {}
+                                          WHERE sync_id = ? AND parent_id IN (SELECT id FROM subtree);""".format(LOC_TB)
+    REMOVE_LOCS_BY_SYNC = """DELETE FROM {}
+                             WHERE sync_id = ?;""".format(LOC_TB)
+
+    SIG_TB = "signature"
+    SAVE_SIG = """INSERT OR REPLACE INTO {}
+                  (location_id, size, mtime, blockSize, digests)
+                  SELECT id, ?, ?, ?, ? FROM {}
+                  WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(SIG_TB, LOC_TB)
+    READ_SIG = """SELECT s.* FROM {} s JOIN {} l ON s.location_id = l.id
+                  WHERE l.sync_id = ? AND l.parent_id = ? AND l.name = ?;""".format(SIG_TB, LOC_TB)
+    REMOVE_SIG = """DELETE FROM {}
+                    WHERE location_id IN (SELECT id FROM {}
+                                          WHERE sync_id = ? AND parent_id = ? AND name = ?);""".format(SIG_TB, LOC_TB)
+    REMOVE_SIG_SUBTREE = DIR_SUBTREE + """DELETE FROM {}
+                                          WHERE location_id IN (SELECT id FROM {}
+                                                                WHERE sync_id = ? AND parent_id IN
+                                                                (SELECT id FROM subtree));""".format(SIG_TB, LOC_TB)
+    REMOVE_SIGS_BY_SYNC = """DELETE FROM {}
+                             WHERE location_id IN (SELECT id FROM {}
+                                                   WHERE sync_id = ?);""".format(SIG_TB, LOC_TB)
+
+    PACK_TB = "pack"
+    CREATE_PACK = """INSERT INTO {}
+                     (sync_id) VALUES (?);""".format(PACK_TB)
+    REMOVE_PACK = """DELETE FROM {}
+                     WHERE id = ?;""".format(PACK_TB)
+    REMOVE_PACKS_BY_SYNC = """DELETE FROM {}
+                              WHERE sync_id = ?;""".format(PACK_TB)
+
+    PACKED_TB = "packed"
+    READ_PACKS = """SELECT p.id, COUNT(e.pack_id) AS entries, COALESCE(SUM(e.size), 0) AS live
+                    FROM {} p LEFT JOIN {} e ON e.pack_id = p.id
+                    WHERE p.sync_id = ? GROUP BY p.id;""".format(PACK_TB, PACKED_TB)
+    SAVE_PACKED = """INSERT OR REPLACE INTO {}
+                     (sync_id, parent_id, name, pack_id, pack_offset, size, mtime, mode)
+                     VALUES (?,?,?,?,?,?,?,?);""".format(PACKED_TB)
+    READ_PACKED = """SELECT * FROM {}
+                     WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(PACKED_TB)
+    READ_PACKED_BY_SYNC = """SELECT * FROM {}
+                             WHERE sync_id = ?;""".format(PACKED_TB)
+    READ_PACKED_BY_PACK = """SELECT * FROM {}
+                             WHERE pack_id = ? ORDER BY pack_offset;""".format(PACKED_TB)
+    MOVE_PACKED = """UPDATE OR REPLACE {} SET
+                     parent_id = ?, name = ? WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(PACKED_TB)
+    RELOCATE_PACKED = """UPDATE {} SET
+                         pack_id = ?, pack_offset = ? WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(PACKED_TB)
+    REMOVE_PACKED = """DELETE FROM {}
+                       WHERE sync_id = ? AND parent_id = ? AND name = ?;""".format(PACKED_TB)
+    REMOVE_PACKED_SUBTREE = DIR_SUBTREE + """DELETE FROM {}
+                                             WHERE sync_id = ? AND parent_id IN (SELECT id FROM subtree);""".format(PACKED_TB)
+    REMOVE_PACKED_BY_SYNC = """DELETE FROM {}
+                               WHERE sync_id = ?;""".format(PACKED_TB)
+
+    JOURNAL_TB = "journal"
+    SAVE_JOURNAL = """INSERT OR REPLACE INTO {}
+                      (sync_id, seq, action, relpath, oldRelpath, done)
+                      VALUES (?,?,?,?,?,0);""".format(JOURNAL_TB)
+    COMPLETE_JOURNAL = """UPDATE {} SET done = 1
+                          WHERE sync_id = ? AND relpath = ? AND action = ?;""".format(JOURNAL_TB)
+    READ_JOURNAL = """SELECT * FROM {}
+                      WHERE sync_id = ? AND done = 0 ORDER BY seq;""".format(JOURNAL_TB)
+    CLEAR_JOURNAL = """DELETE FROM {}
+                       WHERE sync_id = ?;""".format(JOURNAL_TB)
+
+    ROOT_PARENT_ID = 0
+    FILE_ID_CHUNK = 500  # file ids per lookup, under sqlite's 999 bound parameters
+
+    def __init__(self, dbConn, maxBatchSize=50000, maxBatchAge=5):
+        self.dbConn = dbConn
+        self.maxBatchSize = maxBatchSize  # statements kept before a batch is flushed early
+        self.maxBatchAge = maxBatchAge  # seconds, so a crash loses at most this much bookkeeping
+        self._batch = None
+        self._batchStart = None
+        self._batchDepth = 0
+        self._syncIds = {}  # (folderIn, folderOut) -> sync id
+        self._dirIds = {}  # (sync id, parent id, name) -> dir id
+        self._dirEntries = {}  # dir id -> (sync id, parent id, name)
+        self._dirRelpaths = {}  # dir id -> relpath, dropped whenever a dir moves
+        self._rollbacks = dbConn.rollbacks  # the cached dirs are stale once the connection rolls back
+        self._lastDir = (None, None, None)  # (sync id, relDir, dir id) of the last lookup
+
+    # UNIT OF WORK
+
+    def begin_batch(self):
+        """ collects writes until the matching end_batch, nested batches join the outer one """
+        if not(self._batchDepth):
+            self._batch = WriteBatch()
+            self._batchStart = time.monotonic()
+        self._batchDepth += 1
+
+    def end_batch(self):
+        self._batchDepth -= 1
+        if not(self._batchDepth):
+            self.flush_batch()
+            self._batch = None
+
+    def flush_batch(self):
+        """ writes the collected statements in one transaction, with the dir rows inserted meanwhile """
+        if self._batch is not None and (self._batch or self.dbConn.conn.in_transaction):
+            batch, self._batch = self._batch, WriteBatch()
+            self._batchStart = time.monotonic()
+            self.dbConn.executeTransaction(batch.get_statement_groups())
+
+    def _write(self, query, args):
+        if self._batch is None:
+            self.dbConn.execute(query, args)
+        else:
+            self._batch.add(query, args)
+            if len(self._batch) >= self.maxBatchSize or time.monotonic() - self._batchStart >= self.maxBatchAge:
+                self.flush_batch()
+
+    def _read(self, query, args):
+        # reads see the writes collected so far, flushed only if they touch the tables read
+        if self._batch and self._batch.touches(query):
+            self.flush_batch()
+        return self.dbConn.query(query, args)
+
+    def _create_dir(self, key):
+        """ interns a dir row, inside the batch's transaction so it commits (or rolls back) with the batch """
+        dirId = self.dbConn.insert(DataStore.CREATE_DIR, key, commit=self._batch is None)
+        if dirId is None:
+            # another connection made it since it was looked up
+            dirId = self._read(DataStore.READ_DIR, key)[0]['id']
+        return dirId
+
+    # PATHS
+
+    def _sync_id(self, sync):
+        key = (sync.get_folderIn(), sync.get_folderOut())
+        syncId = self._syncIds.get(key)
+        if syncId is None:
+            records = self._read(DataStore.READ_SYNC_ID, key)
+            if not(records):
+                self.dbConn.execute(DataStore.CREATE_SYNC, key)
+                records = self._read(DataStore.READ_SYNC_ID, key)
+            syncId = self._syncIds[key] = records[0]['id']
+        return syncId
+
+    def _dir_id(self, syncId, relDir, create=False):
+        """ id of the folderIn dir at relDir, None if it holds nothing tracked (and create is False) """
+        if self._rollbacks != self.dbConn.rollbacks:
+            self._rollbacks = self.dbConn.rollbacks
+            self._forget_dirs(list(self._dirEntries))
+        lastSyncId, lastRelDir, lastDirId = self._lastDir
+        if lastSyncId == syncId and lastRelDir == relDir:
+            return lastDirId
+        if relDir:
+            parentRelDir, _, name = relDir.rpartition(os.sep)
+            parentId = self._dir_id(syncId, parentRelDir, create)
+            if parentId is None:
+                return None
+        else:
+            parentId, name = DataStore.ROOT_PARENT_ID, ''
+        key = (syncId, parentId, name)
+        dirId = self._dirIds.get(key)
+        if dirId is None:
+            records = self._read(DataStore.READ_DIR, key)
+            if records:
+                dirId = records[0]['id']
+            elif create:
+                dirId = self._create_dir(key)
+            else:
+                return None
+            self._cache_dir(dirId, syncId, parentId, name)
+        self._lastDir = (syncId, relDir, dirId)
+        return dirId
+
+    def _dir_relpath(self, dirId):
+        relpath = self._dirRelpaths.get(dirId)
+        if relpath is None:
+            if dirId not in self._dirEntries:
+                record = self._read(DataStore.READ_DIR_BY_ID, (dirId,))[0]
+                self._cache_dir(dirId, record['sync_id'], record['parent_id'], record['name'])
+            _, parentId, name = self._dirEntries[dirId]
+            if parentId == DataStore.ROOT_PARENT_ID:
+                relpath = name
+            else:
+                parentRelpath = self._dir_relpath(parentId)
+                relpath = parentRelpath + os.sep + name if parentRelpath else name
+            self._dirRelpaths[dirId] = relpath
+        return relpath
+
+    def _cache_dir(self, dirId, syncId, parentId, name):
+        self._dirIds[(syncId, parentId, name)] = dirId
+        self._dirEntries[dirId] = (syncId, parentId, name)
+
+    def _forget_dirs(self, dirIds):
+        for dirId in dirIds:
+            entry = self._dirEntries.pop(dirId, None)
+            if entry is not None and self._dirIds.get(entry) == dirId:
+                del self._dirIds[entry]
+        self._dirRelpaths.clear()
+        self._lastDir = (None, None, None)
+
+    def _locate(self, loc, create=False):
+        """ (sync id, parent dir id, name) of loc, parent dir id is None if it can't be tracked yet """
+        sync = loc.get_sync()
+        syncId = self._sync_id(sync)
+        relDir, _, name = _relative_to(sync.get_folderIn(), loc.get_folderInLocation()).rpartition(os.sep)
+        return syncId, self._dir_id(syncId, relDir, create), name
+
+    def _build_filepath(self, sync, parentId, name):
+        relDir = self._dir_relpath(parentId)
+        return os.path.join(sync.get_folderIn(), relDir, name) if relDir else os.path.join(sync.get_folderIn(), name)
+
+    def _records_to_locations(self, sync, records):
+        locations = []
+        for record in records:
+            locations.append(Location.build_from_dict(
+                sync, self._build_filepath(sync, record['parent_id'], record['name']), record))
+        return locations
+
+    # SYNC
+
+    def read_syncs(self):
+        return [Sync.build_from_dict(record) for record in self._read(DataStore.READ_SYNCS, ())]
+
+    def create_sync(self, sync):
+        """ locations of an existing sync are kept, they carry the move tracking across restarts """
+        self._sync_id(sync)
+
+    # LOCATION
+
+    def create_location(self, loc):
+        syncId, parentId, name = self._locate(loc, create=True)
+        statResult = loc.get_folderInStat()
+        args = (syncId,
+                parentId,
+                name,
+                str(loc.get_folderInId()) if loc.get_folderInId() else None,
+                statResult.st_size if statResult else None,
+                statResult.st_mtime if statResult else None,
+                statResult.st_mode if statResult else None,
+                loc.get_folderInHash())
+        self._write(DataStore.CREATE_LOC, args)
+
+    def read_location_by_path(self, loc):
+        args = self._locate(loc)
+        if args[1] is None:
+            return None
+        locations = self._records_to_locations(loc.get_sync(), self._read(DataStore.READ_LOC_BY_PATH, args))
+        return locations[0] if locations else None
+
+    def read_locations_by_hash(self, sync, fileHash, size):
+        args = (self._sync_id(sync),
+                fileHash,
+                size)
+        return self._records_to_locations(sync, self._read(DataStore.READ_LOCS_BY_HASH, args))
+
+    def has_hashed_location(self, sync, size):
+        """ whether a tracked file of size bytes has a content hash, so a new file that big may be a duplicate """
+        return bool(self._read(DataStore.READ_HASHED_SIZE, (self._sync_id(sync), size)))
+
+    def read_locations_by_sync(self, sync):
+        syncId = self._load_dirs(sync)
+        return self._records_to_locations(sync, self._read(DataStore.READ_LOCS_BY_SYNC, (syncId,)))
+
+    def read_index(self, sync):
+        """ {relpath: EntryStat} of the tracked folderIn entries, without building their absolute paths """
+        syncId = self._load_dirs(sync)
+        index = {}
+        for record in self._read(DataStore.READ_LOCS_BY_SYNC, (syncId,)):
+            entryStat = EntryStat.build_from_dict(record)
+            if entryStat is not None:
+                relDir = self._dir_relpath(record['parent_id'])
+                index[relDir + os.sep + record['name'] if relDir else record['name']] = entryStat
+        return index
+
+    def _load_dirs(self, sync):
+        """ caches every dir of sync, returns the sync id """
+        syncId = self._sync_id(sync)
+        for record in self._read(DataStore.READ_DIRS_BY_SYNC, (syncId,)):
+            self._cache_dir(record['id'], syncId, record['parent_id'], record['name'])
+        return syncId
+
+    def read_location(self, sync, folderId):
+        args = (self._sync_id(sync),
+                str(folderId))
+        locations = self._records_to_locations(sync, self._read(DataStore.READ_LOC, args))
+        return locations[0] if locations else None
+
+    def read_locations_by_file_id(self, sync, folderIds):
+        """ {str(file id): Location} of the folderIds tracked in sync, looked up FILE_ID_CHUNK at a time """
+        syncId = self._sync_id(sync)
+        folderIds = list(dict.fromkeys(str(folderId) for folderId in folderIds))
+        locations = {}
+        for start in range(0, len(folderIds), DataStore.FILE_ID_CHUNK):
+            chunk = folderIds[start:start + DataStore.FILE_ID_CHUNK]
+            query = DataStore.READ_LOCS_BY_FILE_IDS.format(','.join('?' * len(chunk)))
+            for record in self._read(query, (syncId,) + tuple(chunk)):
+                # a hard linked file id may be tracked at several paths, read_location returns any of them
+                if record['file_id'] not in locations:
+                    locations[record['file_id']] = self._records_to_locations(sync, [record])[0]
+        return locations
+
+    def update_location(self, oldLoc, newloc):
+        oldArgs = self._locate(oldLoc)
+        if oldArgs[1] is None:
+            return
+        newArgs = self._locate(newloc, create=True)
+        # a location already at the new path is replaced, its signatures and packed copy go with it
+        self._write(DataStore.REMOVE_SIG, newArgs)
+        self._write(DataStore.REMOVE_PACKED, newArgs)
+        self._write(DataStore.UPDATE_LOC, newArgs[1:] + oldArgs)
+        self._write(DataStore.MOVE_PACKED, newArgs[1:] + oldArgs)
+
+    def move_location_subtree(self, oldLoc, newLoc):
+        """ re-roots every location under oldLoc (not oldLoc itself) to newLoc, one dir row update """
+        syncId, oldParentId, oldName = self._locate(oldLoc)
+        dirId = self._dirIds.get((syncId, oldParentId, oldName)) if oldParentId is not None else None
+        if dirId is None and oldParentId is not None:
+            records = self._read(DataStore.READ_DIR, (syncId, oldParentId, oldName))
+            dirId = records[0]['id'] if records else None
+        if dirId is None:
+            # nothing tracked under oldLoc
+            return
+        _, newParentId, newName = self._locate(newLoc, create=True)
+        if self._dir_id(syncId, _relative_to(newLoc.get_sync().get_folderIn(), newLoc.get_folderInLocation())):
+            # replaced below, drop whatever was tracked under the new path first
+            self.remove_location_subtree(newLoc)
+        self._write(DataStore.MOVE_DIR, (newParentId, newName, dirId))
+        self._forget_dirs((dirId,))
+        self._cache_dir(dirId, syncId, newParentId, newName)
+
+    def remove_location(self, loc):
+        args = self._locate(loc)
+        if args[1] is None:
+            return
+        self._write(DataStore.REMOVE_SIG, args)
+        self._write(DataStore.REMOVE_PACKED, args)
+        self._write(DataStore.REMOVE_LOC, args)
+
+    def remove_location_subtree(self, loc):
+        """ removes every location under loc (not loc itself) """
+        syncId = self._sync_id(loc.get_sync())
+        dirId = self._dir_id(syncId, _relative_to(loc.get_sync().get_folderIn(), loc.get_folderInLocation()))
+        if dirId is None:
+            return
+        subtreeArgs = (dirId, syncId)
+        self._forget_dirs(record['id'] for record in self._read(DataStore.READ_DIR_SUBTREE, subtreeArgs))
+        self._write(DataStore.REMOVE_SIG_SUBTREE, subtreeArgs + (syncId,))
+        self._write(DataStore.REMOVE_PACKED_SUBTREE, subtreeArgs + (syncId,))
+        self._write(DataStore.REMOVE_LOC_SUBTREE, subtreeArgs + (syncId,))
+        self._write(DataStore.REMOVE_DIR_SUBTREE, subtreeArgs)
+
+    # SIGNATURE
+
+    def save_signatures(self, loc, outStat, blockSize, signatures):
+        """ caches the block signatures of the folderOut copy of loc, valid while its size/mtime hold """
+        locArgs = self._locate(loc)
+        if locArgs[1] is None:
+            return
+        args = (outStat.st_size,
+                outStat.st_mtime,
+                blockSize,
+                signatures) + locArgs
+        self._write(DataStore.SAVE_SIG, args)
+
+    def read_signatures(self, loc, outStat, blockSize):
+        """ cached block signatures of the folderOut copy of loc, None if missing or stale """
+        args = self._locate(loc)
+        if args[1] is None:
+            return None
+        records = self._read(DataStore.READ_SIG, args)
+        if not(records):
+            return None
+        record = records[0]
+        if (record['size'], record['mtime'], record['blockSize']) != (outStat.st_size, outStat.st_mtime, blockSize):
+            return None
+        return record['digests']
+
+    def remove_locs_by_sync(self, sync):
+        args = (self._sync_id(sync),)
+        self._write(DataStore.REMOVE_SIGS_BY_SYNC, args)
+        self._write(DataStore.REMOVE_PACKED_BY_SYNC, args)
+        self._write(DataStore.REMOVE_PACKS_BY_SYNC, args)
+        self._write(DataStore.REMOVE_LOCS_BY_SYNC, args)
+        self._write(DataStore.REMOVE_DIRS_BY_SYNC, args)
+        self._forget_dirs([dirId for dirId, entry in self._dirEntries.items() if entry[0] == args[0]])
+
+    # PACK
+
+    def create_pack(self, sync):
+        """ id of a new pack file of sync """
+        return self.dbConn.insert(DataStore.CREATE_PACK, (self._sync_id(sync),))
+
+    def read_packs(self, sync):
+        """ [{'id', 'entries', 'live' (bytes still referenced)}] of the packs of sync """
+        return [dict(record) for record in self._read(DataStore.READ_PACKS, (self._sync_id(sync),))]
+
+    def remove_pack(self, packId):
+        self._write(DataStore.REMOVE_PACK, (packId,))
+
+    def save_packed(self, loc, packId, offset, size, statResult):
+        """ the folderOut copy of loc is size bytes at offset of pack packId, with the mtime/mode of statResult """
+        locArgs = self._locate(loc, create=True)
+        args = locArgs + (packId,
+                          offset,
+                          size,
+                          statResult.st_mtime,
+                          statResult.st_mode)
+        self._write(DataStore.SAVE_PACKED, args)
+
+    def read_packed(self, loc):
+        """ (pack id, offset, size) of the packed folderOut copy of loc, None if it is not packed """
+        args = self._locate(loc)
+        if args[1] is None:
+            return None
+        records = self._read(DataStore.READ_PACKED, args)
+        if not(records):
+            return None
+        return records[0]['pack_id'], records[0]['pack_offset'], records[0]['size']
+
+    def read_packed_index(self, sync):
+        """ {relpath: (pack id, offset, EntryStat)} of the packed folderOut copies of sync """
+        syncId = self._load_dirs(sync)
+        index = {}
+        for record in self._read(DataStore.READ_PACKED_BY_SYNC, (syncId,)):
+            relDir = self._dir_relpath(record['parent_id'])
+            relpath = relDir + os.sep + record['name'] if relDir else record['name']
+            index[relpath] = (record['pack_id'], record['pack_offset'],
+                              EntryStat(record['mode'], record['size'], record['mtime']))
+        return index
+
+    def read_packed_by_pack(self, packId):
+        """ records of the entries still stored in pack packId, in pack order """
+        return [dict(record) for record in self._read(DataStore.READ_PACKED_BY_PACK, (packId,))]
+
+    def relocate_packed(self, record, packId, offset):
+        """ points a read_packed_by_pack record to its copy at offset of pack packId """
+        args = (packId,
+                offset,
+                record['sync_id'],
+                record['parent_id'],
+                record['name'])
+        self._write(DataStore.RELOCATE_PACKED, args)
+
+    def remove_packed(self, loc):
+        args = self._locate(loc)
+        if args[1] is None:
+            return
+        self._write(DataStore.REMOVE_PACKED, args)
+
+    # JOURNAL
+
+    def save_journal(self, sync, plan):
+        """ records the operations of plan as planned and commits them right away, returns how many """
+        syncId = self._sync_id(sync)
+        saved = 0
+        for seq, operation in enumerate(plan):
+            if operation.get_action() == SyncOperation.TRACK:
+                continue
+            args = (syncId,
+                    seq,
+                    operation.get_action(),
+                    operation.get_relpath(),
+                    operation.get_oldRelpath())
+            self._write(DataStore.SAVE_JOURNAL, args)
+            saved += 1
+        if saved:
+            self.flush_batch()
+        return saved
+
+    def complete_journal_entry(self, sync, operation):
+        args = (self._sync_id(sync),
+                operation.get_relpath(),
+                operation.get_action())
+        self._write(DataStore.COMPLETE_JOURNAL, args)
+
+    def read_journal(self, sync):
+        """ SyncOperations (no stats) planned but not completed, in plan order """
+        return [SyncOperation(record['action'], record['relpath'], oldRelpath=record['oldRelpath'])
+                for record in self._read(DataStore.READ_JOURNAL, (self._sync_id(sync),))]
+
+    def clear_journal(self, sync):
+        self._write(DataStore.CLEAR_JOURNAL, (self._sync_id(sync),))
+
+
+class DataStoreWriter:
+    """ runs every DataStore call on one dedicated thread, so worker threads never share the sqlite connection """
+
+    def __init__(self, dataStore, writer=None):
+        self._dataStore = dataStore
+        self._writer = writer if writer else ThreadPoolExecutor(max_workers=1, thread_name_prefix='pyFolderSync-db')
+
+    def for_store(self, dataStore):
+        """ a DataStoreWriter of dataStore on this writer's thread """
+        return DataStoreWriter(dataStore, self._writer)
+
+    def __getattr__(self, name):
+        attr = getattr(self._dataStore, name)
+        if not(callable(attr)):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._writer.submit(attr, *args, **kwargs).result()
+        return call
+
+
+class PlanExecutor:
+    """
+    Runs the operations of a SyncPlan on a bounded thread pool.
+    Operations on overlapping paths (same path, ancestors, descendants) keep their plan order,
+    so parent dirs are made before their children and moves happen before deletes of the same subtree.
+    Several plans may execute at once (see SyncSupervisor): workers and maxInFlightBytes (the size of
+    the file copies running at once) are budgets shared by all of them.
+    """
+
+    def __init__(self, workers=4, maxInFlightBytes=256 * 1024 * 1024):
+        self.workers = workers
+        self.maxInFlightBytes = maxInFlightBytes
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pyFolderSync')
+        self._budget = threading.Condition()
+        self._inFlightOps = 0
+        self._inFlightBytes = 0
+
+    def execute(self, plan, runOperation, stopEvent=None):
+        """
+        runOperation(operation) -> success, returns the number that failed.
+        Once stopEvent is set no more operations are started, the ones left count as failed.
+        """
+        failures = 0
+        inFlight = {}  # future -> paths, of this plan
+        for index, operation in enumerate(plan):
+            if stopEvent and stopEvent.is_set():
+                failures += len(plan) - index
+                break
+            paths = _operation_paths(operation)
+            while inFlight and _overlaps_in_flight(paths, inFlight):
+                failures += self._wait_for_one(inFlight)
+            size = self._operation_bytes(operation)
+            self._acquire(size)
+            future = self._pool.submit(runOperation, operation)
+            future.add_done_callback(lambda _, size=size: self._release(size))
+            inFlight[future] = paths
+        while inFlight:
+            failures += self._wait_for_one(inFlight)
+        return failures
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def _acquire(self, size):
+        """ waits for a worker and room for size bytes (an oversized copy runs alone) """
+        with self._budget:
+            while self._inFlightOps and (self._inFlightOps >= self.workers or
+                                         self._inFlightBytes + size > self.maxInFlightBytes):
+                self._budget.wait()
+            self._inFlightOps += 1
+            self._inFlightBytes += size
+
+    def _release(self, size):
+        with self._budget:
+            self._inFlightOps -= 1
+            self._inFlightBytes -= size
+            self._budget.notify_all()
+
+    def _wait_for_one(self, inFlight):
+        failures = 0
+        done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+        for future in done:
+            del inFlight[future]
+            if not(future.result()):
+                failures += 1
+        return failures
+
+    def _operation_bytes(self, operation):
+        inStat = operation.get_inStat()
+        if operation.get_action() in (SyncOperation.CREATE, SyncOperation.UPDATE) and inStat is not None:
+            return 0 if stat.S_ISDIR(inStat.st_mode) else inStat.st_size
+        return 0
+
+
+class ParallelScanner:
+    """
+    scan_tree on a thread pool, for wide trees and slow (network) mounts. Every dir is listed as its own
+    task once its parent has been, so the tree is sharded dir by dir and an idle worker takes whatever is
+    queued next: a huge or slow dir only holds up the worker listing it while its siblings and their
+    subtrees carry on. The listings are merged back into the pre-order of scan_tree.
+    Several scans (both sides of a sync, several syncs) may share one scanner.
+    """
+
+    def __init__(self, workers=8, readAhead=None):
+        self.workers = workers
+        # listings one scan keeps queued or unmerged at once, bounds its memory on huge trees
+        self.readAhead = readAhead if readAhead else workers * 4
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pyFolderSync-list')
+
+    def scan(self, rootDir, relDir='', syncFilter=None):
+        """ the (relpath, stat) stream of scan_tree(rootDir, relDir, syncFilter), listing starts right away """
+        root = self._pool.submit(self._list, rootDir, relDir, syncFilter, None)
+        return self._merge(rootDir, syncFilter, root)
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+    def _list(self, rootDir, relDir, syncFilter, parentMatcher):
+        """ ([(relpath, stat, isDir)], matcher) of one dir """
+        listing = _list_dir(rootDir, relDir)
+        if syncFilter:
+            return syncFilter.filter_listing(rootDir, relDir, listing, parentMatcher)
+        return listing, None
+
+    def _merge(self, rootDir, syncFilter, root):
+        listings = {}  # relDir -> future listing, queued or not merged yet
+        pending = deque()  # (relDir, parent matcher) of the dirs found but not queued, in merge order
+
+        def read_ahead():
+            while pending and len(listings) < self.readAhead:
+                relDir, matcher = pending.popleft()
+                listings[relDir] = self._pool.submit(self._list, rootDir, relDir, syncFilter, matcher)
+
+        def take(future):
+            listing, matcher = future.result()
+            # merged before the dirs already pending, so they go first
+            pending.extendleft(reversed([(relpath, matcher) for relpath, _, isDir in listing if isDir]))
+            read_ahead()
+            return iter(listing)
+
+        stack = [take(root)]
+        try:
+            while stack:
+                item = next(stack[-1], None)
+                if item is None:
+                    stack.pop()
+                    continue
+                relpath, statResult, isDir = item
+                yield relpath, statResult
+                if isDir:
+                    while relpath not in listings:
+                        # found while the read-ahead was full, it is next in line
+                        relDir, matcher = pending.popleft()
+                        listings[relDir] = self._pool.submit(self._list, rootDir, relDir, syncFilter, matcher)
+                    stack.append(take(listings.pop(relpath)))
+        finally:
+            # an abandoned scan drops the listings not started yet
+            for future in listings.values():
+                future.cancel()
+
+
+class PackStore:
+    """
+    Small folderOut files kept in append-only pack files (folderOut/PACK_DIRNAME/<id>.pack) instead of
+    one file each, indexed in the DataStore under the same keys as their locations (so they move and
+    are deleted with them). Appends are buffered into large sequential writes, reads are an offset
+    lookup into an mmap of the pack. Replaced and deleted copies stay in their pack until compact()
+    rewrites the packs that are mostly garbage.
+    """
+
+    PACK_DIRNAME = '.pyfoldersync-packs'
+
+    def __init__(self, sync, dataStore, maxPackSize=256 * 1024 * 1024, bufferSize=8 * 1024 * 1024):
+        self.sync = sync
+        self.dataStore = dataStore
+        self.maxPackSize = maxPackSize
+        self.bufferSize = bufferSize
+        self.packDir = os.path.join(sync.get_folderOut(), PackStore.PACK_DIRNAME)
+        self._lock = threading.Lock()
+        self._packId = None  # pack appended to, a new one per run
+        self._packSize = 0
+        self._ofp = None
+        self._maps = {}  # pack id -> mmap
+
+    def put(self, relpath, inFilepath, inStat):
+        """ stores a copy of inFilepath as the folderOut file at relpath """
+        with open(inFilepath, 'rb') as ifp:
+            data = ifp.read()
+        with self._lock:
+            packId, offset = self._append(data)
+        self.dataStore.save_packed(self._location(relpath), packId, offset, len(data), inStat)
+
+    def read(self, relpath):
+        """ bytes of the packed folderOut file at relpath, None if it is not packed """
+        packed = self.dataStore.read_packed(self._location(relpath))
+        if packed is None:
+            return None
+        packId, offset, size = packed
+        if not(size):
+            return b''
+        with self._lock:
+            if packId == self._packId:
+                self._ofp.flush()
+            return self._map(packId, offset + size)[offset:offset + size]
+
+    def is_packed(self, relpath):
+        return self.dataStore.read_packed(self._location(relpath)) is not None
+
+    def remove(self, relpath):
+        """ drops the packed copy at relpath, its bytes are reclaimed by compact() """
+        self.dataStore.remove_packed(self._location(relpath))
+
+    def read_snapshot(self):
+        """ {relpath: stat} of the packed files whose bytes made it to their pack """
+        packSizes = {}
+        snapshot = {}
+        self.flush()
+        for relpath, (packId, offset, entryStat) in self.dataStore.read_packed_index(self.sync).items():
+            if packId not in packSizes:
+                try:
+                    packSizes[packId] = os.path.getsize(self._get_pack_filepath(packId))
+                except OSError:
+                    packSizes[packId] = -1
+            # indexed, but the append was lost (crash before the pack was flushed)
+            if not(entryStat.st_size) or offset + entryStat.st_size <= packSizes[packId]:
+                snapshot[relpath] = entryStat
+        return snapshot
+
+    def get_pack_relpaths(self):
+        """ relpaths of the pack dir and its files, as scans of folderOut see them """
+        try:
+            names = os.listdir(self.packDir)
+        except OSError:
+            return []
+        return [PackStore.PACK_DIRNAME] + [os.path.join(PackStore.PACK_DIRNAME, name) for name in names]
+
+    def flush(self):
+        with self._lock:
+            if self._ofp is not None:
+                self._ofp.flush()
+
+    def close(self):
+        with self._lock:
+            if self._ofp is not None:
+                self._ofp.close()
+                self._ofp = None
+                self._packId = None
+            for packMap in self._maps.values():
+                packMap.close()
+            self._maps.clear()
+
+    def compact(self, maxGarbage=0.5):
+        """ rewrites the packs where more than maxGarbage of the bytes is garbage, returns bytes reclaimed """
+        reclaimed = 0
+        self.flush()
+        for pack in self.dataStore.read_packs(self.sync):
+            packId = pack['id']
+            if packId == self._packId:
+                continue
+            packFilepath = self._get_pack_filepath(packId)
+            try:
+                packSize = os.path.getsize(packFilepath)
+            except OSError:
+                packSize = 0
+            # (a pack missing bytes is left alone, the next full scan copies its entries again)
+            if pack['entries'] and packSize - pack['live'] <= maxGarbage * packSize:
+                continue
+            # live entries are appended to the current pack, then the old one goes
+            with self._lock:
+                for record in self.dataStore.read_packed_by_pack(packId):
+                    start = record['pack_offset']
+                    end = start + record['size']
+                    data = self._map(packId, end)[start:end] if end > start else b''
+                    newPackId, offset = self._append(data)
+                    self.dataStore.relocate_packed(record, newPackId, offset)
+                if self._ofp is not None:
+                    self._ofp.flush()
+                    os.fsync(self._ofp.fileno())
+                packMap = self._maps.pop(packId, None)
+                if packMap is not None:
+                    packMap.close()
+            self.dataStore.flush_batch()
+            self.dataStore.remove_pack(packId)
+            if os.path.exists(packFilepath):
+                os.remove(packFilepath)
+            reclaimed += packSize - pack['live']
+        return reclaimed
+
+    def _append(self, data):
+        """ (pack id, offset) data was appended at, call with the lock held """
+        if self._ofp is None or (self._packSize and self._packSize + len(data) > self.maxPackSize):
+            if self._ofp is not None:
+                self._ofp.close()
+            self._packId = self.dataStore.create_pack(self.sync)
+            os.makedirs(self.packDir, exist_ok=True)
+            self._ofp = open(self._get_pack_filepath(self._packId), 'ab', buffering=self.bufferSize)
+            self._packSize = 0
+        offset = self._packSize
+        self._ofp.write(data)
+        self._packSize += len(data)
+        return self._packId, offset
+
+    def _map(self, packId, end):
+        """ mmap of a pack covering at least its first end bytes, call with the lock held """
+        packMap = self._maps.get(packId)
+        if packMap is None or len(packMap) < end:
+            if packMap is not None:
+                packMap.close()
+            with open(self._get_pack_filepath(packId), 'rb') as ifp:
+                packMap = self._maps[packId] = mmap.mmap(ifp.fileno(), 0, access=mmap.ACCESS_READ)
+        return packMap
+
+    def _get_pack_filepath(self, packId):
+        return os.path.join(self.packDir, '{}.pack'.format(packId))
+
+    def _location(self, relpath):
+        return Location(self.sync, os.path.join(self.sync.get_folderIn(), relpath))
+
+
+# Storage
+# ================================================================
+
+class StorageBackend:
+    """
+    Where FolderSync writes folderOut, addressed by relpath ('' is the root).
+    Stats are stat-like (st_mode, st_size, st_mtime), deleting or moving a dir takes its subtree along.
+    """
+
+    def exists(self, relpath=''):
+        return self.stat(relpath) is not None
+
+    def stat(self, relpath):
+        """ stat of relpath, None if it does not exist """
+        raise NotImplementedError
+
+    def list(self):
+        """ (relpath, stat) of every entry, parents before their children """
+        raise NotImplementedError
+
+    def make_dirs(self, relpath):
+        """ makes the dir relpath and its missing parents """
+        raise NotImplementedError
+
+    def put(self, relpath, inFilepath):
+        """ writes a copy of inFilepath (data, mtime and mode) at relpath, returns the mechanism used """
+        raise NotImplementedError
+
+    def set_stat(self, relpath, inFilepath):
+        """ copies the mtime and mode of inFilepath onto relpath """
+        raise NotImplementedError
+
+    def move(self, oldRelpath, relpath):
+        """ moves oldRelpath (and its subtree) to relpath, nothing to do when they are the same """
+        raise NotImplementedError
+
+    def copy(self, srcRelpath, relpath):
+        raise NotImplementedError
+
+    def delete(self, relpaths):
+        raise NotImplementedError
+
+    def is_copied(self, relpath, inFilepath):
+        """ whether relpath is a finished copy of inFilepath (copies get their stat once complete) """
+        outStat = self.stat(relpath)
+        if outStat is None:
+            return False
+        inStat = os.stat(inFilepath)
+        return (stat.S_ISREG(outStat.st_mode) and outStat.st_size == inStat.st_size and
+                outStat.st_mtime == inStat.st_mtime)
+
+    def close(self):
+        pass
+
+
+class LocalStorageBackend(StorageBackend):
+    """ folderOut is a local dir, written through a FileCopier (deletes paced by a RateLimiter) """
+
+    def __init__(self, rootDir, fileCopier=None, rateLimiter=None):
+        self.rootDir = rootDir
+        self.fileCopier = fileCopier if fileCopier else KernelFileCopier()
+        self.rateLimiter = rateLimiter
+
+    def stat(self, relpath):
+        filepath = self._get_filepath(relpath)
+        try:
+            return os.stat(filepath)
+        except FileNotFoundError:
+            # broken link
+            return os.lstat(filepath) if os.path.lexists(filepath) else None
+
+    def list(self):
+        return scan_tree(self.rootDir)
+
+    def make_dirs(self, relpath):
+        os.makedirs(self._get_filepath(relpath), exist_ok=True)
+
+    def put(self, relpath, inFilepath):
+        # written next to the file and renamed over it, so folderOut never holds a partial copy
+        outFilepath = self._get_filepath(relpath)
+        tmpFilepath = _get_temp_filepath(outFilepath)
+        backend = self.fileCopier.copy(inFilepath, tmpFilepath)
+        os.replace(tmpFilepath, outFilepath)
+        return backend
+
+    def set_stat(self, relpath, inFilepath):
+        shutil.copystat(inFilepath, self._get_filepath(relpath))
+
+    def move(self, oldRelpath, relpath):
+        if oldRelpath != relpath:
+            shutil.move(self._get_filepath(oldRelpath), self._get_filepath(relpath))
+
+    def copy(self, srcRelpath, relpath):
+        srcFilepath = self._get_filepath(srcRelpath)
+        if os.path.isdir(srcFilepath):
+            shutil.copytree(srcFilepath, self._get_filepath(relpath), symlinks=True)
+        else:
+            shutil.copy2(srcFilepath, self._get_filepath(relpath), follow_symlinks=False)
+
+    def delete(self, relpaths):
+        for relpath in relpaths:
+            filepath = self._get_filepath(relpath)
+            if os.path.isdir(filepath) and not(os.path.islink(filepath)):
+                self._remove_tree(filepath)
+            else:
+                os.remove(filepath)
+
+    def _remove_tree(self, filepath):
+        """ shutil.rmtree, one entry at a time when deletes are rate limited """
+        if not(self.rateLimiter):
+            shutil.rmtree(filepath)
+            return
+        for dirpath, dirnames, filenames in os.walk(filepath, topdown=False):
+            for name in filenames:
+                self.rateLimiter.acquire_op()
+                os.remove(os.path.join(dirpath, name))
+            for name in dirnames:
+                self.rateLimiter.acquire_op()
+                childPath = os.path.join(dirpath, name)
+                if os.path.islink(childPath):
+                    os.remove(childPath)
+                else:
+                    os.rmdir(childPath)
+        self.rateLimiter.acquire_op()
+        os.rmdir(filepath)
+
+    def _get_filepath(self, relpath):
+        return os.path.join(self.rootDir, relpath) if relpath else self.rootDir
+
+
+class MemoryObjectStore:
+    """
+    In-process stand-in for an S3-like bucket: flat keys, objects with user metadata, multipart uploads,
+    server-side copies, batched deletes and paginated listings. connect() hands out a client (the store
+    itself) and requests are counted per call, so tests can check the round trips a sync makes.
+    """
+
+    MAX_KEYS = 1000  # per listing page and per batched delete
+    MIN_PART_SIZE = 5 * 1024 * 1024  # every part of a multipart upload but the last
+
+    def __init__(self, minPartSize=MIN_PART_SIZE):
+        self.minPartSize = minPartSize
+        self.connections = 0
+        self.requests = Counter()
+        self._objects = {}  # key -> (data, metadata)
+        self._uploads = {}  # upload id -> (key, metadata, {part number: data})
+        self._uploadCount = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        with self._lock:
+            self.connections += 1
+        return self
+
+    def head_object(self, key):
+        """ (size, metadata) of key, None if there is no such object """
+        with self._lock:
+            self.requests['head_object'] += 1
+            obj = self._objects.get(key)
+        return (len(obj[0]), dict(obj[1])) if obj else None
+
+    def get_object(self, key):
+        with self._lock:
+            self.requests['get_object'] += 1
+            return self._objects[key][0]
+
+    def put_object(self, key, data, metadata=None):
+        with self._lock:
+            self.requests['put_object'] += 1
+            self._objects[key] = (bytes(data), dict(metadata) if metadata else {})
+
+    def create_multipart_upload(self, key, metadata=None):
+        with self._lock:
+            self.requests['create_multipart_upload'] += 1
+            self._uploadCount += 1
+            uploadId = str(self._uploadCount)
+            self._uploads[uploadId] = (key, dict(metadata) if metadata else {}, {})
+        return uploadId
+
+    def upload_part(self, uploadId, partNumber, data):
+        with self._lock:
+            self.requests['upload_part'] += 1
+            self._uploads[uploadId][2][partNumber] = bytes(data)
+        return hashlib.md5(data).hexdigest()
+
+    def complete_multipart_upload(self, uploadId, partNumbers):
+        with self._lock:
+            self.requests['complete_multipart_upload'] += 1
+            key, metadata, parts = self._uploads.pop(uploadId)
+            partNumbers = sorted(partNumbers)
+            if any(len(parts[partNumber]) < self.minPartSize for partNumber in partNumbers[:-1]):
+                raise ValueError('multipart upload of {} has a part under {} bytes'.format(key, self.minPartSize))
+            self._objects[key] = (b''.join(parts[partNumber] for partNumber in partNumbers), metadata)
+
+    def abort_multipart_upload(self, uploadId):
+        with self._lock:
+            self.requests['abort_multipart_upload'] += 1
+            self._uploads.pop(uploadId, None)
+
+    def copy_object(self, srcKey, key, metadata=None):
+        """ server-side copy, metadata replaces the source's when given (also to update it in place) """
+        with self._lock:
+            self.requests['copy_object'] += 1
+            data, srcMetadata = self._objects[srcKey]
+            self._objects[key] = (data, dict(metadata) if metadata is not None else srcMetadata)
+
+    def delete_objects(self, keys):
+        if len(keys) > MemoryObjectStore.MAX_KEYS:
+            raise ValueError('at most {} keys per delete'.format(MemoryObjectStore.MAX_KEYS))
+        with self._lock:
+            self.requests['delete_objects'] += 1
+            for key in keys:
+                self._objects.pop(key, None)
+
+    def list_objects(self, prefix='', startAfter=None, maxKeys=MAX_KEYS):
+        """ [(key, size, metadata)] of one page of keys under prefix in order, and whether more follow """
+        with self._lock:
+            self.requests['list_objects'] += 1
+            keys = sorted(key for key in self._objects if key.startswith(prefix) and
+                          (startAfter is None or key > startAfter))
+            page = [(key, len(self._objects[key][0]), dict(self._objects[key][1])) for key in keys[:maxKeys]]
+        return page, len(keys) > maxKeys
+
+
+class ObjectStorageBackend(StorageBackend):
+    """
+    folderOut in an S3-like object store (see MemoryObjectStore for the client calls used), under keyPrefix.
+    Dirs are empty marker objects (key + '/'), stats are kept in object metadata. Requests run on pooled
+    connections (at most poolSize, made by connect()), files of multipartThreshold bytes and up are uploaded
+    in partSize parts, uploadWorkers at a time. The bucket is listed once (and again on list()) into a cached
+    listing that writes keep up to date, so stats and subtree moves/deletes cost no round trips. The listing
+    keeps the children of each dir, so a subtree is found without going through the whole bucket.
+    """
+
+    PUT = 'put'
+    MULTIPART = 'multipart'
+    DIR_MODE = stat.S_IFDIR | 0o755  # of dirs only implied by the keys under them
+
+    def __init__(self, connect, keyPrefix='', poolSize=8, uploadWorkers=4, partSize=8 * 1024 * 1024,
+                 multipartThreshold=16 * 1024 * 1024):
+        self.connect = connect
+        self.keyPrefix = keyPrefix.rstrip('/') + '/' if keyPrefix else ''
+        self.partSize = partSize
+        self.multipartThreshold = multipartThreshold
+        self.uploadWorkers = uploadWorkers
+        self._poolSlots = threading.BoundedSemaphore(poolSize)
+        self._idle = []  # connections not in use
+        self._lock = threading.Lock()
+        self._listing = None  # {relpath: EntryStat} once listed
+        self._children = None  # {dir relpath: {child relpaths}} of the listing
+        self._uploads = ThreadPoolExecutor(max_workers=uploadWorkers, thread_name_prefix='pyFolderSync-upload')
+
+    def stat(self, relpath):
+        if not(relpath):
+            return EntryStat(ObjectStorageBackend.DIR_MODE, 0, 0)
+        return self._get_listing().get(relpath)
+
+    def list(self):
+        """ re-lists the bucket (it may have been changed by others), refreshing the cached listing """
+        listing = {}
+        children = {}
+        startAfter = None
+        while True:
+            page, truncated = self._request('list_objects', self.keyPrefix, startAfter)
+            for key, size, metadata in page:
+                relpath = self._get_relpath(key)
+                if relpath:
+                    self._add_entry(listing, children, relpath, self._build_stat(key, size, metadata))
+            if not(truncated):
+                break
+            startAfter = page[-1][0]
+        with self._lock:
+            self._listing = listing
+            self._children = children
+        return sorted(listing.items(), key=lambda item: _relpath_sort_key(item[0]))
+
+    def make_dirs(self, relpath):
+        listing = self._get_listing()
+        missing = []
+        while relpath and relpath not in listing:
+            missing.append(relpath)
+            relpath = os.path.dirname(relpath)
+        for dirRelpath in reversed(missing):
+            metadata = self._build_metadata(ObjectStorageBackend.DIR_MODE, time.time())
+            self._request('put_object', self._get_key(dirRelpath, True), b'', metadata)
+            self._cache(dirRelpath, EntryStat(ObjectStorageBackend.DIR_MODE, 0, float(metadata['mtime'])))
+
+    def put(self, relpath, inFilepath):
+        key = self._get_key(relpath)
+        with open(inFilepath, 'rb') as ifp:
+            inStat = os.fstat(ifp.fileno())
+            metadata = self._build_metadata(inStat.st_mode, inStat.st_mtime)
+            if inStat.st_size < self.multipartThreshold:
+                self._request('put_object', key, ifp.read(), metadata)
+                backend = ObjectStorageBackend.PUT
+            else:
+                self._put_multipart(key, ifp, metadata)
+                backend = ObjectStorageBackend.MULTIPART
+        self._cache(relpath, EntryStat(inStat.st_mode, inStat.st_size, inStat.st_mtime))
+        return backend
+
+    def set_stat(self, relpath, inFilepath):
+        inStat = os.stat(inFilepath)
+        outStat = self.stat(relpath)
+        key = self._get_key(relpath, stat.S_ISDIR(outStat.st_mode))
+        metadata = self._build_metadata(inStat.st_mode, inStat.st_mtime)
+        if stat.S_ISDIR(outStat.st_mode):
+            # implied dirs get a marker
+            self._request('put_object', key, b'', metadata)
+        else:
+            self._request('copy_object', key, key, metadata)
+        self._cache(relpath, EntryStat(inStat.st_mode, outStat.st_size, inStat.st_mtime))
+
+    def move(self, oldRelpath, relpath):
+        if oldRelpath == relpath:
+            # the delete would remove the object just copied onto itself
+            return
+        # no rename in object stores, a server-side copy then a delete of each object
+        self.copy(oldRelpath, relpath)
+        self.delete([oldRelpath])
+
+    def copy(self, srcRelpath, relpath):
+        listing = self._get_listing()
+        self.make_dirs(os.path.dirname(relpath))
+        for srcChildRelpath, srcStat in self._get_subtree(srcRelpath):
+            childRelpath = relpath + srcChildRelpath[len(srcRelpath):]
+            isDir = stat.S_ISDIR(srcStat.st_mode)
+            metadata = self._build_metadata(srcStat.st_mode, srcStat.st_mtime)
+            if isDir:
+                self._request('put_object', self._get_key(childRelpath, True), b'', metadata)
+            else:
+                self._request('copy_object', self._get_key(srcChildRelpath), self._get_key(childRelpath))
+            self._cache(childRelpath, listing[srcChildRelpath])
+
+    def delete(self, relpaths):
+        """ deletes the objects of relpaths and their subtrees, MAX_KEYS per request """
+        keys = []
+        removed = []
+        for relpath in relpaths:
+            for childRelpath, childStat in self._get_subtree(relpath):
+                keys.append(self._get_key(childRelpath, stat.S_ISDIR(childStat.st_mode)))
+                removed.append(childRelpath)
+        for start in range(0, len(keys), MemoryObjectStore.MAX_KEYS):
+            self._request('delete_objects', keys[start:start + MemoryObjectStore.MAX_KEYS])
+        with self._lock:
+            for relpath in removed:
+                if self._listing.pop(relpath, None) is None:
+                    continue
+                self._children.pop(relpath, None)
+                siblings = self._children.get(os.path.dirname(relpath))
+                if siblings is not None:
+                    siblings.discard(relpath)
+
+    def close(self):
+        self._uploads.shutdown()
+
+    def _put_multipart(self, key, ifp, metadata):
+        uploadId = self._request('create_multipart_upload', key, metadata)
+        try:
+            partNumbers = []
+            pending = set()
+            while True:
+                data = ifp.read(self.partSize)
+                if not(data) and partNumbers:
+                    break
+                # reading ahead is bounded to the parts being uploaded
+                if len(pending) >= self.uploadWorkers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                partNumbers.append(len(partNumbers) + 1)
+                pending.add(self._uploads.submit(self._request, 'upload_part', uploadId, partNumbers[-1], data))
+                if len(data) < self.partSize:
+                    break
+            for future in pending:
+                future.result()
+            self._request('complete_multipart_upload', uploadId, partNumbers)
+        except Exception:
+            self._request('abort_multipart_upload', uploadId)
+            raise
+
+    def _request(self, method, *args):
+        """ runs one client call on a pooled connection """
+        with self._poolSlots:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                connection = self.connect()
+            # a connection whose request raised is dropped
+            result = getattr(connection, method)(*args)
+            with self._lock:
+                self._idle.append(connection)
+            return result
+
+    def _get_listing(self):
+        if self._listing is None:
+            self.list()
+        return self._listing
+
+    def _get_subtree(self, relpath):
+        """ (relpath, stat) of relpath and its descendants in the listing, parents before their children """
+        listing = self._get_listing()
+        subtree = []
+        with self._lock:
+            pending = [relpath] if relpath in listing else []
+            while pending:
+                childRelpath = pending.pop()
+                subtree.append((childRelpath, listing[childRelpath]))
+                pending.extend(self._children.get(childRelpath, ()))
+        return subtree
+
+    def _cache(self, relpath, statResult):
+        listing = self._get_listing()
+        with self._lock:
+            self._add_entry(listing, self._children, relpath, statResult)
+
+    def _add_entry(self, listing, children, relpath, statResult):
+        """ adds relpath and the dirs implied above it to listing and its children """
+        if relpath not in listing:
+            children.setdefault(os.path.dirname(relpath), set()).add(relpath)
+        listing[relpath] = statResult
+        parent = os.path.dirname(relpath)
+        while parent and parent not in listing:
+            listing[parent] = EntryStat(ObjectStorageBackend.DIR_MODE, 0, 0)
+            children.setdefault(os.path.dirname(parent), set()).add(parent)
+            parent = os.path.dirname(parent)
+
+    def _get_key(self, relpath, isDir=False):
+        return self.keyPrefix + relpath.replace(os.sep, '/') + ('/' if isDir else '')
+
+    def _get_relpath(self, key):
+        return key[len(self.keyPrefix):].rstrip('/').replace('/', os.sep)
+
+    def _build_metadata(self, mode, mtime):
+        return {'mode': str(mode), 'mtime': repr(mtime)}
+
+    def _build_stat(self, key, size, metadata):
+        isDir = key.endswith('/')
+        mode = int(metadata['mode']) if 'mode' in metadata else (
+            ObjectStorageBackend.DIR_MODE if isDir else stat.S_IFREG | 0o644)
+        return EntryStat(mode, 0 if isDir else size, float(metadata.get('mtime', 0)))
+
+
+# Watchers
+# ================================================================
+
+class FolderWatcher:
+    """ reports paths changed under a folder, the event source of FolderSync.watch """
+
+    def start(self, rootDir):
+        raise NotImplementedError
+
+    def read_events(self, timeout):
+        """ waits up to timeout seconds, returns (changed filepaths, overflowed) """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(FolderWatcher):
+    """ no change notifications, reports an overflow (full reconcile) every interval seconds """
+
+    def __init__(self, interval=2):
+        self.interval = interval
+        self._nextPoll = None
+
+    def start(self, rootDir):
+        self._nextPoll = time.monotonic() + self.interval
+
+    def read_events(self, timeout):
+        wait = self._nextPoll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return [], False
+        time.sleep(max(wait, 0))
+        self._nextPoll = time.monotonic() + self.interval
+        return [], True
+
+
+class InotifyWatcher(FolderWatcher):
+    """ linux inotify through ctypes, one watch per dir under the root """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    IN_NONBLOCK = 0o4000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+    READ_SIZE = 64 * 1024
+
+    _libc = None
+
+    def __init__(self):
+        self._fd = None
+        self._paths = {}  # wd -> dirpath
+        self._wds = {}  # dirpath -> wd
+        self._overflowed = False
+
+    @staticmethod
+    def _load_libc():
+        if InotifyWatcher._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            InotifyWatcher._libc = libc
+        return InotifyWatcher._libc
+
+    @staticmethod
+    def is_supported():
+        if not(sys.platform.startswith('linux')):
+            return False
+        try:
+            return hasattr(InotifyWatcher._load_libc(), 'inotify_init1')
+        except OSError:
+            return False
+
+    def start(self, rootDir):
+        libc = self._load_libc()
+        self._fd = libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self._fd < 0:
+            errorCode = ctypes.get_errno()
+            raise OSError(errorCode, os.strerror(errorCode))
+        self._add_watches(rootDir)
+
+    def read_events(self, timeout):
+        changed = []
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if ready:
+            movedFrom = {}  # cookie -> dirpath, unpaired ones left the tree
+            for wd, mask, cookie, name in self._read_raw_events():
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    self._overflowed = True
+                    continue
+                dirpath = self._paths.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & InotifyWatcher.IN_IGNORED:
+                    self._forget(wd)
+                    continue
+                path = os.path.join(dirpath, name) if name else dirpath
+                changed.append(path)
+                if mask & InotifyWatcher.IN_ISDIR:
+                    if mask & InotifyWatcher.IN_CREATE:
+                        self._add_watches(path)
+                    elif mask & InotifyWatcher.IN_MOVED_FROM:
+                        movedFrom[cookie] = path
+                    elif mask & InotifyWatcher.IN_MOVED_TO:
+                        oldPath = movedFrom.pop(cookie, None)
+                        if oldPath:
+                            self._rename_watches(oldPath, path)
+                        else:
+                            self._add_watches(path)
+            for oldPath in movedFrom.values():
+                self._remove_watches(oldPath)
+        overflowed, self._overflowed = self._overflowed, False
+        return changed, overflowed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._paths.clear()
+        self._wds.clear()
+
+    def _read_raw_events(self):
+        """ (wd, mask, cookie, name) of every queued inotify_event """
+        while True:
+            try:
+                buf = os.read(self._fd, InotifyWatcher.READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = InotifyWatcher.EVENT_HEADER.unpack_from(buf, offset)
+                offset += InotifyWatcher.EVENT_HEADER.size
+                name = os.fsdecode(buf[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                yield wd, mask, cookie, name
+
+    def _add_watch(self, dirpath):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), InotifyWatcher.WATCH_MASK)
+        if wd < 0:
+            # gone already, or out of watches: a reconcile has to catch up on it
+            self._overflowed = self._overflowed or ctypes.get_errno() != errno.ENOENT
+            return
+        self._paths[wd] = dirpath
+        self._wds[dirpath] = wd
+
+    def _add_watches(self, dirpath):
+        self._add_watch(dirpath)
+        for relpath, statResult in scan_tree(dirpath):
+            if stat.S_ISDIR(statResult.st_mode):
+                self._add_watch(os.path.join(dirpath, relpath))
+
+    def _watched_under(self, dirpath):
+        prefix = dirpath + os.sep
+        return [path for path in self._wds if path == dirpath or path.startswith(prefix)]
+
+    def _rename_watches(self, oldPath, newPath):
+        for path in self._watched_under(oldPath):
+            wd = self._wds.pop(path)
+            movedPath = newPath + path[len(oldPath):]
+            self._paths[wd] = movedPath
+            self._wds[movedPath] = wd
+
+    def _remove_watches(self, dirpath):
+        for path in self._watched_under(dirpath):
+            wd = self._wds.pop(path)
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _forget(self, wd):
+        path = self._paths.pop(wd, None)
+        if path is not None and self._wds.get(path) == wd:
+            del self._wds[path]
+
+
+class WatchQueue:
+    """
+    debounced set of changed paths. A path is ready once no event touched it for debounce seconds,
+    or maxDelay seconds after its first event so a constantly written file still gets synced.
+    """
+
+    def __init__(self, debounce=0.5, maxDelay=10):
+        self.debounce = debounce
+        self.maxDelay = maxDelay
+        self._pending = {}  # path -> (first event, last event)
+
+    def add(self, path, now=None):
+        now = now if now is not None else time.monotonic()
+        first, _ = self._pending.get(path, (now, now))
+        self._pending[path] = (first, now)
+
+    def add_all(self, paths, now=None):
+        now = now if now is not None else time.monotonic()
+        for path in paths:
+            self.add(path, now)
+
+    def pop_ready(self, now=None):
+        """ ready paths, parents before children """
+        now = now if now is not None else time.monotonic()
+        ready = [path for path, (first, last) in self._pending.items() if self._ready_at(first, last) <= now]
+        for path in ready:
+            del self._pending[path]
+        return sorted(ready, key=_relpath_sort_key)
+
+    def get_timeout(self, maxTimeout, now=None):
+        """ seconds until the next path is ready, capped at maxTimeout """
+        if not(self._pending):
+            return maxTimeout
+        now = now if now is not None else time.monotonic()
+        nextReady = min(self._ready_at(first, last) for first, last in self._pending.values())
+        return min(max(nextReady - now, 0), maxTimeout)
+
+    def clear(self):
+        self._pending.clear()
+
+    def __len__(self):
+        return len(self._pending)
 
+    def _ready_at(self, first, last):
+        return min(last + self.debounce, first + self.maxDelay)
 
-class Location:
 
-    def __init__(self, sync, folderInLocation, folderInId=None):
-        self._sync = sync
-        self._folderInLocation = folderInLocation
-        self._folderInId = folderInId
+# Metrics
+# ================================================================
 
-    @staticmethod
-    def build_from_dict(dictInput):
-        return Location(Sync.build_from_dict(dictInput),
-                        dictInput['folderInLocation'],
-                        dictInput['folderInId'])
+class SyncMetrics:
+    """
+    Counters and timings of one FolderSync cycle, updated from the worker threads.
+    statsIssued counts the stats of the walk and of the handlers (update_file, _find_duplicate, ...).
+    Timings are [calls, total seconds, max seconds] per name: phases (walk, plan_sync, execute_plan),
+    handlers (handle_inFile, update_file, ...), operations (operation.create, ...) and db calls (db.read_location, ...).
+    Watch mode events handled between two reconciles are reported with the second one.
+    """
 
-    def get_sync(self):
-        return self._sync
+    def __init__(self, cycle=0):
+        self.cycle = cycle
+        self.fullScan = None
+        self.startTime = time.time()
+        self.seconds = None
+        self._counters = Counter()
+        self._timings = {}
+        self._lock = threading.Lock()
 
-    def get_folderInLocation(self):
-        return self._folderInLocation
+    def add(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
 
-    def get_folderInId(self):
-        return self._folderInId
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                self._timings[name] = [1, seconds, seconds]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
 
+    def get_counters(self):
+        with self._lock:
+            return dict(self._counters)
 
-# Helper Classes
-# ================================================================
+    def get_timings(self):
+        """ {name: (calls, total seconds, max seconds)} """
+        with self._lock:
+            return {name: tuple(timing) for name, timing in self._timings.items()}
 
-class DatabaseConnector:
+    def to_dict(self):
+        return {
+            'cycle': self.cycle,
+            'fullScan': self.fullScan,
+            'startTime': formate_date_iso8601(datetime.fromtimestamp(self.startTime)),
+            'seconds': self.seconds,
+            'counters': self.get_counters(),
+            'timings': {name: {'calls': calls, 'seconds': seconds, 'maxSeconds': maxSeconds}
+                        for name, (calls, seconds, maxSeconds) in self.get_timings().items()},
+        }
 
-    def __init__(self, dataFolder=get_current_folder(), dbSetupFolder=get_current_folder()):
-        self.setupFileLoc = dbSetupFolder + "/tableSetup.sql"
-        self.conn = self._create_connection(dataFolder)
-        self.conn.row_factory = sqlite3.Row
-        self._run_setup()
 
-    def _create_connection(self, db_path):
-        """ create db conn """
-        if not os.path.exists(db_path):
-            os.makedirs(db_path)
-        return sqlite3.connect(db_path + "/sqllite.db", check_same_thread=False)
+class MeteredDataStore:
+    """ times every DataStore call into the current SyncMetrics of folderSync (as db.<method>) """
 
-    def _run_setup(self):
-        """ sets up database tables """
-        cursor = self.conn.cursor()
-        sql_file = open(self.setupFileLoc)
-        sql_as_string = sql_file.read()
-        cursor.executescript(sql_as_string)
+    def __init__(self, dataStore, folderSync):
+        self._dataStore = dataStore
+        self._folderSync = folderSync
 
-    def execute(self, query, args):
-        """Executes sql statements, and maps response to objects"""
-        cursor = self.conn.cursor()
-        cursor.execute(query, args)
-        self.conn.commit()
-        dictList = [dict(row) for row in cursor.fetchall()]
-        return dictList
+    def __getattr__(self, name):
+        attr = getattr(self._dataStore, name)
+        if not(callable(attr)):
+            return attr
+        timingName = 'db.' + name
 
-    def executeBatch(self, query, argsList):
-        """Executes sql statements, and maps response to objects"""
-        cursor = self.conn.cursor()
-        for arg in argsList:
-            cursor.execute(query, arg)
-        self.conn.commit()
-        dictList = [dict(row) for row in cursor.fetchall()]
-        return dictList
+        def call(*args, **kwargs):
+            metrics = self._folderSync.metrics
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                metrics.add('errors.db')
+                raise
+            finally:
+                metrics.observe(timingName, time.perf_counter() - start)
+        return call
 
 
-class DataStore:
+class MetricsExporter:
+    """ metrics hook (see FolderSync.add_metrics_hook) writing each cycle to filepath """
 
-    SYNC_TB = "sync"
-    CREATE_SYNC = """INSERT OR IGNORE INTO {}
-                     (folderIn, folderOut) VALUES (?,?);""".format(SYNC_TB)
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
 
-    LOC_TB = "location"
-    CREATE_LOC = """INSERT OR IGNORE INTO {}
-                    (folderIn, folderOut, folderInLocation, folderInId)
-                    VALUES (?,?,?,?);""".format(LOC_TB)
-    READ_LOC = """SELECT * FROM {}
-                  WHERE folderIn = ? AND folderOut = ? AND folderInId = ?;""".format(LOC_TB)
-    UPDATE_LOC = """UPDATE OR IGNORE {} SET
-                    folderInLocation = ? WHERE folderIn = ? AND folderOut = ? AND folderInLocation = ?;""".format(LOC_TB)
-    REMOVE_LOC = """DELETE FROM {}
-                    WHERE folderIn = ? AND folderOut = ? AND folderInLocation = ?;""".format(LOC_TB)
-    REMOVE_LOCS_BY_SYNC = """DELETE FROM {}
-                             WHERE folderIn = ? AND folderOut = ?;""".format(LOC_TB)
+    def __call__(self, folderSync, metrics):
+        with self._lock:
+            self.export(folderSync, metrics)
 
-    def __init__(self, dbConn):
-        self.dbConn = dbConn
+    def export(self, folderSync, metrics):
+        raise NotImplementedError()
 
-    def _records_to_locations(self, records):
-        locations = []
-        for record in records:
-            locations.append(Location.build_from_dict(record))
-        return locations
 
-    # SYNC
+class JsonLinesMetricsExporter(MetricsExporter):
+    """ appends one json line per cycle """
 
-    def create_sync(self, sync):
-        # wipe old vals
-        self.remove_locs_by_sync(sync)
-        # create sync
-        args = (sync.get_folderIn(), sync.get_folderOut())
-        self.dbConn.execute(DataStore.CREATE_SYNC, args)
+    def export(self, folderSync, metrics):
+        line = dict(folderIn=folderSync.folderIn, folderOut=folderSync.folderOut, **metrics.to_dict())
+        with open(self.filepath, 'a') as ofp:
+            ofp.write(json.dumps(line) + '\n')
 
-    # LOCATION
 
-    def create_location(self, loc):
-        sync = loc.get_sync()
-        args = (sync.get_folderIn(),
-                sync.get_folderOut(),
-                loc.get_folderInLocation(),
-                loc.get_folderInId())
-        self.dbConn.execute(DataStore.CREATE_LOC, args)
+class PrometheusMetricsExporter(MetricsExporter):
+    """
+    rewrites filepath in the prometheus text format with the last cycle of every sync it was hooked to,
+    e.g. for the node_exporter textfile collector. The file is replaced atomically.
+    """
 
-    def read_location(self, sync, folderId):
-        args = (sync.get_folderIn(),
-                sync.get_folderOut(),
-                folderId)
-        records = self.dbConn.execute(DataStore.READ_LOC, args)
-        locations = self._records_to_locations(records)
-        return locations[0] if locations else None
+    def __init__(self, filepath):
+        super().__init__(filepath)
+        self._lastCycles = {}  # (folderIn, folderOut) -> SyncMetrics
 
-    def update_location(self, oldLoc, newloc):
-        sync = newloc.get_sync()
-        args = (newloc.get_folderInLocation(),
-                sync.get_folderIn(),
-                sync.get_folderOut(),
-                oldLoc.get_folderInLocation())
-        self.dbConn.execute(DataStore.UPDATE_LOC, args)
+    def export(self, folderSync, metrics):
+        self._lastCycles[(folderSync.folderIn, folderSync.folderOut)] = metrics
+        lines = []
+        families = [
+            ('pyfoldersync_cycle_seconds', 'duration of the last cycle', lambda m: [((), m.seconds)]),
+            ('pyfoldersync_cycle', 'number of the last cycle', lambda m: [((), m.cycle)]),
+            ('pyfoldersync_count', 'counters of the last cycle',
+             lambda m: [((('name', name),), value) for name, value in sorted(m.get_counters().items())]),
+            ('pyfoldersync_timing_calls', 'timed calls in the last cycle',
+             lambda m: [((('name', name),), timing[0]) for name, timing in sorted(m.get_timings().items())]),
+            ('pyfoldersync_timing_seconds', 'total seconds of the timed calls in the last cycle',
+             lambda m: [((('name', name),), timing[1]) for name, timing in sorted(m.get_timings().items())]),
+            ('pyfoldersync_timing_max_seconds', 'slowest timed call in the last cycle',
+             lambda m: [((('name', name),), timing[2]) for name, timing in sorted(m.get_timings().items())]),
+        ]
+        for family, description, samples in families:
+            lines.append('# HELP {} {}'.format(family, description))
+            lines.append('# TYPE {} gauge'.format(family))
+            for (folderIn, folderOut), cycleMetrics in self._lastCycles.items():
+                for labels, value in samples(cycleMetrics):
+                    labels = (('folder_in', folderIn), ('folder_out', folderOut)) + labels
+                    lines.append('{}{{{}}} {}'.format(family, ','.join(
+                        '{}="{}"'.format(key, self._escape(labelValue)) for key, labelValue in labels),
+                        value if value is not None else 'NaN'))
+        tmpFilepath = self.filepath + '.tmp'
+        with open(tmpFilepath, 'w') as ofp:
+            ofp.write('\n'.join(lines) + '\n')
+        os.replace(tmpFilepath, self.filepath)
 
-    def remove_location(self, loc):
-        sync = loc.get_sync()
-        args = (sync.get_folderIn(),
-                sync.get_folderOut(),
-                loc.get_folderInLocation())
-        self.dbConn.execute(DataStore.REMOVE_LOC, args)
+    def _escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-    def remove_locs_by_sync(self, sync):
-        args = (sync.get_folderIn(),
-                sync.get_folderOut())
-        self.dbConn.execute(DataStore.REMOVE_LOCS_BY_SYNC, args)
 
 # Primary Class
 # ================================================================
@@ -244,67 +3180,642 @@ class FolderSync:
     """
     Keeps the folderOut in sync with the folderIn.
     Frequency (seconds) is the sleep time after run.
-    Moves are tracked by fileid (via fsutil file queryfileid)
+    Moves are tracked by fileid (via fileIdProvider, read from os.stat)
     Steps:
-        1. iterate folderIn
-            for each file/folder:
-                1.5 File actions:
+        1. snapshot folderIn and folderOut (one scandir pass each)
+        2. diff the snapshots into a plan
+            for each folderIn file/folder:
                 - if in folderIn, not in folderOut, -> create or check if moved (modified path)
                 - if in folderIn, in folderOut, if last modified > folderOut last modified -> update
-        2. iterate folderOut locations
-            for each location:
-                2.5 folderOut actions:
+            for each folderOut file/folder:
                 - if in folderOut, not in folderIn, -> delete
+        3. execute the plan
+    watch() replaces the sleep-poll loop of run() with change notifications (see FolderWatcher).
+    dry_run() writes the plan of a cycle without running it, execute_saved_plan() runs it later.
+    folderOut is written through a StorageBackend, a local dir unless an object store backend is given.
     """
 
-    def __init__(self, folderIn, folderOut, frequency=2, deleteWaitlist=True):
+    MIN_MEASURED_BYTES = 16 * 1024 * 1024  # copied in a cycle before its throughput is used for estimates
+
+    def __init__(self, folderIn, folderOut, frequency=2, deleteWaitlist=True, fileIdProvider=None,
+                 fullScanEvery=10, pruneUnchangedDirs=False, trustDirMtimes=False, workers=1,
+                 maxInFlightBytes=256 * 1024 * 1024, deltaMinSize=None, deltaBlockSize=1024 * 1024, fileCopier=None,
+                 contentHash=False, dedupe=False, dataStore=None, planExecutor=None, metricsHooks=None,
+                 rateLimiter=None, syncFilter=None, scanner=None, scanWorkers=1, packMaxFileSize=None,
+                 storage=None):
 
         # set vals
         self.deleteWaitlist = deleteWaitlist  # waits one run for deletes to happen (more optimal in case move happens)
         self.folderIn = EXT_PATH + folderIn
         self.folderOut = EXT_PATH + folderOut
-        self.sync = Sync(self.folderIn, self.folderOut)
+        self.syncFilter = syncFilter  # excluded entries are neither walked nor touched (see SyncFilter)
+        self.sync = Sync(self.folderIn, self.folderOut, syncFilter)
         self.frequency = frequency
-        self.dataStore = DataStore(DatabaseConnector())
-        self.waitForDelete = set()  # waits until next run to delete
+        self.fileIdProvider = fileIdProvider if fileIdProvider else get_default_file_id_provider()
+        self.rateLimiter = rateLimiter  # paces copies, moves and deletes (see RateLimiter)
+        if not(fileCopier):
+            fileCopier = ThrottledFileCopier(rateLimiter) if rateLimiter else KernelFileCopier()
+        self.fileCopier = fileCopier
+        # folderOut is written through storage (see StorageBackend), folderOut names it in the index
+        self.storage = storage if storage else LocalStorageBackend(self.folderOut, fileCopier, rateLimiter)
+        self._localOut = isinstance(self.storage, LocalStorageBackend)
+        if not(self._localOut) and (packMaxFileSize or dedupe or deltaMinSize is not None):
+            raise ValueError('packing, dedupe and delta updates need a local folderOut')
+        self.dataStore = dataStore if dataStore else DataStore(DatabaseConnector())
+        if workers > 1 and not(isinstance(self.dataStore, DataStoreWriter)):
+            # handlers run on worker threads, db calls are funneled to a single writer
+            self.dataStore = DataStoreWriter(self.dataStore)
+        self.dataStore = MeteredDataStore(self.dataStore, self)
+        self.metrics = SyncMetrics()  # of the running cycle
+        self.packMaxFileSize = packMaxFileSize  # smaller files go to pack files (see PackStore)
+        self.packStore = PackStore(self.sync, self.dataStore) if packMaxFileSize else None
+        self.metricsHooks = list(metricsHooks) if metricsHooks else []  # hook(folderSync, metrics) after each cycle
+        self.planExecutor = planExecutor
+        if not(planExecutor) and workers > 1:
+            self.planExecutor = PlanExecutor(workers, maxInFlightBytes)
+        self.scanner = scanner  # lists dirs concurrently (see ParallelScanner)
+        if not(scanner) and scanWorkers > 1:
+            self.scanner = ParallelScanner(scanWorkers)
+        self.waitForDelete = DeleteWaitlist(self.folderOut)  # waits until next run to delete
+        self.fullScanEvery = fullScanEvery  # other cycles diff folderIn against the index instead of folderOut
+        # dirs whose mtime matches the index are not listed, their indexed children are still stat'd one by one:
+        # it saves the open/getdents/close per dir, not stats (see scan_tree_indexed)
+        self.pruneUnchangedDirs = pruneUnchangedDirs
+        # the files of those dirs are not stat'd either, so an in-place edit waits for the next full scan
+        self.trustDirMtimes = trustDirMtimes
+        if trustDirMtimes and not(pruneUnchangedDirs):
+            raise ValueError('trustDirMtimes needs pruneUnchangedDirs')
+        self.deltaMinSize = deltaMinSize  # files this big are updated block by block (None = always copy)
+        self.deltaBlockSize = deltaBlockSize
+        self.contentHash = contentHash  # index a content hash, touched-only files just get their stat copied
+        self.dedupe = dedupe  # link content already in folderOut instead of copying it (needs contentHash)
+        self._indexReady = False  # set once a full scan synced without failures
+        self.measuredBytesPerSecond = None  # copy throughput of the last cycle that copied enough to tell
+        self._journalChecked = False  # resume() runs before the first cycle
+        self._cycle = 0
 
     # Main Loop
     # =================================================================
 
     def run(self):
 
+        # register the sync (an existing one keeps its locations)
+        self.dataStore.create_sync(self.sync)
+
+        # run forever, when infile/outfile paths exist
+        run_cycles(self._run_if_present, self.frequency)
+
+    def sync_once(self):
+        """ diffs both sides, then applies the changes. Returns the executed plan """
+        return self.sync_cycle().get_plan()
+
+    def sync_cycle(self, inSnapshot=None, stopEvent=None, scanSlots=None):
+        """
+        one cycle, the one every sync variant runs: finishes the plan journaled by an interrupted run
+        (first cycle only), or plans a new one and executes it. Returns its SyncResult.
+        inSnapshot is a walk of folderIn already taken (see plan_sync), once stopEvent is set no more
+        operations are started (see execute_plan). scanSlots is a semaphore held while planning only.
+        """
+        result = self._resume_once()
+        if result:
+            return result
+        fullScan = self._begin_cycle()
+        if scanSlots is not None:
+            with scanSlots:
+                plan = self.plan_sync(fullScan, inSnapshot)
+        else:
+            plan = self.plan_sync(fullScan, inSnapshot)
+        return self._finish_cycle(fullScan, plan, self.execute_plan(plan, stopEvent))
+
+    def _run_if_present(self):
+        if self._check_sync_integrety():
+            self.sync_once()
+
+    def _resume_once(self):
+        """ resume() before the first cycle, its SyncResult if it ran anything """
+        if self._journalChecked:
+            return None
+        self._journalChecked = True
+        return self.resume()
+
+    def _finish_cycle(self, fullScan, plan, failures):
+        """ upkeep after an executed plan, returns the SyncResult of the cycle """
+        if self.packStore and fullScan:
+            self.packStore.compact()
+        self._end_cycle(fullScan, failures)
+        return SyncResult(plan, failures, fullScan)
+
+    def _begin_cycle(self):
+        """ whether this cycle has to scan folderOut, or can diff against the index """
+        fullScan = not(self._indexReady) or not(self.fullScanEvery) or self._cycle % self.fullScanEvery == 0
+        self.metrics.cycle = self._cycle
+        self.metrics.fullScan = fullScan
+        self.metrics.startTime = time.time()
+        self._cycle += 1
+        return fullScan
+
+    def _end_cycle(self, fullScan, failures):
+        if fullScan or failures:
+            self._indexReady = not(failures)
+        metrics = self.metrics
+        metrics.seconds = time.time() - metrics.startTime
+        bytesCopied = metrics.get_counters().get('bytesCopied', 0)
+        executeTiming = metrics.get_timings().get('execute_plan')
+        if bytesCopied >= self.MIN_MEASURED_BYTES and executeTiming and executeTiming[1]:
+            self.measuredBytesPerSecond = bytesCopied / executeTiming[1]
+        self.metrics = SyncMetrics(self._cycle)
+        for hook in self.metricsHooks:
+            try:
+                hook(self, metrics)
+            except Exception:
+                print("failed to run metrics hook:" + str(hook))
+                traceback.print_exc()
+
+    def resume(self):
+        """
+        finishes the operations journaled by a cycle that never completed (crash, kill), instead of
+        rescanning both sides. Returns its SyncResult, None if there was nothing to resume.
+        Once it succeeds the index is trusted, the next cycle diffs folderIn against it.
+        """
+        result = self._execute_saved_operations(self.dataStore.read_journal(self.sync))
+        if result is None:
+            self.dataStore.clear_journal(self.sync)
+            return None
+        if not(result.get_failures()):
+            self._indexReady = True
+        return result
+
+    def dry_run(self, ofp=None, fullScan=True, bytesPerSecond=None, opsPerSecond=None):
+        """
+        plans a cycle without touching either side or the index and streams it to ofp (see write_plan).
+        Rates for the estimate default to the rateLimiter's, then to the measured copy throughput.
+        The plan can be run later with execute_saved_plan. Returns the plan.
+        """
+        plan = self.plan_sync(fullScan)
+        if self.rateLimiter:
+            limitedBytes, limitedOps = self.rateLimiter.get_rates()
+            bytesPerSecond = bytesPerSecond if bytesPerSecond else limitedBytes
+            opsPerSecond = opsPerSecond if opsPerSecond else limitedOps
+        bytesPerSecond = bytesPerSecond if bytesPerSecond else self.measuredBytesPerSecond
+        if ofp:
+            write_plan(plan, ofp, self.sync, fullScan, bytesPerSecond, opsPerSecond)
+        return plan
+
+    def execute_saved_plan(self, ifp):
+        """
+        runs a plan written by dry_run. Operations are re-stat'd first, the ones whose source is gone
+        are dropped and changes made since planning are left to the next cycle. Returns its SyncResult.
+        """
+        header, plan, _ = read_plan(ifp)
+        if not(header) or (header['folderIn'], header['folderOut']) != (self.folderIn, self.folderOut):
+            raise ValueError('plan is not one of {} -> {}'.format(self.folderIn, self.folderOut))
+        result = self._execute_saved_operations(plan)
+        return result if result else SyncResult(SyncPlan(), 0, False)
+
+    def _execute_saved_operations(self, operations):
+        """ runs journaled/saved operations as one cycle, None if none of them still applies """
+        plan = SyncPlan()
+        for operation in operations:
+            operation = self._restat_operation(operation)
+            if operation:
+                plan.add(operation)
+        if not(plan):
+            return None
+        fullScan = self._begin_cycle()
+        failures = self.execute_plan(plan)
+        self._end_cycle(fullScan, failures)
+        return SyncResult(plan, failures, False)
+
+    def _restat_operation(self, operation):
+        """ saved operation with fresh stats, None if its source is gone (the next scan sorts it out) """
+        relpath = operation.get_relpath()
+        inFilepath = self._build_in_filepath(relpath)
+        outStat = self._stat_out(relpath)
+        if operation.get_action() == SyncOperation.DELETE:
+            if os.path.lexists(inFilepath):
+                # re-created since
+                return None
+            return SyncOperation(SyncOperation.DELETE, relpath, outStat=outStat)
+        if not(os.path.exists(inFilepath)):
+            return None
+        inStat = self._stat(inFilepath)
+        fileId = self.fileIdProvider.get_file_id(inFilepath, inStat)
+        if operation.get_action() == SyncOperation.MOVE:
+            return SyncOperation(SyncOperation.MOVE, relpath, inStat, outStat, fileId,
+                                 self.dataStore.read_location(self.sync, fileId), operation.get_oldRelpath())
+        if operation.get_action() == SyncOperation.UPDATE and outStat is not None:
+            return SyncOperation(SyncOperation.UPDATE, relpath, inStat, outStat)
+        if operation.get_action() == SyncOperation.TRACK:
+            return SyncOperation(SyncOperation.TRACK, relpath, inStat, outStat) if outStat is not None else None
+        return SyncOperation(SyncOperation.CREATE, relpath, inStat, fileId=fileId)
+
+    def add_metrics_hook(self, hook):
+        """ hook(folderSync, SyncMetrics) is called after each cycle, e.g. a JsonLinesMetricsExporter """
+        self.metricsHooks.append(hook)
+
+    # Watch Loop
+    # =================================================================
+
+    def watch(self, watcher=None, debounce=0.5, reconcileEvery=600, stopEvent=None):
+        """
+        Event driven alternative to run: paths the watcher reports under folderIn are debounced and
+        handled one by one. A full reconcile (sync_once) runs on start, when the watcher overflows
+        and every reconcileEvery seconds. Runs until stopEvent is set.
+        """
+        watcher = watcher if watcher else get_default_watcher()
+        queue = WatchQueue(debounce)
+
         # clean and re-create sync
         self.dataStore.create_sync(self.sync)
 
-        # run forever
-        while True:
+        watcher.start(self.folderIn)
+        try:
+            nextReconcile = time.monotonic()
+            while not(stopEvent and stopEvent.is_set()):
 
-            # check to make sure infile/outfile paths exist
-            if self._check_sync_integrety():
+                # reconcile everything (also catches changes made before the watches were added)
+                if time.monotonic() >= nextReconcile:
+                    if self._check_sync_integrety():
+                        self.sync_once()
+                    nextReconcile = time.monotonic() + reconcileEvery if reconcileEvery else float('inf')
 
-                # iterate infiles to decide on creates/modifies
-                for filee in get_descedents(self.folderIn):
-                    try:
-                        if self._check_sync_integrety():
-                            self.handle_inFile(filee)
-                    except Exception:
-                        print("failed to deal with folderIn file:" + filee)
-                    traceback.print_exc()
-
-                # iterate outfiles to decide on deletes
-                for filee in get_descedents(self.folderOut):
-                    try:
-                        if self._check_sync_integrety():
-                            self.handle_outFile(filee)
-                    except Exception:
-                        print("failed to deal with folderOut file:" + filee)
-                        traceback.print_exc()
+                # wait for events, capped so stopEvent gets checked
+                timeout = min(queue.get_timeout(1.0), max(nextReconcile - time.monotonic(), 0))
+                paths, overflowed = watcher.read_events(timeout)
+                if overflowed:
+                    queue.clear()
+                    nextReconcile = time.monotonic()
+                    continue
+                queue.add_all(paths)
+                self._handle_changed_paths(queue.pop_ready(), queue)
+        finally:
+            watcher.close()
+
+    def _handle_changed_paths(self, inFilepaths, queue):
+        """ existing paths first so a move is tracked before its old path gets deleted """
+        existing = [path for path in inFilepaths if os.path.lexists(path)]
+        existingSet = set(existing)
+        removed = [path for path in inFilepaths if path not in existingSet]
+        # the file ids of the batch are looked up at once, with the stats read for them
+        inStats = {}
+        for inFilepath in existing:
+            try:
+                inStats[inFilepath] = self._stat(inFilepath)
+            except OSError:
+                # gone since, or a broken link: handle_inFile reports it
+                continue
+        priorLocations = self.dataStore.read_locations_by_file_id(
+            self.sync, [self.fileIdProvider.get_file_id(path, inStat) for path, inStat in inStats.items()])
+        for inFilepath in existing:
+            try:
+                if self._is_excluded(self.folderIn, inFilepath):
+                    continue
+                if self._check_sync_integrety():
+                    self.handle_inFile(inFilepath, inStats.get(inFilepath), priorLocations)
+            except Exception:
+                self.metrics.add('errors.handle_inFile')
+                print("failed to deal with folderIn file:" + inFilepath)
+                traceback.print_exc()
+        for inFilepath in removed:
+            outFilepath = self._build_sync_filepath(self.folderIn, self.folderOut, inFilepath)
+            try:
+                if self._is_out_excluded(outFilepath):
+                    continue
+                if self._check_sync_integrety():
+                    self.handle_outFile(outFilepath)
+                    # waitlisted, deleted once another debounce passes without a move claiming it
+                    if self.deleteWaitlist and outFilepath in self.waitForDelete:
+                        queue.add(inFilepath)
+            except Exception:
+                self.metrics.add('errors.handle_outFile')
+                print("failed to deal with folderOut file:" + outFilepath)
+                traceback.print_exc()
+
+    def _scan(self, rootDir):
+        if self.scanner:
+            return self.scanner.scan(rootDir, syncFilter=self.syncFilter)
+        return scan_tree(rootDir, syncFilter=self.syncFilter)
+
+    def _list_out(self):
+        """ listing of a folderOut that is not a local dir, filtered by the ignore files of folderIn """
+        if not(self.syncFilter):
+            return self.storage.list()
+        return [(relpath, outStat) for relpath, outStat in self.storage.list()
+                if not(self.syncFilter.is_path_excluded(self.folderIn, relpath, outStat))]
+
+    def _is_in_excluded(self, relpath):
+        """ whether folderIn has relpath but the filter excludes it """
+        if not(self.syncFilter):
+            return False
+        try:
+            inStat = os.lstat(self._build_in_filepath(relpath))
+        except OSError:
+            return False
+        return self.syncFilter.is_path_excluded(self.folderIn, relpath, inStat)
 
-            # re-run or stop
-            if self.frequency:
-                time.sleep(self.frequency)
+    def _is_out_excluded(self, outFilepath):
+        """ whether the folderOut entry at outFilepath is excluded, False if there is none """
+        if not(self.syncFilter):
+            return False
+        relpath = self._build_relpath(self.folderOut, outFilepath)
+        outStat = self._stat_out(relpath)
+        return outStat is not None and self.syncFilter.is_path_excluded(self.folderIn, relpath, outStat)
+
+    def _is_excluded(self, rootDir, filepath):
+        if not(self.syncFilter):
+            return False
+        return self.syncFilter.is_path_excluded(rootDir, self._build_relpath(rootDir, filepath), os.lstat(filepath))
+
+    # Diff engine
+    # =================================================================
+
+    @_timed
+    def plan_sync(self, fullScan=True, inSnapshot=None):
+        """
+        diffs one snapshot of each side into the creates/updates/moves/deletes for this cycle.
+        A full scan walks both folders, otherwise folderOut is taken from the index of the last sync.
+        inSnapshot is a walk of folderIn already taken (see FanOutSync).
+        """
+        plan = SyncPlan()
+        index = self._read_index()
+        walkStart = time.perf_counter()
+        syncFilter = self.syncFilter
+        walksIn = inSnapshot is None  # a snapshot handed in was stat'd (and counted) by its walk
+        trustedIndex = False  # whether the walk took stats from the index
+        if fullScan:
+            # with a scanner both sides are listed at once
+            inScan = self._scan(self.folderIn) if inSnapshot is None else None
+            outScan = self._scan(self.folderOut) if self._localOut else self._list_out()
+            inSnapshot = dict(inScan) if inSnapshot is None else inSnapshot
+            outSnapshot = dict(outScan)
+            if self._localOut:
+                self._count_stats(len(outSnapshot))
+            if self.packStore:
+                # the packed files instead of the packs holding them
+                for relpath in self.packStore.get_pack_relpaths():
+                    outSnapshot.pop(relpath, None)
+                outSnapshot.update(self.packStore.read_snapshot())
+            self.metrics.add('entriesScanned.out', len(outSnapshot))
+        else:
+            if inSnapshot is None:
+                if self.pruneUnchangedDirs:
+                    inSnapshot = dict(scan_tree_indexed(self.folderIn, index, _index_children(index),
+                                                        syncFilter=syncFilter, trustDirMtimes=self.trustDirMtimes))
+                    trustedIndex = self.trustDirMtimes
+                else:
+                    inSnapshot = dict(self._scan(self.folderIn))
+            if syncFilter:
+                outSnapshot = {relpath: indexStat for relpath, indexStat in index.items()
+                               if not(syncFilter.is_path_excluded(self.folderIn, relpath, indexStat))}
             else:
-                break
+                outSnapshot = dict(index)
+        self.metrics.add('entriesScanned.in', len(inSnapshot))
+        if trustedIndex:
+            self._count_stats(sum(1 for relpath, inStat in inSnapshot.items() if inStat is not index.get(relpath)))
+        elif walksIn:
+            self._count_stats(len(inSnapshot))
+        self.metrics.observe('walk', time.perf_counter() - walkStart)
+        # index entries on neither side (changed while not running), dropped so their file ids can't match
+        # (excluded ones are left to the filter, their folderOut copies are kept)
+        staleRelpaths = [relpath for relpath in index
+                         if relpath not in inSnapshot and relpath not in outSnapshot
+                         and not(syncFilter and syncFilter.is_path_excluded(self.folderIn, relpath, index[relpath]))
+                         and not(self._is_in_excluded(relpath))] if fullScan else []
+        trackOperations = []
+        # {snapshot relpath: relpath} of entries moved earlier in this plan and the reverse, the snapshots
+        # and index keep their keys and moved subtrees are looked up through these (see _remap_relpath)
+        moves = {}
+        movedTo = {}
+        dirUpdates = []  # dir stats are applied last, children changes would bump their mtime
+        skipPrefix = None
+        createdDir = None
+        fileIds, priorLocations = self._read_prior_locations(inSnapshot, outSnapshot)
+
+        for relpath, inStat in inSnapshot.items():
+            # descendants of a created dir are copied along with it (pre-order keeps them contiguous)
+            if skipPrefix:
+                if relpath.startswith(skipPrefix):
+                    if stat.S_ISREG(inStat.st_mode):
+                        createdDir.add_subtree_bytes(inStat.st_size)
+                    continue
+                skipPrefix = None
+
+            # update file
+            snapshotRelpath = self._find_snapshot_relpath(relpath, moves, movedTo)
+            outStat = outSnapshot.get(snapshotRelpath)
+            if outStat is not None:
+                if self._is_modified(inStat, outStat):
+                    self._plan_update(plan, dirUpdates, SyncOperation(SyncOperation.UPDATE, relpath, inStat, outStat))
+                elif self._is_modified(inStat, index.get(snapshotRelpath)):
+                    trackOperations.append(SyncOperation(SyncOperation.TRACK, relpath, inStat, outStat))
+                continue
+
+            # create or move file/files
+            fileId = fileIds.get(relpath)
+            if fileId is None:
+                fileId = self.fileIdProvider.get_file_id(self._build_in_filepath(relpath), inStat)
+                priorLocation = self.dataStore.read_location(self.sync, fileId)
+            else:
+                priorLocation = priorLocations.get(str(fileId))
+            snapshotRelpath = self._find_move_source(inStat, priorLocation, moves, inSnapshot, outSnapshot)
+            if snapshotRelpath is not None:
+                outStat = outSnapshot[snapshotRelpath]
+                # where folderOut holds it once the moves before it have run
+                oldRelpath = _remap_relpath(snapshotRelpath, moves)
+                plan.add(SyncOperation(SyncOperation.MOVE, relpath, inStat, outStat,
+                                       fileId, priorLocation, oldRelpath))
+                moves[snapshotRelpath] = relpath
+                movedTo[relpath] = snapshotRelpath
+                if self._is_modified(inStat, outStat):
+                    self._plan_update(plan, dirUpdates, SyncOperation(SyncOperation.UPDATE, relpath, inStat, outStat))
+            else:
+                operation = SyncOperation(SyncOperation.CREATE, relpath, inStat, fileId=fileId)
+                plan.add(operation)
+                if stat.S_ISDIR(inStat.st_mode):
+                    skipPrefix = relpath + os.sep
+                    createdDir = operation
+
+        # delete file/files (descendants of a deleted dir go with it)
+        deletes = {}
+        for snapshotRelpath, outStat in outSnapshot.items():
+            relpath = _remap_relpath(snapshotRelpath, moves) if moves else snapshotRelpath
+            if relpath not in inSnapshot:
+                deletes[relpath] = outStat
+        skipPrefix = None
+        for relpath in sorted(deletes, key=_relpath_sort_key):
+            if skipPrefix and relpath.startswith(skipPrefix):
+                continue
+            outStat = deletes[relpath]
+            skipPrefix = relpath + os.sep if stat.S_ISDIR(outStat.st_mode) else None
+            if self._is_in_excluded(relpath):
+                # still in folderIn, only filtered out (e.g. too young): its copy is left alone
+                continue
+            plan.add(SyncOperation(SyncOperation.DELETE, relpath, outStat=outStat))
+        for relpath in staleRelpaths:
+            plan.add(SyncOperation(SyncOperation.DELETE, relpath, outStat=index[relpath]))
+
+        # deepest dirs first so a parent's mtime is set after its children
+        for operation in reversed(dirUpdates):
+            plan.add(operation)
+        for operation in trackOperations:
+            plan.add(operation)
+        return plan
+
+    @_timed
+    def execute_plan(self, plan, stopEvent=None):
+        """
+        runs each planned operation through its handler, returns the number that failed.
+        Operations not started because stopEvent was set count as failed, they stay journaled for resume().
+        """
+        # db bookkeeping of the whole plan is written in one transaction (checkpointed every maxBatchAge)
+        self.dataStore.begin_batch()
+        try:
+            # journaled before anything runs, so a crash mid-plan can be resumed
+            journaled = self.dataStore.save_journal(self.sync, plan)
+            if self.planExecutor:
+                failures = self.planExecutor.execute(plan, self._run_operation, stopEvent)
+            else:
+                failures = 0
+                for index, operation in enumerate(plan):
+                    if stopEvent and stopEvent.is_set():
+                        failures += len(plan) - index
+                        break
+                    if not(self._run_operation(operation)):
+                        failures += 1
+            if self.packStore:
+                self.packStore.flush()
+            if journaled and not(stopEvent and stopEvent.is_set()):
+                self.dataStore.clear_journal(self.sync)
+            return failures
+        finally:
+            self.dataStore.end_batch()
+
+    def _run_operation(self, operation):
+        start = time.perf_counter()
+        try:
+            if self._check_sync_integrety():
+                self._execute_operation(operation)
+                if operation.get_action() != SyncOperation.TRACK:
+                    self.dataStore.complete_journal_entry(self.sync, operation)
+            return True
+        except Exception:
+            self.metrics.add('errors.' + operation.get_action())
+            print("failed to {} file:".format(operation.get_action()) + operation.get_relpath())
+            traceback.print_exc()
+            return False
+        finally:
+            self.metrics.observe('operation.' + operation.get_action(), time.perf_counter() - start)
+
+    def _execute_operation(self, operation):
+        action = operation.get_action()
+        inFilepath = self._build_in_filepath(operation.get_relpath())
+        outFilepath = self._build_out_filepath(operation.get_relpath())
+        if action == SyncOperation.UPDATE:
+            operation.set_copyBackends(
+                self.update_file(inFilepath, outFilepath, operation.get_inStat(), operation.get_outStat()))
+        elif action == SyncOperation.CREATE:
+            operation.set_copyBackends(
+                self.create_file(inFilepath, outFilepath,
+                                 Location(self.sync, inFilepath, operation.get_fileId(), operation.get_inStat())))
+        elif action == SyncOperation.MOVE:
+            self.move_file(inFilepath, outFilepath,
+                           Location(self.sync, inFilepath, operation.get_fileId()),
+                           operation.get_priorLocation(),
+                           self._build_out_filepath(operation.get_oldRelpath()))
+        elif action == SyncOperation.DELETE:
+            if self._out_exists(outFilepath):
+                self.delete_file(inFilepath, outFilepath, Location(self.sync, inFilepath))
+            else:
+                # stale index entry, folderOut no longer has it
+                self.dataStore.remove_location(Location(self.sync, inFilepath))
+        elif action == SyncOperation.TRACK:
+            self._track_file(inFilepath, operation.get_inStat())
+
+    def _plan_update(self, plan, dirUpdates, operation):
+        if stat.S_ISDIR(operation.get_inStat().st_mode):
+            dirUpdates.append(operation)
+        else:
+            plan.add(operation)
+
+    def _is_modified(self, inStat, outStat):
+        if outStat is None:
+            return True
+        if inStat.st_mtime != outStat.st_mtime:
+            return True
+        # dir sizes are filesystem specific
+        return not(stat.S_ISDIR(inStat.st_mode)) and inStat.st_size != outStat.st_size
+
+    def _read_index(self):
+        """ {relpath: EntryStat} of folderIn as of the last sync """
+        return self.dataStore.read_index(self.sync)
+
+    def _track_file(self, inFilepath, inStat, fileHash=None):
+        """ records the synced folderIn metadata in the index """
+        fileId = self.fileIdProvider.get_file_id(inFilepath, inStat)
+        if self.contentHash and fileHash is None and stat.S_ISREG(inStat.st_mode):
+            fileHash = self._content_hash(inFilepath, inStat)
+        self.dataStore.create_location(Location(self.sync, inFilepath, fileId, inStat, fileHash))
+
+    def _indexed_hash(self, inFilepath, inStat):
+        """ the content hash indexed for inFilepath while its size and mtime still match, otherwise None """
+        priorLocation = self.dataStore.read_location_by_path(Location(self.sync, inFilepath))
+        if priorLocation is None or not(priorLocation.get_folderInHash()):
+            return None
+        priorStat = priorLocation.get_folderInStat()
+        if priorStat is None or (priorStat.st_size, priorStat.st_mtime) != (inStat.st_size, inStat.st_mtime):
+            return None
+        return priorLocation.get_folderInHash()
+
+    def _content_hash(self, inFilepath, inStat):
+        """ content hash of inFilepath, only read again once its size or mtime changed """
+        fileHash = self._indexed_hash(inFilepath, inStat)
+        return fileHash if fileHash else hash_file(inFilepath)
+
+    def _find_move_source(self, inStat, priorLocation, moves, inSnapshot, outSnapshot):
+        """ snapshot relpath of the folderOut entry holding the tracked file, or None if it has to be created """
+        if not(priorLocation):
+            return None
+        snapshotRelpath = self._build_relpath(self.folderIn, priorLocation.get_folderInLocation())
+        oldOutStat = outSnapshot.get(snapshotRelpath)
+        if oldOutStat is None or snapshotRelpath in moves:
+            return None
+        # the prior dir may have been moved earlier in this plan
+        if _remap_relpath(snapshotRelpath, moves) in inSnapshot:
+            return None
+        if stat.S_ISDIR(oldOutStat.st_mode) != stat.S_ISDIR(inStat.st_mode):
+            return None
+        return snapshotRelpath
+
+    def _read_prior_locations(self, inSnapshot, outSnapshot):
+        """
+        ({relpath: file id}, {str(file id): Location}) of the folderIn entries plan_sync looks up as move
+        sources, one lookup per level of the tree: the entries missing from folderOut under a dir it holds,
+        then the ones under those tracked elsewhere (moves). Under an untracked dir they are created along with it.
+        """
+        missingChildren = {}  # parent relpath -> [relpaths missing from folderOut]
+        for relpath in inSnapshot:
+            if relpath not in outSnapshot:
+                missingChildren.setdefault(relpath.rpartition(os.sep)[0], []).append(relpath)
+        fileIds = {}
+        priorLocations = {}
+        level = [relpath for parent, relpaths in missingChildren.items() if not(parent) or parent in outSnapshot
+                 for relpath in relpaths]
+        while level:
+            levelIds = {relpath: self.fileIdProvider.get_file_id(self._build_in_filepath(relpath), inSnapshot[relpath])
+                        for relpath in level}
+            fileIds.update(levelIds)
+            priorLocations.update(self.dataStore.read_locations_by_file_id(self.sync, levelIds.values()))
+            level = [child for relpath, fileId in levelIds.items()
+                     if str(fileId) in priorLocations for child in missingChildren.get(relpath, ())]
+        return fileIds, priorLocations
+
+    def _find_snapshot_relpath(self, relpath, moves, movedTo):
+        """ key of the folderOut entry at relpath in the snapshots taken before this plan's moves, or None """
+        if not(movedTo):
+            return relpath
+        snapshotRelpath = _remap_relpath(relpath, movedTo)
+        # not if that entry was moved on elsewhere (or an ancestor of it was)
+        return snapshotRelpath if _remap_relpath(snapshotRelpath, moves) == relpath else None
 
     # Handlers
     # =================================================================
@@ -312,20 +3823,30 @@ class FolderSync:
     # Infile handler
     # ==================================
 
-    def handle_inFile(self, inFilepath):
-        """ handles each file in the src directory to decide on creates/updates """
+    @_timed
+    def handle_inFile(self, inFilepath, inStat=None, priorLocations=None):
+        """
+        handles each file in the src directory to decide on creates/updates.
+        inStat and priorLocations ({str(file id): Location}, see read_locations_by_file_id) may be read
+        ahead for a batch of files, a file id missing from priorLocations is not tracked.
+        """
         # build vars
         outFilepath = self._build_sync_filepath(self.folderIn, self.folderOut, inFilepath)
 
         # update file
-        if os.path.exists(inFilepath) and os.path.exists(outFilepath):
-            self.update_file(inFilepath, outFilepath)
+        if os.path.exists(inFilepath) and self._out_exists(outFilepath):
+            self.update_file(inFilepath, outFilepath, inStat)
 
         # create or move file/files
-        if not(os.path.exists(outFilepath)):
+        if not(self._out_exists(outFilepath)):
 
-            location = Location(self.sync, inFilepath, get_file_id(inFilepath))
-            priorLocation = self.dataStore.read_location(self.sync, get_file_id(inFilepath))
+            inStat = inStat if inStat else self._stat(inFilepath)
+            fileId = self.fileIdProvider.get_file_id(inFilepath, inStat)
+            location = Location(self.sync, inFilepath, fileId, inStat)
+            if priorLocations is None:
+                priorLocation = self.dataStore.read_location(self.sync, fileId)
+            else:
+                priorLocation = priorLocations.get(str(fileId))
 
             if priorLocation:
                 # move file/files
@@ -337,58 +3858,244 @@ class FolderSync:
     # Helpers
     # ==================
 
-    def update_file(self, inFilepath, outFilepath):
-        # if modified times don't match, rectify
-        if os.stat(inFilepath).st_mtime != os.stat(outFilepath).st_mtime:
-            if os.path.isdir(outFilepath):
-                shutil.copystat(inFilepath, outFilepath)
+    @_timed
+    def update_file(self, inFilepath, outFilepath, inStat=None, outStat=None):
+        """ returns {copy mechanism: files} of the data copied """
+        relpath = self._build_relpath(self.folderOut, outFilepath)
+        inStat = inStat if inStat else self._stat(inFilepath)
+        outStat = outStat if outStat else self._stat_out(relpath)
+        copyBackends = Counter()
+        fileHash = None
+        # if modified times (or sizes) don't match, rectify
+        if self._is_modified(inStat, outStat):
+            if outStat is not None and stat.S_ISDIR(outStat.st_mode):
+                self.storage.set_stat(relpath, inFilepath)
             else:
-                shutil.copy2(inFilepath, outFilepath)
+                if self.contentHash:
+                    fileHash = self._content_hash(inFilepath, inStat)
+                if self.packStore and not(os.path.lexists(outFilepath)):
+                    # packed copy, replaced by a new one (or a plain file once it outgrew packing)
+                    copyBackends[self._copy_new_file(inFilepath, outFilepath, fileHash)] += 1
+                elif self._is_copied(relpath, inFilepath):
+                    # copied since it was planned (interrupted earlier run, fan-out)
+                    copyBackends['resumed'] += 1
+                elif self._localOut and self._stat(outFilepath).st_nlink > 1:
+                    # deduped copy or snapshot link, break the link instead of writing (or copystat) through it
+                    os.unlink(outFilepath)
+                    copyBackends[self._copy_new_file(inFilepath, outFilepath, fileHash)] += 1
+                elif fileHash and self._is_synced_content(inFilepath, relpath, inStat, fileHash):
+                    # only touched, same bytes as the synced copy
+                    self.storage.set_stat(relpath, inFilepath)
+                    copyBackends['metadata'] += 1
+                elif self.deltaMinSize is not None and inStat.st_size >= self.deltaMinSize:
+                    self._delta_update_file(inFilepath, outFilepath)
+                    copyBackends['delta'] += 1
+                else:
+                    copyBackends[self._copy_new_file(inFilepath, outFilepath, fileHash)] += 1
+            # track update in db
+            self._track_file(inFilepath, inStat, fileHash)
+        return dict(copyBackends)
+
+    def _is_synced_content(self, inFilepath, relpath, inStat, fileHash):
+        priorLocation = self.dataStore.read_location_by_path(Location(self.sync, inFilepath))
+        return (priorLocation is not None and priorLocation.get_folderInHash() == fileHash and
+                self._stat_out(relpath).st_size == inStat.st_size)
 
+    def _copy_new_file(self, inFilepath, outFilepath, fileHash=None):
+        """ copies inFilepath, or links a folderOut file with the same content when deduping """
+        self._throttle_op()
+        relpath = self._build_relpath(self.folderOut, outFilepath)
+        if self.packStore:
+            inStat = self._stat(inFilepath)
+            if stat.S_ISREG(inStat.st_mode) and inStat.st_size < self.packMaxFileSize:
+                self.packStore.put(relpath, inFilepath, inStat)
+                if os.path.lexists(outFilepath):
+                    # was a plain file
+                    os.remove(outFilepath)
+                self.metrics.add('bytesCopied', inStat.st_size)
+                return 'packed'
+            self.packStore.remove(relpath)
+        if self.dedupe and fileHash:
+            duplicateFilepath = self._find_duplicate(inFilepath, fileHash)
+            if duplicateFilepath:
+                # written next to outFilepath and renamed over it, so folderOut never holds a partial copy
+                tmpFilepath = _get_temp_filepath(outFilepath)
+                backend = self._link_duplicate(inFilepath, duplicateFilepath, tmpFilepath)
+                os.replace(tmpFilepath, outFilepath)
+                return backend
+        backend = self.storage.put(relpath, inFilepath)
+        self.metrics.add('bytesCopied', self._stat_out(relpath).st_size)
+        return backend
+
+    def _find_duplicate(self, inFilepath, fileHash):
+        """
+        folderOut copy of a tracked file with the same content, preferably one with the mtime and mode
+        of inFilepath (see _link_duplicate)
+        """
+        inStat = self._stat(inFilepath)
+        found = None
+        for location in self.dataStore.read_locations_by_hash(self.sync, fileHash, inStat.st_size):
+            if location.get_folderInLocation() == inFilepath:
+                continue
+            duplicateFilepath = self._build_sync_filepath(self.folderIn, self.folderOut, location.get_folderInLocation())
+            try:
+                duplicateStat = self._stat(duplicateFilepath)
+            except OSError:
+                continue
+            if not(stat.S_ISREG(duplicateStat.st_mode)) or duplicateStat.st_size != inStat.st_size:
+                continue
+            if (duplicateStat.st_mtime, duplicateStat.st_mode) == (inStat.st_mtime, inStat.st_mode):
+                return duplicateFilepath
+            found = found if found else duplicateFilepath
+        return found
+
+    def _link_duplicate(self, inFilepath, duplicateFilepath, outFilepath):
+        """
+        reflinks duplicateFilepath to outFilepath. Hard links share their stat, so they are only
+        used when the duplicate already has the mtime and mode of inFilepath, otherwise it is copied.
+        """
+        if fcntl is not None:
+            try:
+                with open(duplicateFilepath, 'rb') as ifp, open(outFilepath, 'wb') as ofp:
+                    fcntl.ioctl(ofp.fileno(), FICLONE, ifp.fileno())
+                shutil.copystat(inFilepath, outFilepath)
+                return KernelFileCopier.REFLINK
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+                os.remove(outFilepath)
+        inStat = self._stat(inFilepath)
+        duplicateStat = self._stat(duplicateFilepath)
+        if (inStat.st_mtime, inStat.st_mode) == (duplicateStat.st_mtime, duplicateStat.st_mode):
+            if os.path.lexists(outFilepath):
+                os.remove(outFilepath)
+            os.link(duplicateFilepath, outFilepath)
+            return 'hardlink'
+        backend = self.fileCopier.copy(duplicateFilepath, outFilepath)
+        shutil.copystat(inFilepath, outFilepath)
+        return backend
+
+    def _delta_update_file(self, inFilepath, outFilepath):
+        # rewrite only the changed blocks, re-using the signatures cached for the folderOut copy
+        location = Location(self.sync, inFilepath)
+        signatures = self.dataStore.read_signatures(location, self._stat(outFilepath), self.deltaBlockSize)
+        signatures, bytesWritten = delta_copy(inFilepath, outFilepath, self.deltaBlockSize, signatures)
+        self.metrics.add('bytesCopied', bytesWritten)
+        shutil.copystat(inFilepath, outFilepath)
+        self.dataStore.save_signatures(location, self._stat(outFilepath), self.deltaBlockSize, signatures)
+
+    @_timed
     def create_file(self, inFilepath, outFilepath, location):
+        """ returns {copy mechanism: files} of the data copied """
+        copyBackends = Counter()
+        fileHashes = {}
+        inStats = {}  # of the files under a created dir, from its walk
+
+        def copy_function(src, dst):
+            if self.storage.is_copied(self._build_relpath(self.folderOut, dst), src):
+                # finished by an interrupted earlier run
+                copyBackends['resumed'] += 1
+            else:
+                inStat = inStats.get(src)
+                inStat = inStat if inStat else self._stat(src)
+                if (self.dedupe and src not in fileHashes and
+                        self.dataStore.has_hashed_location(self.sync, inStat.st_size)):
+                    # hashed before the copy only if a tracked file of that size may hold the same bytes
+                    fileHashes[src] = hash_file(src)
+                copyBackends[self._copy_new_file(src, dst, fileHashes.get(src))] += 1
+            if self.contentHash and src not in fileHashes:
+                # for the index, the copy left the file in the page cache
+                fileHashes[src] = hash_file(src)
+
         # make parent if not exists (only should happen if user edits while running)
-        make_parent_if_not_exists(outFilepath)
+        relpath = self._build_relpath(self.folderOut, outFilepath)
+        self.storage.make_dirs(os.path.dirname(relpath))
         # make file
         if os.path.isdir(inFilepath):
+            # stat descendants before the copy, edits made during it are picked up next cycle
+            descendants = list(scan_tree(self.folderIn, self._build_relpath(self.folderIn, inFilepath),
+                                         self.syncFilter))
+            inStats.update((os.path.join(self.folderIn, relpath), statResult) for relpath, statResult in descendants)
+            ignore = None
+            if self.syncFilter:
+                # copytree asks per dir for the names to skip, everything the filtered walk did not yield
+                included = set(os.path.join(self.folderIn, relpath) for relpath, _ in descendants)
+                ignore = lambda src, names: [name for name in names if os.path.join(src, name) not in included]
             # cp
-            shutil.copytree(inFilepath, outFilepath)
+            if self._localOut:
+                shutil.copytree(inFilepath, outFilepath, copy_function=copy_function, ignore=ignore,
+                                dirs_exist_ok=True)
+            else:
+                self._put_tree(relpath, descendants, copy_function)
             # track create in db
-            self.dataStore.create_location(location)
-            for fileLoc in get_descedents(inFilepath):
-                self.dataStore.create_location(Location(self.sync, fileLoc, get_file_id(fileLoc)))
+            self.dataStore.begin_batch()
+            try:
+                self.dataStore.create_location(location)
+                for relpath, statResult in descendants:
+                    fileLoc = os.path.join(self.folderIn, relpath)
+                    fileId = self.fileIdProvider.get_file_id(fileLoc, statResult)
+                    self.dataStore.create_location(Location(self.sync, fileLoc, fileId, statResult,
+                                                            fileHashes.get(fileLoc)))
+            finally:
+                self.dataStore.end_batch()
         else:
+            if self.contentHash and location.get_folderInStat() is not None:
+                # re-created at a path whose index entry still has its size and mtime
+                indexedHash = self._indexed_hash(inFilepath, location.get_folderInStat())
+                if indexedHash:
+                    fileHashes[inFilepath] = indexedHash
             # cp
-            shutil.copy2(inFilepath, outFilepath)
+            copy_function(inFilepath, outFilepath)
             # track create in db
-            self.dataStore.create_location(location)
+            self.dataStore.create_location(Location(self.sync, location.get_folderInLocation(),
+                                                    location.get_folderInId(), location.get_folderInStat(),
+                                                    fileHashes.get(inFilepath)))
+        return dict(copyBackends)
+
+    def _put_tree(self, relpath, descendants, copy_function):
+        """ copytree for a folderOut that is not a local dir, descendants are the (relpath, stat) under relpath """
+        self.storage.make_dirs(relpath)
+        dirRelpaths = [relpath]
+        for childRelpath, inStat in descendants:
+            if stat.S_ISDIR(inStat.st_mode):
+                self.storage.make_dirs(childRelpath)
+                dirRelpaths.append(childRelpath)
+            else:
+                copy_function(self._build_in_filepath(childRelpath), self._build_out_filepath(childRelpath))
+        # dir stats last, like copytree
+        for dirRelpath in reversed(dirRelpaths):
+            self.storage.set_stat(dirRelpath, self._build_in_filepath(dirRelpath))
 
-    def move_file(self, inFilepath, outFilepath, location, priorLocation):
+    @_timed
+    def move_file(self, inFilepath, outFilepath, location, priorLocation, oldOutfile=None):
         # map old inFileLocation to old outFileLocation
-        oldOutfile = self._build_sync_filepath(self.folderIn, self.folderOut, priorLocation.get_folderInLocation())
-        if os.path.exists(oldOutfile):
+        if not(oldOutfile):
+            oldOutfile = self._build_sync_filepath(self.folderIn, self.folderOut, priorLocation.get_folderInLocation())
+        relpath = self._build_relpath(self.folderOut, outFilepath)
+        oldRelpath = self._build_relpath(self.folderOut, oldOutfile)
+        if oldRelpath == relpath:
+            # already there (a stale existence check took it for a move)
+            return
+        if self.storage.exists(oldRelpath):
             # make parent if not exists (only should happen if user edits while running)
-            make_parent_if_not_exists(outFilepath)
+            self.storage.make_dirs(os.path.dirname(relpath))
             # move old outFile to new outfile
-            shutil.move(oldOutfile, outFilepath)
-            # track move in db
-            oldLocation = Location(self.sync, self._build_sync_filepath(self.folderOut, self.folderIn, oldOutfile))
-            self.dataStore.update_location(oldLocation, location)
-            if os.path.isdir(inFilepath):
-                # track move in all descendents in db
-                for newfileLoc in get_descedents(inFilepath):
-                    priorLocation = self.dataStore.read_location(self.sync, get_file_id(newfileLoc))
-                    if priorLocation:
-                        oldOutfile = self._build_sync_filepath(self.folderIn,
-                                                               self.folderOut,
-                                                               priorLocation.get_folderInLocation())
-                        oldLocation = Location(self.sync, self._build_sync_filepath(self.folderOut,
-                                                                                    self.folderIn,
-                                                                                    oldOutfile))
-                        self.dataStore.update_location(oldLocation, location)
+            self._throttle_op()
+            self.storage.move(oldRelpath, relpath)
+        elif not(self.storage.exists(relpath)) and not(self._is_packed(oldOutfile)):
+            return
+        # track move in db (a packed copy moves with it) (also when only the db missed an earlier, interrupted move)
+        oldLocation = Location(self.sync, self._build_sync_filepath(self.folderOut, self.folderIn, oldOutfile))
+        self.dataStore.update_location(oldLocation, location)
+        outStat = self._stat_out(relpath)
+        if outStat is not None and stat.S_ISDIR(outStat.st_mode):
+            # track move in all descendents in db
+            self.dataStore.move_location_subtree(oldLocation, location)
 
     # Outfile handler
     # ==================================
 
+    @_timed
     def handle_outFile(self, outFilepath):
         """ handles each file in the output directory to decide on deletes """
         # build vars
@@ -396,35 +4103,38 @@ class FolderSync:
         oldLocation = Location(self.sync, self._build_sync_filepath(self.folderOut, self.folderIn, outFilepath))
 
         # delete file/files
-        if not(os.path.exists(inFilepath)) and os.path.exists(outFilepath):
+        if not(os.path.exists(inFilepath)) and self._out_exists(outFilepath):
             self.delete_file(inFilepath, outFilepath, oldLocation)
 
     # Helpers
     # ==================
 
+    @_timed
     def delete_file(self, inFilepath, outFilepath, oldLocation):
         # only continue if it is in the waitlist (to avoid situation of move after handle_infile)
         if not(self.deleteWaitlist) or outFilepath in self.waitForDelete:
-            # rm curr from waitlist
+            # rm curr and all descendents from waitlist
             if self.deleteWaitlist:
-                self.waitForDelete.remove(outFilepath)
-
-            if os.path.isdir(outFilepath):
-                # rm all descendents from waitlist
-                if self.deleteWaitlist:
-                    for fileLoc in get_descedents(outFilepath):
-                        if fileLoc in self.waitForDelete:
-                            self.waitForDelete.remove(fileLoc)
-                # rm
-                shutil.rmtree(outFilepath)
+                self.waitForDelete.discard_subtree(outFilepath)
+
+            relpath = self._build_relpath(self.folderOut, outFilepath)
+            outStat = self._stat_out(relpath)
+            if outStat is None:
+                # packed copy, compact() reclaims its bytes
+                if self.packStore:
+                    self.packStore.remove(relpath)
+                # track rm in db
+                self.dataStore.remove_location(oldLocation)
+            elif stat.S_ISDIR(outStat.st_mode):
+                # rm (the local backend paces subtree deletes itself)
+                self.storage.delete([relpath])
                 # track rm in db
                 self.dataStore.remove_location(oldLocation)
-                for oldfileLoc in get_descedents(inFilepath):
-                    oldLocation = Location(self.sync, self._build_sync_filepath(self.folderOut, self.folderIn, oldfileLoc))
-                    self.dataStore.remove_location(oldLocation)
+                self.dataStore.remove_location_subtree(oldLocation)
             else:
                 # rm
-                os.remove(outFilepath)
+                self._throttle_op()
+                self.storage.delete([relpath])
                 # track rm in db
                 self.dataStore.remove_location(oldLocation)
         else:
@@ -435,11 +4145,552 @@ class FolderSync:
     # Utilities
     # =================================================================
 
+    def _throttle_op(self):
+        if self.rateLimiter:
+            self.rateLimiter.acquire_op()
+
+    def _count_stats(self, count=1):
+        self.metrics.add('statsIssued', count)
+
+    def _stat(self, filepath):
+        """ os.stat, counted in the cycle's statsIssued """
+        self._count_stats()
+        return os.stat(filepath)
+
+    def _stat_out(self, relpath):
+        """ storage.stat, counted in the cycle's statsIssued """
+        self._count_stats()
+        return self.storage.stat(relpath)
+
+    def _is_copied(self, relpath, inFilepath):
+        # a stat of each side
+        self._count_stats(2)
+        return self.storage.is_copied(relpath, inFilepath)
+
+    def _out_exists(self, outFilepath):
+        """ whether folderOut has a copy at outFilepath, packed copies included """
+        return self.storage.exists(self._build_relpath(self.folderOut, outFilepath)) or self._is_packed(outFilepath)
+
+    def _is_packed(self, outFilepath):
+        return bool(self.packStore) and self.packStore.is_packed(self._build_relpath(self.folderOut, outFilepath))
+
     def _build_sync_filepath(self, rootDirIn, rootDirOut, filepathIn):
         """ takes filepath, and re-builds it under rootDirOut """
-        relativePathIn = filepathIn.split(rootDirIn, 1)[1]
-        filepathOut = rootDirOut + relativePathIn
-        return filepathOut
+        relpath = _relative_to(rootDirIn, filepathIn)
+        return os.path.join(rootDirOut, relpath) if relpath else rootDirOut
+
+    def _build_relpath(self, rootDir, filepath):
+        """ snapshot key of filepath under rootDir """
+        return _relative_to(rootDir, filepath)
+
+    def _build_in_filepath(self, relpath):
+        return os.path.join(self.folderIn, relpath)
+
+    def _build_out_filepath(self, relpath):
+        return os.path.join(self.folderOut, relpath)
 
     def _check_sync_integrety(self):
-        return os.path.exists(self.folderIn) and os.path.exists(self.folderOut)
\ No newline at end of file
+        return os.path.exists(self.folderIn) and self.storage.exists()
+
+
+# Fan-out
+# ================================================================
+
+
+class FanOutSync:
+    """
+    Mirrors one folderIn to several folderOuts. Every destination is a FolderSync with a sync of its own
+    (its own locations, journal and index, so each one plans against its own state), but the reads
+    of folderIn are shared: it is walked once per cycle, and a file more than one destination copies
+    is read once with each chunk written to all of them (see fan_out_copy). A destination that fails
+    only fails its own operations, the others carry on.
+    """
+
+    def __init__(self, folderIn, folderOuts, frequency=2, dataStore=None, bufferSize=1024 * 1024, **folderSyncArgs):
+        self.frequency = frequency
+        self.bufferSize = bufferSize
+        dataStore = dataStore if dataStore else DataStore(DatabaseConnector())
+        workers = folderSyncArgs.get('workers', 1)
+        if workers > 1:
+            # one db writer and one transfer pool for all destinations
+            if not(isinstance(dataStore, DataStoreWriter)):
+                dataStore = DataStoreWriter(dataStore)
+            if not(folderSyncArgs.get('planExecutor')):
+                folderSyncArgs['planExecutor'] = PlanExecutor(workers, folderSyncArgs.get('maxInFlightBytes',
+                                                                                          256 * 1024 * 1024))
+        self.folderSyncs = [FolderSync(folderIn, folderOut, frequency=None, dataStore=dataStore, **folderSyncArgs)
+                            for folderOut in folderOuts]
+        self.folderIn = self.folderSyncs[0].folderIn
+
+    # Main Loop
+    # =================================================================
+
+    def run(self):
+
+        # register the syncs (existing ones keep their locations)
+        for folderSync in self.folderSyncs:
+            folderSync.dataStore.create_sync(folderSync.sync)
+
+        # run forever, while folderIn exists
+        run_cycles(self._run_if_present, self.frequency)
+
+    def sync_once(self):
+        """
+        one cycle of every destination, returns {folderOut: SyncResult}. The steps are those of
+        FolderSync.sync_cycle, run in lockstep so the destinations share the walk and the copies.
+        """
+        results = {}
+        planned = []  # (folderSync, fullScan, plan)
+        for folderSync in self.folderSyncs:
+            if not(folderSync._check_sync_integrety()):
+                results[folderSync.folderOut] = SyncResult(SyncPlan(), 0, False)
+                continue
+            result = self._isolated(folderSync, folderSync._resume_once)
+            if result:
+                results[folderSync.folderOut] = result
+                continue
+            planned.append((folderSync, None, None))
+        if not(planned):
+            return results
+
+        # one walk of folderIn, planned against each destination
+        inSnapshot = dict(planned[0][0]._scan(self.folderIn))
+        # its stats are counted once, by the first destination
+        planned[0][0]._count_stats(len(inSnapshot))
+        for index, (folderSync, _, _) in enumerate(planned):
+            fullScan = folderSync._begin_cycle()
+            plan = self._isolated(folderSync, folderSync.plan_sync, fullScan, inSnapshot)
+            planned[index] = (folderSync, fullScan, plan)
+
+        # the copies shared by several destinations first, their handlers then find them done
+        try:
+            self._fan_out([entry for entry in planned if entry[2] is not None], inSnapshot)
+        except Exception:
+            print("failed to fan out folderIn:" + self.folderIn)
+            traceback.print_exc()
+
+        for folderSync, fullScan, plan in planned:
+            failures = 1
+            if plan is not None:
+                failures = self._isolated(folderSync, folderSync.execute_plan, plan)
+                failures = len(plan) if failures is None else failures
+            plan = plan if plan is not None else SyncPlan()
+            result = self._isolated(folderSync, folderSync._finish_cycle, fullScan, plan, failures)
+            results[folderSync.folderOut] = result if result else SyncResult(plan, failures, fullScan)
+        return results
+
+    def _run_if_present(self):
+        if os.path.exists(self.folderIn):
+            self.sync_once()
+
+    def _isolated(self, folderSync, function, *args):
+        """ function(*args), None if it failed: one destination failing must not stop the others """
+        try:
+            return function(*args)
+        except Exception:
+            folderSync.metrics.add('errors.cycle')
+            print("failed to sync folderOut:" + folderSync.folderOut)
+            traceback.print_exc()
+            return None
+
+    def _fan_out(self, planned, inSnapshot):
+        """ copies the files several destinations are about to create or rewrite, with one read each """
+        destinations = {}  # relpath -> [folderSync]
+        for folderSync, _, plan in planned:
+            for relpath in self._copied_relpaths(folderSync, plan, inSnapshot):
+                destinations.setdefault(relpath, []).append(folderSync)
+        for relpath, folderSyncs in destinations.items():
+            if len(folderSyncs) < 2:
+                # a single destination copies it as usual
+                continue
+            outFilepaths = {folderSync._build_out_filepath(relpath): folderSync for folderSync in folderSyncs}
+            try:
+                copied = fan_out_copy(folderSyncs[0]._build_in_filepath(relpath), list(outFilepaths),
+                                      self.bufferSize)
+            except OSError:
+                # the handlers of each destination will retry it
+                traceback.print_exc()
+                continue
+            for outFilepath in copied:
+                outFilepaths[outFilepath].metrics.add('bytesCopied', inSnapshot[relpath].st_size)
+
+    def _copied_relpaths(self, folderSync, plan, inSnapshot):
+        """ files the plan copies whole: created files, files of created dirs and rewritten files """
+        if folderSync.dedupe or folderSync.rateLimiter or folderSync.packStore or not(folderSync._localOut):
+            # links duplicates / paces copies / packs small files / uploads on its own
+            return []
+        relpaths = []
+        createdDirs = set()
+        movedPrefixes = []  # moved paths, their destinations are only ready once the move ran
+        for operation in plan:
+            if operation.get_action() == SyncOperation.MOVE:
+                movedPrefixes.extend((operation.get_relpath(), operation.get_oldRelpath()))
+        for operation in plan:
+            action = operation.get_action()
+            inStat = operation.get_inStat()
+            if action == SyncOperation.CREATE and stat.S_ISDIR(inStat.st_mode):
+                createdDirs.add(operation.get_relpath())
+            elif action == SyncOperation.CREATE and stat.S_ISREG(inStat.st_mode):
+                relpaths.append(operation.get_relpath())
+            elif (action == SyncOperation.UPDATE and stat.S_ISREG(inStat.st_mode) and not(folderSync.contentHash)
+                    and (folderSync.deltaMinSize is None or inStat.st_size < folderSync.deltaMinSize)):
+                relpaths.append(operation.get_relpath())
+        if createdDirs:
+            for relpath, inStat in inSnapshot.items():
+                if stat.S_ISREG(inStat.st_mode) and self._is_under(relpath, createdDirs):
+                    relpaths.append(relpath)
+        return [relpath for relpath in relpaths
+                if not(any(relpath == prefix or relpath.startswith(prefix + os.sep) for prefix in movedPrefixes))]
+
+    def _is_under(self, relpath, dirRelpaths):
+        parent = os.path.dirname(relpath)
+        while parent:
+            if parent in dirRelpaths:
+                return True
+            parent = os.path.dirname(parent)
+        return False
+
+
+# Snapshots
+# ================================================================
+
+
+class SnapshotSync:
+    """
+    Keeps point-in-time generations of folderIn under snapshotsDir instead of a single mirror.
+    A cycle links the latest generation into a work dir (PARTIAL_DIRNAME: dirs made, files hard linked
+    or reflinked, in parallel batches), syncs folderIn into it and renames it to a dated generation,
+    so a generation costs a metadata pass plus the changed bytes. Changed files replace their link
+    (see update_file) and never write through it into older generations.
+    The work dir is the folderOut of one FolderSync, its index and move tracking carry across
+    generations, and a cycle that failed leaves it in place to be finished by the next one.
+    Generations beyond the retention (keepLast newest, plus the newest of each of the last keepDaily
+    days and keepWeekly weeks) are pruned.
+    """
+
+    PARTIAL_DIRNAME = '.partial'
+    GENERATION_FORMAT = '%Y-%m-%dT%H%M%S'
+    GENERATION_REGEX = re.compile(r'\d{4}-\d{2}-\d{2}T\d{6}(?:-\d+)?')
+    HARDLINK = 'hardlink'
+    REFLINK = 'reflink'
+
+    def __init__(self, folderIn, snapshotsDir, frequency=2, keepLast=10, keepDaily=7, keepWeekly=4,
+                 linkMode=HARDLINK, linkWorkers=8, linkBatchSize=1000, **folderSyncArgs):
+        self.frequency = frequency
+        self.snapshotsDir = EXT_PATH + snapshotsDir
+        self.keepLast = keepLast
+        self.keepDaily = keepDaily
+        self.keepWeekly = keepWeekly
+        self.linkMode = linkMode
+        self.linkWorkers = linkWorkers
+        self.linkBatchSize = linkBatchSize
+        # a delete waitlist would carry deleted files into one more generation
+        folderSyncArgs.setdefault('deleteWaitlist', False)
+        self.folderSync = FolderSync(folderIn, os.path.join(snapshotsDir, SnapshotSync.PARTIAL_DIRNAME),
+                                     frequency=None, **folderSyncArgs)
+
+    # Main Loop
+    # =================================================================
+
+    def run(self):
+
+        # register the sync (an existing one keeps its locations)
+        self.folderSync.dataStore.create_sync(self.folderSync.sync)
+
+        # run forever, while folderIn exists
+        run_cycles(self._run_if_present, self.frequency)
+
+    def sync_once(self):
+        """ takes one generation, returns the SyncResult of its cycle """
+        folderSync = self.folderSync
+        partialDir = folderSync.folderOut
+        if not(os.path.exists(partialDir)):
+            generations = self.get_generations()
+            if generations:
+                self.link_generation(os.path.join(self.snapshotsDir, generations[-1]), partialDir)
+            else:
+                os.makedirs(partialDir)
+        # an interrupted cycle's plan is finished first, the generation still gets a cycle of its own
+        folderSync._resume_once()
+        result = folderSync.sync_cycle()
+        if not(result.get_failures()):
+            os.replace(partialDir, os.path.join(self.snapshotsDir, self._new_generation_name()))
+            self.prune()
+        return result
+
+    # Generations
+    # =================================================================
+
+    def get_generations(self):
+        """ names of the complete generations, oldest first """
+        try:
+            names = os.listdir(self.snapshotsDir)
+        except OSError:
+            return []
+        return sorted(name for name in names if SnapshotSync.GENERATION_REGEX.fullmatch(name))
+
+    def link_generation(self, generationDir, targetDir):
+        """ re-creates generationDir at targetDir with links to its files, returns the files linked """
+        os.makedirs(targetDir)
+        dirs = ['']
+        batch = []
+        pending = []
+        with ThreadPoolExecutor(max_workers=self.linkWorkers, thread_name_prefix='pyFolderSync-link') as pool:
+            # dirs are made in walk order, so a batch only holds files whose dir exists
+            for relpath, statResult in scan_tree(generationDir):
+                if stat.S_ISDIR(statResult.st_mode) and not(os.path.islink(os.path.join(generationDir, relpath))):
+                    os.mkdir(os.path.join(targetDir, relpath))
+                    dirs.append(relpath)
+                    continue
+                batch.append(relpath)
+                if len(batch) >= self.linkBatchSize:
+                    pending.append(pool.submit(self._link_batch, generationDir, targetDir, batch))
+                    batch = []
+            if batch:
+                pending.append(pool.submit(self._link_batch, generationDir, targetDir, batch))
+            linked = sum(future.result() for future in pending)
+        # dir stats last, adding their children bumped their mtimes
+        for relDir in reversed(dirs):
+            shutil.copystat(os.path.join(generationDir, relDir) if relDir else generationDir,
+                            os.path.join(targetDir, relDir) if relDir else targetDir)
+        return linked
+
+    def prune(self):
+        """ removes the generations the retention does not keep, returns their names """
+        generations = self.get_generations()
+        # the latest generation is kept whatever the retention, the next cycle links from it
+        keep = set(generations[-max(self.keepLast, 1):])
+        for period, count in ((lambda date: date.date(), self.keepDaily),
+                              (lambda date: date.isocalendar()[:2], self.keepWeekly)):
+            periods = set()
+            for name in reversed(generations):
+                key = period(self._get_generation_date(name))
+                if len(periods) >= count:
+                    break
+                if key not in periods:
+                    periods.add(key)
+                    keep.add(name)
+        removed = [name for name in generations if name not in keep]
+        for name in removed:
+            shutil.rmtree(os.path.join(self.snapshotsDir, name))
+        return removed
+
+    def _run_if_present(self):
+        if os.path.exists(self.folderSync.folderIn):
+            self.sync_once()
+
+    def _link_batch(self, generationDir, targetDir, relpaths):
+        for relpath in relpaths:
+            self._link_file(os.path.join(generationDir, relpath), os.path.join(targetDir, relpath))
+        return len(relpaths)
+
+    def _link_file(self, filepath, linkFilepath):
+        if self.linkMode == SnapshotSync.REFLINK and fcntl is not None and not(os.path.islink(filepath)):
+            try:
+                with open(filepath, 'rb') as ifp, open(linkFilepath, 'wb') as ofp:
+                    fcntl.ioctl(ofp.fileno(), FICLONE, ifp.fileno())
+                shutil.copystat(filepath, linkFilepath)
+                return
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+                os.remove(linkFilepath)
+        os.link(filepath, linkFilepath, follow_symlinks=False)
+
+    def _new_generation_name(self):
+        name = datetime.now().strftime(SnapshotSync.GENERATION_FORMAT)
+        suffix = 1
+        generationName = name
+        while os.path.exists(os.path.join(self.snapshotsDir, generationName)):
+            generationName = '{}-{}'.format(name, suffix)
+            suffix += 1
+        return generationName
+
+    def _get_generation_date(self, name):
+        return datetime.strptime(name[:17], SnapshotSync.GENERATION_FORMAT)
+
+
+# Supervisor
+# ================================================================
+
+
+class SupervisedSync:
+    """ scheduling state of one FolderSync in a SyncSupervisor """
+
+    def __init__(self, folderSync, frequency, priority, nextRun):
+        self.folderSync = folderSync
+        self.frequency = frequency
+        self.priority = priority
+        self.nextRun = nextRun
+        self.busyTime = 0.0  # seconds spent in cycles, weighs fairness
+        self.running = False
+
+    def get_share(self):
+        """ busy time per unit of priority, the least served sync runs first """
+        return self.busyTime / self.priority
+
+
+class SyncSupervisor:
+    """
+    Runs many syncs in one process.
+    At most maxConcurrentCycles cycles run at once, on a pool of that many threads: of those maxConcurrentScans
+    cap the walks/diffs planning at once, the transfers (hashing and delta signatures included) run on one
+    shared PlanExecutor (workers and maxInFlightBytes are global budgets). Every db call goes through one
+    DataStoreWriter thread, each sync with a DataStore (and so a write batch) of its own, so a failing sync
+    never rolls back the bookkeeping of another.
+    Due syncs start by lowest busy time per priority whenever a cycle slot frees up, first runs are staggered
+    over each frequency.
+    """
+
+    def __init__(self, dbConn=None, workers=4, maxConcurrentScans=2, maxInFlightBytes=256 * 1024 * 1024,
+                 scanWorkers=1, maxConcurrentCycles=4):
+        self.dbConn = dbConn if dbConn else DatabaseConnector()
+        self.dataStore = DataStoreWriter(DataStore(self.dbConn))
+        self.planExecutor = PlanExecutor(workers, maxInFlightBytes)
+        # dir listings of every sync on one pool (see ParallelScanner)
+        self.scanner = ParallelScanner(scanWorkers) if scanWorkers > 1 else None
+        self.maxConcurrentScans = maxConcurrentScans
+        self.maxConcurrentCycles = maxConcurrentCycles
+        self._scanSlots = threading.BoundedSemaphore(maxConcurrentScans)
+        self._supervised = []
+
+    def add_sync(self, folderIn, folderOut, frequency=2, priority=1, **folderSyncArgs):
+        """ frequency (seconds) between cycles of this sync, None runs it once """
+        folderSync = FolderSync(folderIn, folderOut, frequency=frequency,
+                                dataStore=self.dataStore.for_store(DataStore(self.dbConn)),
+                                planExecutor=self.planExecutor, scanner=self.scanner, **folderSyncArgs)
+        self._supervised.append(SupervisedSync(folderSync, frequency, priority, None))
+        return folderSync
+
+    def load_syncs(self, frequency=2, priority=1, **folderSyncArgs):
+        """ adds every sync stored in the db """
+        for sync in self.dataStore.read_syncs():
+            self.add_sync(self._strip_ext_path(sync.get_folderIn()),
+                          self._strip_ext_path(sync.get_folderOut()),
+                          frequency, priority, **folderSyncArgs)
+
+    def run(self, stopEvent=None):
+        """ runs until stopEvent is set, or until every sync ran once if none has a frequency """
+        now = time.monotonic()
+        for index, supervised in enumerate(self._supervised):
+            # store the sync, its locations are kept
+            supervised.folderSync.dataStore.create_sync(supervised.folderSync.sync)
+            # stagger first runs so the syncs don't all walk at the same second
+            supervised.nextRun = now + (supervised.frequency or 0) * index / len(self._supervised)
+
+        # a sync never runs two cycles at once, due ones wait for a free thread
+        with ThreadPoolExecutor(max_workers=self.maxConcurrentCycles,
+                                thread_name_prefix='pyFolderSync-cycle') as cyclePool:
+            running = {}  # future -> SupervisedSync
+            while not(stopEvent and stopEvent.is_set()):
+                pending = [s for s in self._supervised if s.running or s.nextRun is not None]
+                if not(pending):
+                    break
+
+                # start due syncs, least served first, as many as there are free cycle threads
+                now = time.monotonic()
+                due = [s for s in pending if not(s.running) and s.nextRun <= now]
+                due.sort(key=lambda s: (s.get_share(), s.nextRun))
+                for supervised in due[:self.maxConcurrentCycles - len(running)]:
+                    supervised.running = True
+                    running[cyclePool.submit(self._run_cycle, supervised)] = supervised
+
+                # wait for a cycle to finish or, with a thread free, the next sync to be due
+                nextRuns = [s.nextRun for s in pending if not(s.running)] \
+                    if len(running) < self.maxConcurrentCycles else []
+                timeout = min([max(nextRun - now, 0) for nextRun in nextRuns] + [1.0])
+                if running:
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        running.pop(future).running = False
+                else:
+                    time.sleep(timeout)
+            wait(running)
+
+    def _run_cycle(self, supervised):
+        folderSync = supervised.folderSync
+        start = time.monotonic()
+        try:
+            if folderSync._check_sync_integrety():
+                folderSync.sync_cycle(scanSlots=self._scanSlots)
+        except Exception:
+            folderSync.metrics.add('errors.cycle')
+            print("failed to sync folderIn:" + folderSync.folderIn)
+            traceback.print_exc()
+        end = time.monotonic()
+        supervised.busyTime += end - start
+        supervised.nextRun = end + supervised.frequency if supervised.frequency else None
+
+    def _strip_ext_path(self, filepath):
+        return filepath[len(EXT_PATH):] if EXT_PATH and filepath.startswith(EXT_PATH) else filepath
+
+
+# Asyncio
+# ================================================================
+
+
+class AsyncFolderSync:
+    """
+    asyncio front of a FolderSync, for embedding in event-loop services.
+    Cycles (FolderSync.sync_cycle) run on a bounded executor, never on the loop, with their plans executed
+    by a PlanExecutor of workers threads: operations on different subtrees interleave while overlapping
+    ones keep their plan order. Cancelling a cycle stops it between operations.
+    """
+
+    def __init__(self, folderIn, folderOut, frequency=2, workers=4, executor=None, **folderSyncArgs):
+        # the cycle runs on the executor's threads, db calls are funneled to a single writer
+        dataStore = folderSyncArgs.pop('dataStore', None)
+        dataStore = dataStore if dataStore else DataStore(DatabaseConnector())
+        if not(isinstance(dataStore, DataStoreWriter)):
+            dataStore = DataStoreWriter(dataStore)
+        if not(folderSyncArgs.get('planExecutor')) and workers > 1:
+            folderSyncArgs['planExecutor'] = PlanExecutor(workers, folderSyncArgs.get('maxInFlightBytes',
+                                                                                      256 * 1024 * 1024))
+        self.folderSync = FolderSync(folderIn, folderOut, frequency=frequency, dataStore=dataStore, **folderSyncArgs)
+        self.frequency = frequency
+        self.workers = workers
+        self.executor = executor if executor else ThreadPoolExecutor(max_workers=1,
+                                                                     thread_name_prefix='pyFolderSync-async')
+        self._syncCreated = False
+
+    async def sync_once(self):
+        """ one cycle, returns its SyncResult """
+        folderSync = self.folderSync
+        if not(self._syncCreated):
+            # register the sync (an existing one keeps its locations)
+            await self._run(folderSync.dataStore.create_sync, folderSync.sync)
+            self._syncCreated = True
+        if not(await self._run(folderSync._check_sync_integrety)):
+            return SyncResult(SyncPlan(), 0, False)
+        stopEvent = threading.Event()
+        cycle = self._run(folderSync.sync_cycle, None, stopEvent)
+        try:
+            return await asyncio.shield(cycle)
+        except asyncio.CancelledError:
+            # operations already running finish (and their batch is flushed) before the cancel goes through
+            stopEvent.set()
+            await asyncio.wait([cycle])
+            raise
+
+    async def cycles(self):
+        """ SyncResult of each cycle, frequency seconds apart (one cycle if frequency is None) """
+        while True:
+            yield await self.sync_once()
+            if not(self.frequency):
+                return
+            await asyncio.sleep(self.frequency)
+
+    def __aiter__(self):
+        return self.cycles()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
@@ -1,14 +1,73 @@
 CREATE TABLE IF NOT EXISTS sync (
+    id INTEGER PRIMARY KEY,
     folderIn VARCHAR(100),
     folderOut VARCHAR(100),
-    PRIMARY KEY (folderIn, folderOut)
+    UNIQUE (folderIn, folderOut)
+);
+
+-- folderIn dirs holding tracked entries, the sync root is (parent_id 0, name '')
+CREATE TABLE IF NOT EXISTS directory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sync_id INTEGER,
+    parent_id INTEGER,
+    name VARCHAR(100),
+    UNIQUE (sync_id, parent_id, name)
 );
 
 CREATE TABLE IF NOT EXISTS location (
-    folderIn VARCHAR(100),
-    folderOut VARCHAR(100),
-    folderInLocation VARCHAR(100),
-    folderInId VARCHAR(100),
-    FOREIGN KEY(folderIn, folderOut) REFERENCES sync(folderIn, folderOut),
-    PRIMARY KEY (folderIn, folderOut, folderInLocation)
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sync_id INTEGER,
+    parent_id INTEGER,
+    name VARCHAR(100),
+    file_id VARCHAR(100),
+    size INTEGER,
+    mtime REAL,
+    mode INTEGER,
+    hash VARCHAR(64),
+    UNIQUE (sync_id, parent_id, name)
+);
+
+CREATE INDEX IF NOT EXISTS location_file_idx ON location (sync_id, file_id, parent_id, name);
+
+-- dedupe candidates: any hashed file of a size, then the ones of that size and hash
+DROP INDEX IF EXISTS location_hash_idx;
+CREATE INDEX IF NOT EXISTS location_size_idx ON location (sync_id, size, hash);
+
+CREATE TABLE IF NOT EXISTS signature (
+    location_id INTEGER PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    blockSize INTEGER,
+    digests BLOB
 );
+
+CREATE TABLE IF NOT EXISTS journal (
+    sync_id INTEGER,
+    seq INTEGER,
+    action VARCHAR(10),
+    relpath VARCHAR(100),
+    oldRelpath VARCHAR(100),
+    done INTEGER,
+    PRIMARY KEY (sync_id, relpath, action)
+);
+
+-- append-only pack files of small folderOut files (folderOut/.pyfoldersync-packs/<id>.pack)
+CREATE TABLE IF NOT EXISTS pack (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sync_id INTEGER
+);
+
+-- folderOut files stored in a pack, keyed like their location
+CREATE TABLE IF NOT EXISTS packed (
+    sync_id INTEGER,
+    parent_id INTEGER,
+    name VARCHAR(100),
+    pack_id INTEGER,
+    pack_offset INTEGER,
+    size INTEGER,
+    mtime REAL,
+    mode INTEGER,
+    PRIMARY KEY (sync_id, parent_id, name)
+);
+
+CREATE INDEX IF NOT EXISTS packed_pack_idx ON packed (pack_id, pack_offset);
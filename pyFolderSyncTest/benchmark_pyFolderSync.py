@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks FolderSync on generated trees.
+
+    python -m pyFolderSyncTest.benchmark_pyFolderSync --entries 100000 --output bench.json
+    python -m pyFolderSyncTest.benchmark_pyFolderSync --entries 100000 --baseline bench.json
+
+Scenarios: initial sync, no-op resync (with and without listing unchanged dirs), small-delta resync,
+bulk rename, bulk delete.
+Each reports seconds, entries/s, MB/s, the stats the sync issued, read/write syscalls and peak RSS.
+--baseline fails on scenarios that got slower or issued more stats.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from pyFolderSync import pyFolderSync
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+# Utilities
+# =================================================================
+
+# Tree generation
+# ====================
+
+# (weight, size in bytes) choices for generated files
+DEFAULT_FILE_SIZES = [(70, 1024), (25, 64 * 1024), (5, 1024 * 1024)]
+
+
+def generate_tree(path, entries, fanOut=10, depth=3, fileSizes=None, seed=0):
+    """
+    writes a deterministic tree of about `entries` files/dirs under path: `depth` levels of `fanOut` dirs,
+    files spread evenly over the dirs with sizes drawn from fileSizes [(weight, size)]
+    """
+    rand = random.Random(seed)
+    fileSizes = fileSizes if fileSizes else DEFAULT_FILE_SIZES
+    weights = [weight for weight, _ in fileSizes]
+    sizes = [size for _, size in fileSizes]
+
+    dirs = ['']
+    level = ['']
+    for _ in range(depth):
+        level = [os.path.join(parent, 'dir{}'.format(i)) for parent in level for i in range(fanOut)]
+        if len(dirs) + len(level) > entries // 2:
+            break
+        dirs.extend(level)
+    for relDir in dirs:
+        os.makedirs(os.path.join(path, relDir), exist_ok=True)
+
+    blob = rand.randbytes(max(sizes)) if hasattr(rand, 'randbytes') else os.urandom(max(sizes))
+    for i in range(max(entries - len(dirs), 0)):
+        size = rand.choices(sizes, weights)[0]
+        with open(os.path.join(path, dirs[i % len(dirs)], 'file{}.bin'.format(i)), 'wb') as ofp:
+            ofp.write(blob[:size])
+
+
+def _spec_to_files(spec, path):
+    """ jsonToFiles from the tests, kept here so benchmarks do not import the test case """
+    spec = spec if isinstance(spec, list) else [spec]
+    for entry in spec:
+        if 'folder' in entry:
+            folder = entry['folder']
+            os.makedirs(path + folder['path'])
+            _spec_to_files(folder['children'], path + folder['path'])
+        if 'file' in entry:
+            with open(path + entry['file']['path'], 'w') as ofp:
+                ofp.write(entry['file']['contents'])
+
+
+def generate_tree_from_spec(path, specFilepath):
+    """ writes a jsonToFiles spec (see resources/base-folder-tree.json) under path """
+    with open(specFilepath) as ifp:
+        _spec_to_files(json.load(ifp), path)
+
+
+def _tree_stats(path):
+    """ (entries, bytes of files) under path """
+    entries = 0
+    size = 0
+    for _, statResult in pyFolderSync.scan_tree(path):
+        entries += 1
+        if stat.S_ISREG(statResult.st_mode):
+            size += statResult.st_size
+    return entries, size
+
+
+# Measurement
+# ====================
+
+def _syscalls():
+    """
+    read + write syscalls of this process so far (linux), None elsewhere.
+    /proc/self/io counts no stat, open or getdents calls, see the statsIssued of the cycles for those.
+    """
+    try:
+        with open('/proc/self/io') as ifp:
+            counters = dict(line.split(': ') for line in ifp.read().splitlines())
+        return int(counters['syscr']) + int(counters['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _plan_bytes(plan, folderIn):
+    """ bytes of the data the plan created/updated """
+    size = 0
+    for operation in plan:
+        if operation.get_action() not in (pyFolderSync.SyncOperation.CREATE, pyFolderSync.SyncOperation.UPDATE):
+            continue
+        inStat = operation.get_inStat()
+        if stat.S_ISDIR(inStat.st_mode):
+            if operation.get_action() == pyFolderSync.SyncOperation.CREATE:
+                size += _tree_stats(os.path.join(folderIn, operation.get_relpath()))[1]
+        else:
+            size += inStat.st_size
+    return size
+
+
+def measure(name, entries, syncCycle, folderIn, cycles=None):
+    """ runs syncCycle() -> plan and reports its metrics, cycles is the list a metrics hook appends to """
+    syscallsBefore = _syscalls()
+    cyclesBefore = len(cycles) if cycles is not None else None
+    start = time.perf_counter()
+    plan = syncCycle()
+    seconds = time.perf_counter() - start
+    syscallsAfter = _syscalls()
+    size = _plan_bytes(plan, folderIn) if plan is not None else 0
+    statsIssued = None
+    if cycles is not None:
+        statsIssued = sum(metrics.get_counters().get('statsIssued', 0) for metrics in cycles[cyclesBefore:])
+    return {
+        'scenario': name,
+        'seconds': seconds,
+        'entries': entries,
+        'entriesPerSecond': entries / seconds if seconds else None,
+        'operations': len(plan) if plan is not None else None,
+        'megabytes': size / (1024 * 1024),
+        'megabytesPerSecond': size / (1024 * 1024) / seconds if seconds else None,
+        'statsIssued': statsIssued,
+        'readWriteSyscalls': syscallsAfter - syscallsBefore if syscallsBefore is not None else None,
+        'peakRssMegabytes': _peak_rss_mb(),
+    }
+
+
+# Scenarios
+# =================================================================
+
+def run_benchmark(workingDir, entries=1000, fanOut=10, depth=3, fileSizes=None, specFilepath=None,
+                  deltaFraction=0.01, seed=0, **folderSyncArgs):
+    """ runs every scenario on a fresh tree under workingDir, returns their metrics """
+    folderIn = os.path.join(workingDir, 'in')
+    folderOut = os.path.join(workingDir, 'out')
+    os.makedirs(folderOut)
+    if specFilepath:
+        os.makedirs(folderIn)
+        generate_tree_from_spec(folderIn, specFilepath)
+    else:
+        generate_tree(folderIn, entries, fanOut, depth, fileSizes, seed)
+    entries, _ = _tree_stats(folderIn)
+
+    dataStore = pyFolderSync.DataStore(pyFolderSync.DatabaseConnector(os.path.join(workingDir, 'db')))
+    folderSync = pyFolderSync.FolderSync(folderIn, folderOut, frequency=None, deleteWaitlist=False,
+                                         dataStore=dataStore, **folderSyncArgs)
+    dataStore.create_sync(folderSync.sync)
+    cycles = []
+    folderSync.add_metrics_hook(lambda sync, metrics: cycles.append(metrics))
+    rand = random.Random(seed)
+    results = []
+
+    # initial sync
+    results.append(measure('initialSync', entries, folderSync.sync_once, folderIn, cycles))
+
+    # no-op resync
+    results.append(measure('noopResync', entries, folderSync.sync_once, folderIn, cycles))
+
+    # no-op resync re-stat'ing the indexed children of unchanged dirs instead of listing them
+    pruneUnchangedDirs = folderSync.pruneUnchangedDirs
+    folderSync.pruneUnchangedDirs = True
+    results.append(measure('noopResyncPruned', entries, folderSync.sync_once, folderIn, cycles))
+
+    # no-op resync taking the files of unchanged dirs from the index, only dirs are stat'd
+    folderSync.trustDirMtimes = True
+    results.append(measure('noopResyncTrusted', entries, folderSync.sync_once, folderIn, cycles))
+    folderSync.trustDirMtimes = False
+    folderSync.pruneUnchangedDirs = pruneUnchangedDirs
+
+    # small-delta resync
+    files = [relpath for relpath, statResult in pyFolderSync.scan_tree(folderIn)
+             if stat.S_ISREG(statResult.st_mode)]
+    for relpath in rand.sample(files, max(int(len(files) * deltaFraction), 1) if files else 0):
+        with open(os.path.join(folderIn, relpath), 'ab') as ofp:
+            ofp.write(b'delta')
+    results.append(measure('smallDeltaResync', entries, folderSync.sync_once, folderIn, cycles))
+
+    # bulk rename
+    topLevel = sorted(os.listdir(folderIn))
+    for name in topLevel:
+        os.rename(os.path.join(folderIn, name), os.path.join(folderIn, name + '_renamed'))
+    results.append(measure('bulkRename', entries, folderSync.sync_once, folderIn, cycles))
+
+    # bulk delete
+    for name in topLevel[::2]:
+        removed = os.path.join(folderIn, name + '_renamed')
+        if os.path.isdir(removed):
+            shutil.rmtree(removed)
+        else:
+            os.remove(removed)
+    results.append(measure('bulkDelete', entries, folderSync.sync_once, folderIn, cycles))
+
+    dataStore.dbConn.conn.close()
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """ scenarios whose seconds or stats issued regressed more than tolerance against the baseline, as messages """
+    baselineByScenario = {result['scenario']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        prior = baselineByScenario.get(result['scenario'])
+        if not(prior):
+            continue
+        if prior['seconds'] and result['seconds'] > prior['seconds'] * (1 + tolerance):
+            regressions.append('{}: {:.3f}s -> {:.3f}s ({:+.0%})'.format(
+                result['scenario'], prior['seconds'], result['seconds'], result['seconds'] / prior['seconds'] - 1))
+        # baselines from before statsIssued was reported have none
+        priorStats = prior.get('statsIssued')
+        stats = result.get('statsIssued')
+        if priorStats and stats is not None and stats > priorStats * (1 + tolerance):
+            regressions.append('{}: {} -> {} stats ({:+.0%})'.format(
+                result['scenario'], priorStats, stats, stats / priorStats - 1))
+    return regressions
+
+
+def _format_metric(value, spec, width):
+    """ value formatted with spec, or '-' when measure() could not compute it """
+    return format(value, spec) if value is not None else '-'.rjust(width)
+
+
+def format_result(result):
+    """ one line of a scenario's metrics """
+    return '{:>18}: {:8.3f}s {} entries/s {} MB/s {} ops {} stats'.format(
+        result['scenario'], result['seconds'],
+        _format_metric(result['entriesPerSecond'], '12.0f', 12),
+        _format_metric(result['megabytesPerSecond'], '8.1f', 8),
+        _format_metric(result['operations'], '8d', 8),
+        _format_metric(result.get('statsIssued'), '8d', 8))
+
+
+# Main
+# =================================================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--fan-out', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--spec', help='jsonToFiles spec to sync instead of a generated tree')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write results as a json baseline')
+    parser.add_argument('--baseline', help='json baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    workingDir = tempfile.mkdtemp(prefix='pyFolderSync-bench-')
+    try:
+        results = run_benchmark(workingDir, args.entries, args.fan_out, args.depth,
+                                specFilepath=args.spec, seed=args.seed, workers=args.workers)
+    finally:
+        shutil.rmtree(workingDir, ignore_errors=True)
+
+    report = {'config': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as ofp:
+            json.dump(report, ofp, indent=4)
+    for result in results:
+        print(format_result(result))
+    if args.baseline:
+        with open(args.baseline) as ifp:
+            regressions = compare_to_baseline(results, json.load(ifp), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,20 @@
 # -*- coding: utf-8 -*-
 import unittest
 import os
+import sys
+import errno
 import inspect
 import shutil
+import io
 import json
+import time
+import threading
+import asyncio
+import sqlite3
 
 from pathlib import Path
 from pyFolderSync import pyFolderSync
+from pyFolderSyncTest import benchmark_pyFolderSync
 
 
 # Utilities
@@ -34,6 +42,35 @@ def _get_filename(filepath):
 def _get_parent(filepath):
     return str(Path(filepath).parent)
 
+
+def _refuse_copy(inFd, outFd):
+    """ a KernelFileCopier mechanism the filesystem does not support """
+    raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+# watch
+# ====================
+
+
+class ReportingWatcher(pyFolderSync.FolderWatcher):
+    """ reports the paths given to report(), as a change notification would """
+
+    def __init__(self):
+        self._paths = []
+        self._lock = threading.Lock()
+
+    def start(self, rootDir):
+        pass
+
+    def report(self, *paths):
+        with self._lock:
+            self._paths.extend(paths)
+
+    def read_events(self, timeout):
+        time.sleep(min(timeout, 0.02))
+        with self._lock:
+            paths, self._paths = self._paths, []
+        return paths, False
+
 # serialization
 # ====================
 
@@ -79,25 +116,28 @@ def filesToJson(path):
 class TestPyFolderSync(unittest.TestCase):
 
     WORKING_DIR = _get_parent(inspect.getfile(inspect.currentframe()))
-    RESOURCES_DIR = WORKING_DIR + '\\resources'
-    FOLDER_TREE = json.load(open(RESOURCES_DIR + '\\base-folder-tree.json',))
+    RESOURCES_DIR = os.path.join(WORKING_DIR, 'resources')
+    FOLDER_TREE = json.load(open(os.path.join(RESOURCES_DIR, 'base-folder-tree.json'),))
 
     TEST_WORKING_FOLDER = os.path.join(WORKING_DIR, 'TEST_WORKING_FOLDER')
 
-    TEST_IN_FOLDER = TEST_WORKING_FOLDER + '\\in'
-    TEST_OUT_FOLDER = TEST_WORKING_FOLDER + '\\out'
+    TEST_IN_FOLDER = os.path.join(TEST_WORKING_FOLDER, 'in')
+    TEST_OUT_FOLDER = os.path.join(TEST_WORKING_FOLDER, 'out')
 
-    TEST_IN_FOLDER_ROOT = TEST_IN_FOLDER + '\\root'
-    TEST_OUT_FOLDER_ROOT = TEST_OUT_FOLDER + '\\root'
+    TEST_IN_FOLDER_ROOT = os.path.join(TEST_IN_FOLDER, 'root')
+    TEST_OUT_FOLDER_ROOT = os.path.join(TEST_OUT_FOLDER, 'root')
 
     def setUp(self):
         self.tearDown()
         os.makedirs(TestPyFolderSync.TEST_IN_FOLDER)
         os.makedirs(TestPyFolderSync.TEST_OUT_FOLDER)
         jsonToFiles(TestPyFolderSync.FOLDER_TREE, TestPyFolderSync.TEST_IN_FOLDER)
+        self.dataStore = pyFolderSync.DataStore(pyFolderSync.DatabaseConnector(TestPyFolderSync.TEST_WORKING_FOLDER))
         self.maxDiff = 2000
 
     def tearDown(self):
+        if hasattr(self, 'dataStore'):
+            self.dataStore.dbConn.conn.close()
         # destroy any possible files
         if os.path.exists(TestPyFolderSync.TEST_WORKING_FOLDER):
             shutil.rmtree(TestPyFolderSync.TEST_WORKING_FOLDER)
@@ -106,7 +146,7 @@ class TestPyFolderSync(unittest.TestCase):
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None).run()
+                                frequency=None, dataStore=self.dataStore).run()
         # assert equals
         jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
         jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
@@ -116,21 +156,23 @@ class TestPyFolderSync(unittest.TestCase):
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None).run()
+                                frequency=None, dataStore=self.dataStore).run()
         # make changes
-        os.makedirs(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFolder1')
-        os.makedirs(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\testFolder2')
-        os.makedirs(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\testFolder2\\YELLO')
-        os.makedirs(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York\\YELLO')
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFolder1'))
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'testFolder2'))
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'testFolder2', 'YELLO'))
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'YELLO'))
 
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFolder1\\hello.txt', "I am mister winner!!", "w")
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York\\YELLO\\NOPE.txt', "I am miaaaa!!", "w")
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\hello.txt', "I am mister winner!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFolder1', 'hello.txt'),
+                    "I am mister winner!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'YELLO', 'NOPE.txt'),
+                    "I am miaaaa!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'hello.txt'), "I am mister winner!!", "w")
 
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None).run()
+                                frequency=None, dataStore=self.dataStore).run()
 
         # assert equals
         jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
@@ -141,25 +183,26 @@ class TestPyFolderSync(unittest.TestCase):
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None).run()
+                                frequency=None, dataStore=self.dataStore).run()
         # make changes
-        shutil.move(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York',
-                    TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York2')
-        shutil.move(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York2\\notes.txt',
-                    TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York2\\notes3.txt')
-        shutil.move(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\photosFun.txt',
-                    TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\nope.txt')
-        shutil.move(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFile2.txt',
-                    TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\GOSHHHH.txt')
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2'))
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notes.txt'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notes3.txt'))
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'photosFun.txt'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'nope.txt'))
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'GOSHHHH.txt'))
 
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\photosFun.txt', "WHAT IS HAPPENING", "w")
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFile1.txt', "TEST BOIIII", "w")
-        _write_file(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFile2.txt', "TEST BOIIIIwerwer", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'photosFun.txt'),
+                    "WHAT IS HAPPENING", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), "TEST BOIIII", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'), "TEST BOIIIIwerwer", "w")
 
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None, deleteWaitlist=False).run()
+                                frequency=None, deleteWaitlist=False, dataStore=self.dataStore).run()
 
         # assert equals
         jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
@@ -170,22 +213,923 @@ class TestPyFolderSync(unittest.TestCase):
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None).run()
+                                frequency=None, dataStore=self.dataStore).run()
+        # make changes
+        shutil.rmtree(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York'))
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'photosFun.txt'))
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'))
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+
+        # sync
+        pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                TestPyFolderSync.TEST_OUT_FOLDER,
+                                frequency=None, deleteWaitlist=False, dataStore=self.dataStore).run()
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_parallel_sync_files(self):
+        # sync
+        pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                TestPyFolderSync.TEST_OUT_FOLDER,
+                                frequency=None, workers=4, dataStore=self.dataStore).run()
+        # make changes
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2'))
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFolder1', 'YELLO'))
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFolder1', 'YELLO', 'NOPE.txt'),
+                    "I am miaaaa!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), "TEST BOIIII", "w")
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+
+        # sync
+        pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                TestPyFolderSync.TEST_OUT_FOLDER,
+                                frequency=None, deleteWaitlist=False, workers=4, dataStore=self.dataStore).run()
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_delta_update_files(self):
+        filepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+        outFilepath = os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt')
+        _write_file(filepath, "aaaaaaaabbbbbbbbccccccccdd", "w")
+        # sync
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, deltaMinSize=0, deltaBlockSize=8,
+                                             dataStore=self.dataStore)
+        folderSync.run()
+        # make changes
+        _write_file(filepath, "aaaaaaaaBBBBBBBBcccccccc", "w")
+        signatures = pyFolderSync.compute_block_signatures(filepath, 8)
+        shutil.copy2(outFilepath, outFilepath + '.bak')
+        self.assertEqual((signatures, 8), pyFolderSync.delta_copy(filepath, outFilepath + '.bak', 8))
+        os.remove(outFilepath + '.bak')
+
+        # sync
+        folderSync.sync_once()
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_copy_backends(self):
+        filepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+        copiers = [(pyFolderSync.BufferedFileCopier(bufferSize=4), [pyFolderSync.BufferedFileCopier.BUFFERED])]
+        if sys.platform.startswith('linux'):
+            kernelCopier = pyFolderSync.KernelFileCopier()
+            kernelBackends = [(kernelCopier._reflink, pyFolderSync.KernelFileCopier.REFLINK),
+                              (kernelCopier._copy_file_range, pyFolderSync.KernelFileCopier.COPY_FILE_RANGE),
+                              (kernelCopier._sendfile, pyFolderSync.KernelFileCopier.SENDFILE)]
+            # reflink only where the filesystem shares extents (btrfs/XFS), never the buffered loop
+            copiers.append((kernelCopier, [backend for _, backend in kernelBackends]))
+            # each mechanism the filesystem refuses falls back to the next one
+            for refused in range(1, len(kernelBackends) + 1):
+                fileCopier = pyFolderSync.KernelFileCopier()
+                for method, _ in kernelBackends[:refused]:
+                    setattr(fileCopier, method.__name__, _refuse_copy)
+                copiers.append((fileCopier, [kernelBackends[refused][1] if refused < len(kernelBackends)
+                                             else pyFolderSync.BufferedFileCopier.BUFFERED]))
+        for fileCopier, expectedBackends in copiers:
+            backend = fileCopier.copy(filepath, filepath + '.copy')
+            # assert equals
+            self.assertIn(backend, expectedBackends)
+            self.assertEqual(_read_file(filepath), _read_file(filepath + '.copy'))
+            self.assertEqual(os.stat(filepath).st_mtime, os.stat(filepath + '.copy').st_mtime)
+            os.remove(filepath + '.copy')
+
+    def test_batched_locations(self):
+        dataStore = self.dataStore
+        sync = pyFolderSync.Sync(TestPyFolderSync.TEST_IN_FOLDER, TestPyFolderSync.TEST_OUT_FOLDER)
+        dataStore.create_sync(sync)
+        # batch
+        dataStore.begin_batch()
+        for name in ('a', 'b', 'c'):
+            dataStore.create_location(pyFolderSync.Location(sync, os.path.join(TestPyFolderSync.TEST_IN_FOLDER, name)))
+        dataStore.remove_location(pyFolderSync.Location(sync, os.path.join(TestPyFolderSync.TEST_IN_FOLDER, 'b')))
+        dataStore.end_batch()
+        # assert equals
+        locations = dataStore.read_locations_by_sync(sync)
+        self.assertEqual([os.path.join(TestPyFolderSync.TEST_IN_FOLDER, 'a'),
+                          os.path.join(TestPyFolderSync.TEST_IN_FOLDER, 'c')],
+                         sorted(location.get_folderInLocation() for location in locations))
+        self.assertEqual('wal', dataStore.dbConn.conn.execute("PRAGMA journal_mode;").fetchone()[0])
+
+    def test_rolled_back_dirs(self):
+        dataStore = self.dataStore
+        sync = pyFolderSync.Sync(TestPyFolderSync.TEST_IN_FOLDER, TestPyFolderSync.TEST_OUT_FOLDER)
+        dataStore.create_sync(sync)
+        location = pyFolderSync.Location(sync, os.path.join(TestPyFolderSync.TEST_IN_FOLDER, 'a', 'b', 'c'))
+        # the dir rows are inserted in the batch's transaction, so they roll back with it
+        dataStore.begin_batch()
+        dataStore.create_location(location)
+        dataStore._write("INSERT INTO missing_table VALUES (?);", (1,))
+        self.assertRaises(sqlite3.OperationalError, dataStore.end_batch)
+        self.assertEqual(0, dataStore.dbConn.conn.execute("SELECT count(*) FROM directory;").fetchone()[0])
+        # and are inserted again once forgotten
+        dataStore.create_location(location)
+        self.assertEqual([location.get_folderInLocation()],
+                         [loc.get_folderInLocation() for loc in dataStore.read_locations_by_sync(sync)])
+        self.assertEqual(3, dataStore.dbConn.conn.execute("SELECT count(*) FROM directory;").fetchone()[0])
+
+    def test_batched_dir_commits(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, dataStore=self.dataStore)
+        folderSync.run()
+        commits = []
+        for depth in (2, 10):
+            os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, *['nested{}'.format(depth)] * depth))
+            statements = []
+            folderSync.dataStore.dbConn.conn.set_trace_callback(statements.append)
+            folderSync.sync_once()
+            folderSync.dataStore.dbConn.conn.set_trace_callback(None)
+            commits.append(statements.count('COMMIT'))
+        # dir rows are written with the plan's batch, not committed one by one
+        self.assertEqual(commits[0], commits[1])
+        trackedFilepaths = [location.get_folderInLocation()
+                            for location in folderSync.dataStore.read_locations_by_sync(folderSync.sync)]
+        self.assertIn(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, *['nested10'] * 10), trackedFilepaths)
+
+    def test_normalized_locations(self):
+        # a db from before sync ids keeps its syncs
+        dbFolder = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'db')
+        os.makedirs(dbFolder)
+        legacyConn = sqlite3.connect(dbFolder + '/sqllite.db')
+        legacyConn.execute("CREATE TABLE sync (folderIn VARCHAR(100), folderOut VARCHAR(100));")
+        legacyConn.execute("INSERT INTO sync VALUES ('legacyIn', 'legacyOut');")
+        legacyConn.commit()
+        legacyConn.close()
+        dataStore = pyFolderSync.DataStore(pyFolderSync.DatabaseConnector(dbFolder))
+        self.assertEqual(['legacyIn'], [sync.get_folderIn() for sync in dataStore.read_syncs()])
+
+        # dirs are interned, a subtree moves with its dir row
+        sync = pyFolderSync.Sync(TestPyFolderSync.TEST_IN_FOLDER, TestPyFolderSync.TEST_OUT_FOLDER)
+        dataStore.create_sync(sync)
+        root = os.path.join(TestPyFolderSync.TEST_IN_FOLDER, 'root')
+        for parts in (['a'], ['a', 'b'], ['a', 'b', 'c.txt'], ['a', 'd.txt']):
+            dataStore.create_location(pyFolderSync.Location(sync, os.path.join(root, *parts)))
+        dataStore.update_location(pyFolderSync.Location(sync, os.path.join(root, 'a')),
+                                  pyFolderSync.Location(sync, os.path.join(root, 'z')))
+        dataStore.move_location_subtree(pyFolderSync.Location(sync, os.path.join(root, 'a')),
+                                        pyFolderSync.Location(sync, os.path.join(root, 'z')))
+        self.assertEqual([os.path.join(root, 'z'), os.path.join(root, 'z', 'b'),
+                          os.path.join(root, 'z', 'b', 'c.txt'), os.path.join(root, 'z', 'd.txt')],
+                         sorted(location.get_folderInLocation() for location in dataStore.read_locations_by_sync(sync)))
+        dataStore.remove_location_subtree(pyFolderSync.Location(sync, os.path.join(root, 'z')))
+        self.assertEqual([os.path.join(root, 'z')],
+                         [location.get_folderInLocation() for location in dataStore.read_locations_by_sync(sync)])
+        self.assertEqual(2, dataStore.dbConn.conn.execute("SELECT count(*) FROM directory;").fetchone()[0])
+        dataStore.dbConn.conn.close()
+
+    def test_content_hash_files(self):
+        # sync
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, contentHash=True, dedupe=True, dataStore=self.dataStore)
+        folderSync.run()
+        # make changes
+        os.utime(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+        shutil.copy2(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'),
+                     os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile3.txt'))
+
+        # sync
+        plan = folderSync.sync_once()
+        copyBackends = {operation.get_relpath(): operation.get_copyBackends()
+                        for operation in plan if operation.get_copyBackends()}
+        self.assertEqual({'metadata': 1}, copyBackends[os.path.join('root', 'testFile2.txt')])
+        # whichever tracked copy the index lists first, one with the same stat is linked
+        self.assertIn(list(copyBackends[os.path.join('root', 'testFile3.txt')]), [['reflink'], ['hardlink']])
+        self.assertEqual(os.stat(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile3.txt')).st_mtime,
+                         os.stat(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile3.txt')).st_mtime)
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_content_hash_reuse(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, contentHash=True, dedupe=True, dataStore=self.dataStore)
+        folderSync.run()
+        cycles = []
+        folderSync.add_metrics_hook(lambda sync, metrics: cycles.append(metrics.get_timings()))
+        hashed = []
+        hashFile = pyFolderSync.hash_file
+        pyFolderSync.hash_file = lambda filepath, *args: hashed.append(filepath) or hashFile(filepath, *args)
+        try:
+            # folderIn still has the indexed size and mtime, its hash is not read again
+            inFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+            outFilepath = os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt')
+            os.utime(outFilepath, (0, 0))
+            folderSync.execute_plan(folderSync.plan_sync(fullScan=True))
+            self.assertEqual([], hashed)
+            self.assertEqual(os.stat(inFilepath).st_mtime, os.stat(outFilepath).st_mtime)
+
+            # no tracked file of its size, hashed once for the index and never looked up by hash
+            uniqueFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'unique.txt')
+            _write_file(uniqueFilepath, 'unique' * 1000, 'w')
+            folderSync.sync_once()
+            self.assertEqual([uniqueFilepath], hashed)
+            self.assertNotIn('db.read_locations_by_hash', cycles[-1])
+
+            # a duplicate is hashed once, before the copy, and linked
+            duplicateFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'duplicate.txt')
+            shutil.copy2(uniqueFilepath, duplicateFilepath)
+            plan = folderSync.sync_once()
+            self.assertEqual([uniqueFilepath, duplicateFilepath], hashed)
+            operation, = plan.get_operations(pyFolderSync.SyncOperation.CREATE)
+            self.assertIn(list(operation.get_copyBackends()), [['reflink'], ['hardlink']])
+        finally:
+            pyFolderSync.hash_file = hashFile
+
+    def test_supervise_syncs(self):
+        supervisor = pyFolderSync.SyncSupervisor(self.dataStore.dbConn, workers=4)
+        for name in ('out', 'out2'):
+            supervisor.add_sync(TestPyFolderSync.TEST_IN_FOLDER,
+                                os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name),
+                                frequency=None)
+            os.makedirs(os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name), exist_ok=True)
+        # sync
+        supervisor.run()
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        for name in ('out', 'out2'):
+            jsonStringOut = json.dumps(filesToJson(os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name, 'root')))
+            self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_supervise_cycle_limit(self):
+        supervisor = pyFolderSync.SyncSupervisor(self.dataStore.dbConn, maxConcurrentCycles=2)
+        lock = threading.Lock()
+        active = []
+        peaks = []
+
+        def counted(syncCycle):
+            def sync_cycle(*args, **kwargs):
+                with lock:
+                    active.append(syncCycle)
+                    peaks.append(len(active))
+                time.sleep(0.05)
+                try:
+                    return syncCycle(*args, **kwargs)
+                finally:
+                    with lock:
+                        active.remove(syncCycle)
+            return sync_cycle
+        names = ('out', 'out2', 'out3', 'out4')
+        for name in names:
+            os.makedirs(os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name), exist_ok=True)
+            folderSync = supervisor.add_sync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name),
+                                             frequency=None)
+            folderSync.sync_cycle = counted(folderSync.sync_cycle)
+        # sync
+        supervisor.run()
+
+        # every sync ran, never more than two at once
+        self.assertEqual(len(names), len(peaks))
+        self.assertEqual(2, max(peaks))
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        for name in names:
+            jsonStringOut = json.dumps(filesToJson(os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name, 'root')))
+            self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_supervise_separate_batches(self):
+        dbConn = self.dataStore.dbConn
+        supervisor = pyFolderSync.SyncSupervisor(dbConn)
+        folderSyncs = [supervisor.add_sync(TestPyFolderSync.TEST_IN_FOLDER,
+                                           os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, name),
+                                           frequency=None) for name in ('out', 'out2')]
+        inFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+        # one sync's batch commits while another's is still open
+        folderSyncs[0].dataStore.begin_batch()
+        folderSyncs[1].dataStore.begin_batch()
+        folderSyncs[1].dataStore.create_location(pyFolderSync.Location(folderSyncs[1].sync, inFilepath))
+        folderSyncs[1].dataStore.end_batch()
+        rows = dbConn.execute("SELECT * FROM location WHERE name = ?;", ('testFile1.txt',))
+        folderSyncs[0].dataStore.end_batch()
+        self.assertEqual(1, len(rows))
+
+    def test_async_sync_files(self):
+        async def sync():
+            async with pyFolderSync.AsyncFolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                                    TestPyFolderSync.TEST_OUT_FOLDER,
+                                                    frequency=None,
+                                                    dataStore=self.dataStore) as asyncFolderSync:
+                return [result async for result in asyncFolderSync]
+        # sync
+        results = asyncio.run(sync())
+        self.assertEqual(1, len(results))
+        self.assertEqual(0, results[0].get_failures())
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_async_pack_files(self):
+        async def sync():
+            async with pyFolderSync.AsyncFolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                                    TestPyFolderSync.TEST_OUT_FOLDER,
+                                                    frequency=None,
+                                                    deleteWaitlist=False,
+                                                    packMaxFileSize=25, dataStore=self.dataStore) as asyncFolderSync:
+                await asyncFolderSync.sync_once()
+        # the async cycle is the sync one, so its packs are flushed to disk once it ends
+        asyncio.run(sync())
+        packDir = os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, pyFolderSync.PackStore.PACK_DIRNAME)
+        packed = b''.join(_read_file(os.path.join(packDir, name)) for name in os.listdir(packDir))
+        self.assertIn(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')), packed)
+
+    def test_plan_moves(self):
+        # sync
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, dataStore=self.dataStore)
+        folderSync.run()
         # make changes
-        shutil.rmtree(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\New York')
-        os.remove(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\photos\\photosFun.txt')
-        os.remove(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFile1.txt')
-        os.remove(TestPyFolderSync.TEST_IN_FOLDER_ROOT + '\\testFile2.txt')
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2'))
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notes.txt'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notes3.txt'))
+
+        # plan
+        plan = folderSync.plan_sync()
+        self.assertEqual(2, len(plan.get_operations(pyFolderSync.SyncOperation.MOVE)))
+        # the move sources are looked up a level at a time (the moved dir, then the file renamed in it),
+        # not one query per entry
+        timings = folderSync.metrics.get_timings()
+        self.assertEqual(2, timings['db.read_locations_by_file_id'][0])
+        self.assertNotIn('db.read_location', timings)
+        self.assertEqual([], plan.get_operations(pyFolderSync.SyncOperation.CREATE))
+        self.assertEqual([], plan.get_operations(pyFolderSync.SyncOperation.DELETE))
+        # the moved dir's descendants are indexed under it by the move, not tracked one by one
+        self.assertEqual([], plan.get_operations(pyFolderSync.SyncOperation.TRACK))
+
+        # sync
+        folderSync.execute_plan(plan)
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+        trackedFilepaths = [location.get_folderInLocation()
+                            for location in folderSync.dataStore.read_locations_by_sync(folderSync.sync)]
+        self.assertIn(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notesNY.txt'),
+                      trackedFilepaths)
+        self.assertIn(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2', 'notes3.txt'),
+                      trackedFilepaths)
+        self.assertFalse([filepath for filepath in trackedFilepaths if os.path.join('New York', '') in filepath])
+
+        # delete
+        shutil.rmtree(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York2'))
+        folderSync.deleteWaitlist = False
+        folderSync.sync_once()
+        trackedFilepaths = [location.get_folderInLocation()
+                            for location in folderSync.dataStore.read_locations_by_sync(folderSync.sync)]
+        self.assertFalse([filepath for filepath in trackedFilepaths if 'New York' in filepath])
+
+    def test_index_sync_files(self):
+        # sync
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, deleteWaitlist=False, pruneUnchangedDirs=True,
+                                             dataStore=self.dataStore)
+        folderSync.run()
+        # make changes
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'YELLO.txt'),
+                    "I am miaaaa!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), "TEST BOIIII", "w")
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+
+        # sync against the index
+        folderSync.sync_once()
+        self.assertEqual(0, len(folderSync.plan_sync(fullScan=False)))
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_index_in_place_edit(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, deleteWaitlist=False, pruneUnchangedDirs=True,
+                                             dataStore=self.dataStore)
+        folderSync.run()
+        # rewritten in place, its dir keeps its mtime and is not listed
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'notesNY.txt'),
+                    "edited in place", "w")
+        folderSync.sync_once()
+        self.assertEqual(b'edited in place',
+                         _read_file(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'photos', 'New York', 'notesNY.txt')))
+
+    def test_index_trust_dir_mtimes(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, deleteWaitlist=False, pruneUnchangedDirs=True,
+                                             trustDirMtimes=True, dataStore=self.dataStore)
+        folderSync.run()
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'YELLO.txt'),
+                    "I am miaaaa!!", "w")
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), "edited in place", "w")
+        # the new file bumped its dir's mtime, the edit left the root's alone and is only seen by a full scan
+        plan = folderSync.plan_sync(fullScan=False)
+        self.assertEqual([os.path.join('root', 'photos', 'New York', 'YELLO.txt')],
+                         [operation.get_relpath() for operation in plan.get_operations(pyFolderSync.SyncOperation.CREATE)])
+        editedRelpath = os.path.join('root', 'testFile1.txt')
+        self.assertNotIn(editedRelpath,
+                         [operation.get_relpath() for operation in plan.get_operations(pyFolderSync.SyncOperation.UPDATE)])
+        plan = folderSync.plan_sync(fullScan=True)
+        self.assertIn(editedRelpath,
+                      [operation.get_relpath() for operation in plan.get_operations(pyFolderSync.SyncOperation.UPDATE)])
+        self.assertRaises(ValueError, pyFolderSync.FolderSync, TestPyFolderSync.TEST_IN_FOLDER,
+                          TestPyFolderSync.TEST_OUT_FOLDER, trustDirMtimes=True, dataStore=self.dataStore)
+
+    @unittest.skipUnless(pyFolderSync.InotifyWatcher.is_supported(), "inotify not available")
+    def test_watch_files(self):
+        self._watch_changes(pyFolderSync.InotifyWatcher())
+
+    def test_polling_watch_files(self):
+        self._watch_changes(pyFolderSync.PollingWatcher(interval=0.1))
+
+    def _watch_changes(self, watcher):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             deleteWaitlist=False, dataStore=self.dataStore)
+        stopEvent = threading.Event()
+        watchThread = threading.Thread(target=folderSync.watch,
+                                       kwargs={'watcher': watcher, 'debounce': 0.05, 'stopEvent': stopEvent})
+        watchThread.start()
+        root = TestPyFolderSync.TEST_IN_FOLDER_ROOT
+        try:
+            self._wait_for_sync()
+            # make changes
+            shutil.move(os.path.join(root, 'photos', 'New York'), os.path.join(root, 'photos', 'New York2'))
+            os.makedirs(os.path.join(root, 'testFolder1'))
+            _write_file(os.path.join(root, 'testFolder1', 'hello.txt'), "I am mister winner!!", "w")
+            _write_file(os.path.join(root, 'testFile1.txt'), "TEST BOIIII", "w")
+            os.remove(os.path.join(root, 'testFile2.txt'))
+            # assert equals
+            self._wait_for_sync()
+        finally:
+            stopEvent.set()
+            watchThread.join()
+
+    def _wait_for_sync(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+                jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+            except OSError:
+                jsonStringIN, jsonStringOut = None, ''
+            if jsonStringIN == jsonStringOut or time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_benchmark(self):
+        workingDir = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'bench')
+        os.makedirs(workingDir)
+        results = benchmark_pyFolderSync.run_benchmark(workingDir, entries=200, fanOut=3, depth=2)
+        self.assertEqual(['initialSync', 'noopResync', 'noopResyncPruned', 'noopResyncTrusted', 'smallDeltaResync',
+                          'bulkRename', 'bulkDelete'],
+                         [result['scenario'] for result in results])
+        self.assertEqual(0, results[1]['operations'])
+        self.assertEqual(0, results[2]['operations'])
+        self.assertEqual(0, results[3]['operations'])
+        # a stat per dir instead of one per entry
+        self.assertLess(results[3]['statsIssued'], results[2]['statsIssued'])
+        self.assertEqual([], benchmark_pyFolderSync.compare_to_baseline(results, {'results': results}))
+        # stat volume is a regression of its own, whatever the timings say
+        self.assertGreater(results[1]['statsIssued'], 0)
+        baseline = [dict(result, statsIssued=result['statsIssued'] // 2, seconds=result['seconds'] * 2)
+                    for result in results]
+        regressions = benchmark_pyFolderSync.compare_to_baseline(results, {'results': baseline})
+        self.assertIn('noopResync: ', regressions[1])
+        self.assertIn(' stats ', regressions[1])
+        # metrics measure() could not compute still print
+        results[0].update(entriesPerSecond=None, megabytesPerSecond=None, operations=None, statsIssued=None)
+        self.assertIn('initialSync', benchmark_pyFolderSync.format_result(results[0]))
+
+    def test_sync_metrics(self):
+        cycles = []
+        jsonFilepath = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'metrics.jsonl')
+        promFilepath = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'metrics.prom')
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             metricsHooks=[lambda sync, metrics: cycles.append(metrics),
+                                                           pyFolderSync.JsonLinesMetricsExporter(jsonFilepath)],
+                                             dataStore=self.dataStore)
+        folderSync.add_metrics_hook(pyFolderSync.PrometheusMetricsExporter(promFilepath))
+        # sync twice
+        folderSync.run()
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), "TEST BOIIII", "w")
+        folderSync.sync_once()
+
+        # assert metrics
+        self.assertEqual([0, 1], [metrics.cycle for metrics in cycles])
+        counters = cycles[0].get_counters()
+        self.assertGreater(counters['entriesScanned.in'], 0)
+        self.assertGreater(counters['bytesCopied'], 0)
+        timings = cycles[0].get_timings()
+        for name in ['walk', 'plan_sync', 'execute_plan', 'operation.create', 'create_file', 'db.create_location']:
+            self.assertIn(name, timings)
+        self.assertNotIn('operation.create', cycles[1].get_timings())
+        # the walk's stats and the ones update_file issued on top
+        counters = cycles[1].get_counters()
+        self.assertGreater(counters['statsIssued'], counters['entriesScanned.in'] + counters.get('entriesScanned.out', 0))
+        counters = cycles[0].get_counters()
+
+        # assert exports
+        lines = [json.loads(line) for line in _read_file(jsonFilepath, 'r').splitlines()]
+        self.assertEqual([0, 1], [line['cycle'] for line in lines])
+        self.assertEqual(counters['bytesCopied'], lines[0]['counters']['bytesCopied'])
+        self.assertIn('pyfoldersync_cycle{', _read_file(promFilepath, 'r'))
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        rateLimiter = pyFolderSync.RateLimiter(bytesPerSecond=100, opsPerSecond=10,
+                                               clock=lambda: now[0], sleep=sleep)
+        # one second of burst, then paced
+        rateLimiter.pace(100, 0)
+        rateLimiter.pace(50, 0)
+        self.assertEqual([0.5], sleeps)
+        for _ in range(11):
+            rateLimiter.acquire_op()
+        self.assertAlmostEqual(0.1, sleeps[-1])
+
+        # profiles override the default rates
+        rateLimiter.profiles = [pyFolderSync.ThrottleProfile('00:00', '00:00', bytesPerSecond=None, opsPerSecond=5)]
+        rateLimiter._refresh(force=True)
+        self.assertEqual((None, 5), rateLimiter.get_rates())
+
+        # adaptive backs off when writes get slower
+        rateLimiter = pyFolderSync.RateLimiter(bytesPerSecond=1000, adaptive=True, clock=lambda: now[0], sleep=sleep)
+        rateLimiter.pace(100, 0.01)
+        now[0] += 1
+        rateLimiter.pace(100, 1.0)
+        self.assertLess(rateLimiter.get_scale(), 1)
+        self.assertLess(rateLimiter.get_rates()[0], 1000)
+
+    def test_throttled_sync_files(self):
+        rateLimiter = pyFolderSync.RateLimiter(bytesPerSecond=64 * 1024, opsPerSecond=1000)
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             deleteWaitlist=False,
+                                             rateLimiter=rateLimiter, dataStore=self.dataStore)
+        folderSync.run()
+        shutil.rmtree(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos'))
+        folderSync.sync_once()
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_filter_sync_files(self):
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'build', 'obj'))
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'build', 'obj', 'main.o'), b'obj')
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'big.bin'), b'x' * 4096)
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', '.syncignore'),
+                    b'*.txt\n!notesNY.txt\n')
+        syncFilter = pyFolderSync.SyncFilter(['build/', 'testFile2.txt'], ignoreFilename='.syncignore',
+                                             maxSize=1024)
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             deleteWaitlist=False,
+                                             syncFilter=syncFilter, dataStore=self.dataStore)
+        folderSync.run()
+        # excluded out files are left alone
+        _write_file(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile2.txt'), b'out only')
+        folderSync.sync_once()
+
+        included = ['testFile1.txt', os.path.join('photos', '.syncignore'),
+                    os.path.join('photos', 'New York', 'notesNY.txt')]
+        excluded = ['build', 'big.bin', os.path.join('photos', 'photosFun.txt'),
+                    os.path.join('photos', 'New York', 'notes.txt')]
+        for relpath in included:
+            self.assertTrue(os.path.exists(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, relpath)), relpath)
+        for relpath in excluded:
+            self.assertFalse(os.path.exists(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, relpath)), relpath)
+        self.assertEqual(b'out only', _read_file(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile2.txt')))
+
+    def test_filter_young_files(self):
+        oldTime = time.time() - 3600
+        for relpath, _ in pyFolderSync.scan_tree(TestPyFolderSync.TEST_IN_FOLDER):
+            os.utime(os.path.join(TestPyFolderSync.TEST_IN_FOLDER, relpath), (oldTime, oldTime))
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             deleteWaitlist=False,
+                                             syncFilter=pyFolderSync.SyncFilter(minAge=60), dataStore=self.dataStore)
+        folderSync.run()
+        # still being written: neither copied nor deleted, on full and quick cycles
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), 'half written', 'w')
+        for fullScan in (True, False):
+            self.assertEqual([], [operation.get_action() for operation in folderSync.plan_sync(fullScan)])
+        folderSync.sync_once()
+        self.assertEqual(b'Photos are fun to take}', _read_file(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt')))
+
+    def test_dry_run_sync_files(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, dataStore=self.dataStore)
+        planFile = io.StringIO()
+        plan = folderSync.dry_run(planFile, bytesPerSecond=100)
+        self.assertEqual([], os.listdir(TestPyFolderSync.TEST_OUT_FOLDER))
+
+        # one line per operation between the header and the summary
+        records = [json.loads(line) for line in planFile.getvalue().splitlines()]
+        self.assertEqual(['header'] + ['operation'] * len(plan) + ['summary'], [r['type'] for r in records])
+        self.assertEqual(117, records[-1]['bytes'])
+        self.assertEqual(1.17, records[-1]['estimatedSeconds'])
+
+        # run it later
+        planFile.seek(0)
+        result = folderSync.execute_saved_plan(planFile)
+        self.assertEqual(0, result.get_failures())
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_delete_waitlist(self):
+        waitlist = pyFolderSync.DeleteWaitlist(TestPyFolderSync.TEST_OUT_FOLDER)
+        for relpath in ['root', os.path.join('root', 'photos'), os.path.join('root', 'photos', 'photosFun.txt'),
+                        os.path.join('root', 'testFile1.txt')]:
+            waitlist.add(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, relpath))
+        waitlist.discard(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, 'root'))
+        self.assertEqual(3, len(waitlist))
+        self.assertNotIn(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, 'root'), waitlist)
+        waitlist.discard_subtree(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, 'root', 'photos'))
+        self.assertEqual(1, len(waitlist))
+        self.assertIn(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, 'root', 'testFile1.txt'), waitlist)
+        self.assertNotIn(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, 'root', 'photos', 'photosFun.txt'), waitlist)
+
+    def test_scan_deep_tree(self):
+        # deeper than the dirs scan_tree keeps open
+        depth = pyFolderSync.MAX_OPEN_DIRS + 6
+        os.makedirs(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, *['d'] * depth))
+        relpaths = [relpath for relpath, _ in pyFolderSync.scan_tree(TestPyFolderSync.TEST_IN_FOLDER)]
+        self.assertEqual(8 + depth, len(relpaths))
+        # pre-order, every dir right before its children
+        for relpath in relpaths:
+            parent = os.path.dirname(relpath)
+            self.assertTrue(not(parent) or relpaths.index(parent) < relpaths.index(relpath))
+
+    def test_parallel_scan_files(self):
+        scanner = pyFolderSync.ParallelScanner(workers=4)
+        self.assertEqual([relpath for relpath, _ in pyFolderSync.scan_tree(TestPyFolderSync.TEST_IN_FOLDER)],
+                         [relpath for relpath, _ in scanner.scan(TestPyFolderSync.TEST_IN_FOLDER)])
 
         # sync
         pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
                                 TestPyFolderSync.TEST_OUT_FOLDER,
-                                frequency=None, deleteWaitlist=False).run()
+                                frequency=None, scanner=scanner, dataStore=self.dataStore).run()
+        scanner.shutdown()
 
         # assert equals
         jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
         jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
         self.assertEqual(jsonStringIN, jsonStringOut)
 
+    def test_parallel_scan_read_ahead(self):
+        scanner = pyFolderSync.ParallelScanner(workers=4, readAhead=1)
+        listed = []
+        listDir = scanner._list
+        scanner._list = lambda rootDir, relDir, *args: listed.append(relDir) or listDir(rootDir, relDir, *args)
+        scan = scanner.scan(TestPyFolderSync.TEST_IN_FOLDER)
+        next(scan)
+        time.sleep(0.1)
+        # the root and one dir ahead, however long the merge is held up
+        self.assertEqual(2, len(listed))
+        self.assertEqual([relpath for relpath, _ in pyFolderSync.scan_tree(TestPyFolderSync.TEST_IN_FOLDER)][1:],
+                         [relpath for relpath, _ in scan])
+        scanner.shutdown()
+
+    def test_fan_out_sync_files(self):
+        folderOut2 = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'out2')
+        missingFolderOut = os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'missing')
+        os.makedirs(folderOut2)
+        fanOutSync = pyFolderSync.FanOutSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             [TestPyFolderSync.TEST_OUT_FOLDER, folderOut2, missingFolderOut],
+                                             frequency=None, deleteWaitlist=False, dataStore=self.dataStore)
+        fanOutSync.run()
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), 'edited', 'w')
+        results = fanOutSync.sync_once()
+
+        # the edit was read once and written to both destinations, the missing one was skipped
+        for folderSync in fanOutSync.folderSyncs[:2]:
+            operation, = results[folderSync.folderOut].get_plan().get_operations(pyFolderSync.SyncOperation.UPDATE)
+            self.assertEqual({'resumed': 1}, operation.get_copyBackends())
+        self.assertEqual(0, len(results[fanOutSync.folderSyncs[2].folderOut].get_plan()))
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        for folderOut in [TestPyFolderSync.TEST_OUT_FOLDER, folderOut2]:
+            jsonStringOut = json.dumps(filesToJson(os.path.join(folderOut, 'root')))
+            self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_pack_small_files(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             deleteWaitlist=False,
+                                             packMaxFileSize=25, dataStore=self.dataStore)
+        folderSync.run()
+        packStore = folderSync.packStore
+        # only notesNY.txt (28 bytes) is a plain file
+        self.assertTrue(os.path.exists(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'photos', 'New York', 'notesNY.txt')))
+        self.assertFalse(os.path.exists(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt')))
+        self.assertEqual(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')),
+                         packStore.read(os.path.join('root', 'testFile1.txt')))
+
+        # grow one past the limit, delete one, move one
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'),
+                    'now far too big to be packed', 'w')
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'photosFun.txt'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photosFun.txt'))
+        folderSync.sync_once()
+        self.assertEqual(b'now far too big to be packed',
+                         _read_file(os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt')))
+        self.assertIsNone(packStore.read(os.path.join('root', 'testFile1.txt')))
+        self.assertIsNone(packStore.read(os.path.join('root', 'testFile2.txt')))
+        self.assertEqual(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photosFun.txt')),
+                         packStore.read(os.path.join('root', 'photosFun.txt')))
+
+        # a full scan sees the packed files as synced, compaction reclaims the dropped ones
+        folderSync.packStore.close()
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             packMaxFileSize=25, dataStore=self.dataStore)
+        self.assertEqual(0, len(folderSync.plan_sync()))
+        self.assertEqual(23 + 23, folderSync.packStore.compact())
+        self.assertEqual(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'notes.txt')),
+                         folderSync.packStore.read(os.path.join('root', 'photos', 'New York', 'notes.txt')))
+
+    def test_pack_delete_waitlist(self):
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None,
+                                             packMaxFileSize=25, dataStore=self.dataStore)
+        folderSync.run()
+        packStore = folderSync.packStore
+        packed = _read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+        # a packed copy waits out one cycle like a plain one
+        folderSync.sync_once()
+        self.assertEqual(packed, packStore.read(os.path.join('root', 'testFile2.txt')))
+        folderSync.sync_once()
+        self.assertIsNone(packStore.read(os.path.join('root', 'testFile2.txt')))
+
+    def test_snapshot_generations(self):
+        snapshotSync = pyFolderSync.SnapshotSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                                 TestPyFolderSync.TEST_OUT_FOLDER,
+                                                 frequency=None, linkBatchSize=2, dataStore=self.dataStore)
+        snapshotSync.run()
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'),
+                    'edited in the second generation', 'w')
+        snapshotSync.sync_once()
+
+        # the old generation kept its bytes, unchanged files are shared between generations
+        first, second = [os.path.join(TestPyFolderSync.TEST_OUT_FOLDER, name) for name in snapshotSync.get_generations()]
+        self.assertNotEqual(_read_file(os.path.join(first, 'root', 'testFile1.txt')),
+                            _read_file(os.path.join(second, 'root', 'testFile1.txt')))
+        self.assertEqual(os.stat(os.path.join(first, 'root', 'testFile2.txt')).st_ino,
+                         os.stat(os.path.join(second, 'root', 'testFile2.txt')).st_ino)
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(os.path.join(second, 'root')))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+        # pruning to one generation keeps the latest
+        snapshotSync.keepLast, snapshotSync.keepDaily, snapshotSync.keepWeekly = 1, 0, 0
+        self.assertEqual([os.path.basename(first)], snapshotSync.prune())
+        self.assertEqual([os.path.basename(second)], snapshotSync.get_generations())
+
+    def test_object_storage_sync(self):
+        store = pyFolderSync.MemoryObjectStore(minPartSize=8)
+        storage = pyFolderSync.ObjectStorageBackend(store.connect, 'backup', poolSize=2, uploadWorkers=2,
+                                                    partSize=8, multipartThreshold=24)
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'bucket'),
+                                             frequency=None,
+                                             deleteWaitlist=False,
+                                             storage=storage, dataStore=self.dataStore)
+        folderSync.run()
+        # notesNY.txt (28 bytes) went up in 8 byte parts
+        self.assertEqual(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'New York', 'notesNY.txt')),
+                         store.get_object('backup/root/photos/New York/notesNY.txt'))
+        self.assertEqual(4, store.requests['upload_part'])
+
+        # move a dir, delete a file, edit a file
+        shutil.move(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos'),
+                    os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'pics'))
+        os.remove(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt'))
+        _write_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'), 'edited', 'w')
+        folderSync.sync_once()
+        self.assertEqual(_read_file(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'pics', 'photosFun.txt')),
+                         store.get_object('backup/root/pics/photosFun.txt'))
+        self.assertEqual(b'edited', store.get_object('backup/root/testFile1.txt'))
+        # the moved dir was copied server-side, not uploaded again
+        self.assertEqual(4, store.requests['upload_part'])
+        self.assertEqual(3, store.requests['copy_object'])
+        keys = [key for key, _, _ in store.list_objects('backup/')[0]]
+        self.assertFalse([key for key in keys if 'photos/' in key or 'testFile2' in key])
+
+        # stats round-trip through metadata, stats were served from the cached listing over few connections
+        self.assertEqual(0, len(folderSync.plan_sync(fullScan=True)))
+        self.assertEqual(0, store.requests['head_object'])
+        self.assertLessEqual(store.connections, 2)
+        storage.close()
+
+    def test_watch_object_storage(self):
+        store = pyFolderSync.MemoryObjectStore()
+        storage = pyFolderSync.ObjectStorageBackend(store.connect, 'backup')
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             os.path.join(TestPyFolderSync.TEST_WORKING_FOLDER, 'bucket'),
+                                             deleteWaitlist=False,
+                                             storage=storage, dataStore=self.dataStore)
+        watcher = ReportingWatcher()
+        stopEvent = threading.Event()
+        watchThread = threading.Thread(target=folderSync.watch,
+                                       kwargs={'watcher': watcher, 'debounce': 0.02, 'stopEvent': stopEvent})
+        watchThread.start()
+        editedFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+        try:
+            self._wait_for(lambda: len(store.list_objects('backup/')[0]) == 8)
+            keys = [key for key, _, _ in store.list_objects('backup/')[0]]
+            # an edit is an update, not a move of the object onto itself
+            _write_file(editedFilepath, 'edited while watched', 'w')
+            watcher.report(editedFilepath)
+            self._wait_for(lambda: store.get_object('backup/root/testFile1.txt') == b'edited while watched')
+        finally:
+            stopEvent.set()
+            watchThread.join()
+        self.assertEqual(keys, [key for key, _, _ in store.list_objects('backup/')[0]])
+        storage.close()
+
+    def _wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not(condition()):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.02)
+
+    def test_resume_sync(self):
+        # a run that journaled its plan, then died after copying one file of root
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, dataStore=self.dataStore)
+        folderSync.dataStore.create_sync(folderSync.sync)
+        folderSync.dataStore.save_journal(folderSync.sync, folderSync.plan_sync())
+        os.makedirs(TestPyFolderSync.TEST_OUT_FOLDER_ROOT)
+        shutil.copy2(os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt'),
+                     os.path.join(TestPyFolderSync.TEST_OUT_FOLDER_ROOT, 'testFile1.txt'))
+
+        # restart, resumes the journal instead of scanning
+        folderSync = pyFolderSync.FolderSync(TestPyFolderSync.TEST_IN_FOLDER,
+                                             TestPyFolderSync.TEST_OUT_FOLDER,
+                                             frequency=None, dataStore=self.dataStore)
+        plan = folderSync.sync_once()
+        operation, = plan.get_operations(pyFolderSync.SyncOperation.CREATE)
+        self.assertEqual(1, operation.get_copyBackends()['resumed'])
+        self.assertEqual([], folderSync.dataStore.read_journal(folderSync.sync))
+        self.assertFalse(folderSync._begin_cycle())
+
+        # assert equals
+        jsonStringIN = json.dumps(filesToJson(TestPyFolderSync.TEST_IN_FOLDER_ROOT))
+        jsonStringOut = json.dumps(filesToJson(TestPyFolderSync.TEST_OUT_FOLDER_ROOT))
+        self.assertEqual(jsonStringIN, jsonStringOut)
+
+    def test_file_id_survives_move(self):
+        filepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile1.txt')
+        movedFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'photos', 'testFile1.txt')
+        fileId = pyFolderSync.get_file_id(filepath)
+        shutil.move(filepath, movedFilepath)
+        # assert equals
+        self.assertEqual(fileId, pyFolderSync.get_file_id(movedFilepath))
+        self.assertEqual(fileId, pyFolderSync.FileId.build_from_str(str(fileId)))
+        otherFilepath = os.path.join(TestPyFolderSync.TEST_IN_FOLDER_ROOT, 'testFile2.txt')
+        self.assertNotEqual(fileId, pyFolderSync.get_file_id(otherFilepath))
+
+
 if __name__ == '__main__':
     unittest.main()